@@ -6,7 +6,7 @@ import os
 import subprocess
 import time
 import traceback
-from logging.handlers import RotatingFileHandler, SMTPHandler
+from logging.handlers import SMTPHandler
 
 import simplejson
 from flask import Flask, request, jsonify, url_for, render_template
@@ -16,10 +16,11 @@ from pythonjsonlogger import jsonlogger
 from werkzeug.exceptions import NotFound
 
 from bmrbapi.exceptions import RequestException, ServerException
-from bmrbapi.schemas import validate_parameters
+from bmrbapi.schemas import build_validators, validate_parameters
 from bmrbapi.utils import querymod
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import RedisConnection, PostgresConnection
+from bmrbapi.utils.log_handlers import BackgroundLogHandler, log_file_handler
 from bmrbapi.views.db_links import db_endpoints
 from bmrbapi.views.dictionary import dictionary_endpoints
 from bmrbapi.views.entry import entry_endpoints
@@ -64,29 +65,24 @@ if querymod.configuration.get('log'):
 
 # Set up the standard logger
 app_formatter = logging.Formatter('[%(asctime)s]:%(levelname)s:%(funcName)s: %(message)s')
-application_log = RotatingFileHandler(application_log_file, maxBytes=1048576, backupCount=100)
-application_log.setFormatter(app_formatter)
-application.logger.addHandler(application_log)
+application.logger.addHandler(BackgroundLogHandler(log_file_handler(application_log_file, app_formatter)))
 application.logger.setLevel(logging.WARNING)
 
-# Set up the request loggers
+# Set up the request loggers. The records are written out in batches by a background thread, so that logging a
+#  request doesn't block on file I/O.
 
 # Plain text logger
 request_formatter = logging.Formatter('[%(asctime)s]: %(message)s')
-request_log = RotatingFileHandler(request_log_file, maxBytes=1048576, backupCount=100)
-request_log.setFormatter(request_formatter)
 rlogger = logging.getLogger("rlogger")
 rlogger.setLevel(logging.INFO)
-rlogger.addHandler(request_log)
+rlogger.addHandler(BackgroundLogHandler(log_file_handler(request_log_file, request_formatter)))
 rlogger.propagate = False
 
 # JSON logger
 json_formatter = jsonlogger.JsonFormatter()
-application_json = RotatingFileHandler(request_json_file, maxBytes=1048576, backupCount=100)
-application_json.setFormatter(json_formatter)
 jlogger = logging.getLogger("jlogger")
 jlogger.setLevel(logging.INFO)
-jlogger.addHandler(application_json)
+jlogger.addHandler(BackgroundLogHandler(log_file_handler(request_json_file, json_formatter)))
 jlogger.propagate = False
 
 # Set up the SMTP handler
@@ -213,34 +209,65 @@ def catch_all():
     return render_template('base.html', content="\n".join(links))
 
 
+def _resolve_version() -> str:
+    """ Determines the version of the API. Done once per worker, rather than on every status request. """
+
+    module_dir = os.path.dirname(os.path.realpath(__file__))
+    try:
+        return subprocess.check_output(["git", "describe", "--abbrev=0"], cwd=module_dir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        try:
+            with open(os.path.join(module_dir, 'version.txt'), 'r') as version_file:
+                return version_file.read().strip()
+        except IOError:
+            return 'unknown'
+
+
+api_version = _resolve_version()
+
+
 @application.route('/status')
 def get_status():
     """ Returns the server status."""
 
+    databases = ['metabolomics', 'macromolecules', 'chemcomps', 'combined']
+    with RedisConnection() as r:
+        pipe = r.pipeline(transaction=False)
+        for key in databases:
+            pipe.hgetall("%s:meta" % key)
+        metadata = pipe.execute()
+
     stats = {}
-    for key in ['metabolomics', 'macromolecules', 'chemcomps', 'combined']:
+    for key, meta in zip(databases, metadata):
         stats[key] = {}
-        with RedisConnection() as r:
-            for k, v in r.hgetall("%s:meta" % key).items():
-                k = k.decode()
-                v = v.decode()
-                stats[key][k] = v
-        for skey in stats[key]:
-            if skey == "update_time":
-                stats[key][skey] = float(stats[key][skey])
+        for k, v in meta.items():
+            k = k.decode()
+            v = v.decode()
+            if k == "update_time":
+                stats[key][k] = float(v)
             else:
-                stats[key][skey] = int(stats[key][skey])
+                stats[key][k] = int(v)
 
     with PostgresConnection() as pg:
-        for key in ['metabolomics', 'macromolecules']:
-            sql = '''SELECT reltuples FROM pg_class WHERE oid = '%s."Atom_chem_shift"'::regclass;''' % key
-            pg.execute(sql)
-            stats[key]['num_chemical_shifts'] = int(pg.fetchone()['reltuples'])
+        pg.execute('''
+SELECT relnamespace::regnamespace::text AS database, reltuples
+FROM pg_class
+WHERE oid IN ('metabolomics."Atom_chem_shift"'::regclass, 'macromolecules."Atom_chem_shift"'::regclass);''')
+        for row in pg.fetchall():
+            stats[row['database']]['num_chemical_shifts'] = int(row['reltuples'])
 
-    try:
-        stats['version'] = subprocess.check_output(["git", "describe", "--abbrev=0"]).strip()
-    except subprocess.CalledProcessError:
-        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'version.txt'), 'r') as version_file:
-            stats['version'] = version_file.read().strip()
+    stats['version'] = api_version
 
     return jsonify(stats)
+
+
+@application.route('/health')
+def get_health():
+    """ Returns a minimal response for load balancer health checks. Touches neither Redis nor Postgres. """
+
+    return jsonify({'status': 'ok', 'version': api_version})
+
+
+# Now that every route is registered, set up the validator of each endpoint
+build_validators(application.view_functions)
@@ -11,7 +11,9 @@ import sys
 import time
 
 from bmrbapi.reloaders.database import one_entry
+from bmrbapi.reloaders.fasta import fasta
 from bmrbapi.reloaders.inext import inext
+from bmrbapi.reloaders.mappings import mappings
 from bmrbapi.reloaders.molprobity import molprobity_full, molprobity_visualizations
 from bmrbapi.reloaders.sql_initialize import sql_initialize
 from bmrbapi.reloaders.timedomain import timedomain
@@ -65,7 +67,8 @@ def make_entry_list(name: str):
     for each_entry in old_entries:
         if each_entry not in ent_list:
             to_delete = "%s:entry:%s" % (name, each_entry)
-            if r_conn.delete(to_delete):
+            # The framecode index goes with the entry, or the entry would still look available
+            if r_conn.delete(to_delete, "%s:framecodes:%s" % (name, each_entry)):
                 logging.info("Deleted stale entry: %s" % to_delete)
 
     # Set the update time, ready status, and entry list
@@ -95,9 +98,17 @@ opt.add_option("--timedomain", action="store_true", dest="timedomain", default=F
                help="Update the timedomain tables.")
 opt.add_option("--uniprot", action="store_true", dest="uniprot", default=False, help="Update the UniProt tables.")
 opt.add_option("--xml", action="store_true", dest="xml", default=False, help="Update the XML file for BMRB entries.")
+opt.add_option("--fasta", action="store_true", dest="fasta", default=False,
+               help="Update the FASTA sequence libraries used by the FASTA search. Always done after --sql.")
+opt.add_option("--mappings", action="store_true", dest="mappings", default=False,
+               help="Render the bulk ID mappings served by the /mappings endpoints. Always done after --sql or "
+                    "--uniprot.")
 opt.add_option("--inext", action="store_true", dest="inext", default=False, help="Update the iNext tables.")
 opt.add_option("--sql", action="store_true", dest="sql", default=False,
                help="Run the SQL commands to prepare the correct indexes on the DB.")
+opt.add_option("--sql-full-rebuild", action="store_true", dest="sql_full_rebuild", default=False,
+               help="Rebuild the chemical shift and query grid tables from scratch rather than only refreshing the "
+                    "entries which changed. Only has an effect with --sql.")
 opt.add_option("--sql-host", action="store", dest='sql_host', default=configuration['postgres']['host'],
                help="Host to run the SQL updater on.")
 opt.add_option("--sql-database", action="store", dest='sql_database', default=configuration['postgres']['database'],
@@ -108,7 +119,8 @@ opt.add_option("--sql-port", action="store", dest='sql_port', default=configurat
                help="Port to connect to Postgres on.")
 opt.add_option("--all-entries", action="store_true", dest="all", default=False,
                help="Update all the databases, and run all reloaders. Equivalent to: --metabolomics --macromolecules "
-                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain")
+                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain --fasta "
+                    "--mappings")
 opt.add_option("--redis-db", action="store", dest="redis_db", default=configuration['redis']['db'],
                help="The Redis DB to use. 0 is master.")
 opt.add_option("--redis-host", action="store", dest="redis_host", default=None,
@@ -143,7 +155,7 @@ else:
 # Make sure they specify a DB
 if not (options.metabolomics or options.macromolecules or options.chemcomps or options.molprobity_visualization
         or options.molprobity_full or options.uniprot or options.xml or options.inext or options.sql or
-        options.timedomain or options.all):
+        options.timedomain or options.fasta or options.mappings or options.all):
     logging.exception("You must specify at least one of the reloaders.")
     sys.exit(1)
 
@@ -158,6 +170,8 @@ if options.all:
     options.sql = True
     options.timedomain = True
     options.xml = True
+    options.fasta = True
+    options.mappings = True
     #options.inext = True
 
 if options.timedomain:
@@ -180,12 +194,28 @@ if options.inext:
     inext()
     logger.info('Finished iNext reload...')
 
+# The FASTA libraries and mappings must not be built from the tables of a failed SQL initialization
+sql_failed = False
 if options.sql:
     logger.info('Doing SQL initialization...')
-    if sql_initialize(host=options.sql_host, database=options.sql_database, user=options.sql_user):
+    if sql_initialize(full_rebuild=options.sql_full_rebuild):
         logger.info('Finished SQL initialization...')
     else:
         logger.exception('SQL reloading exited with exception.')
+        sql_failed = True
+        logger.error('Not rebuilding the FASTA libraries or mappings from the incomplete SQL initialization.')
+
+# The FASTA libraries are built from the "Entity" rows, so are rebuilt whenever the database is reloaded
+if (options.fasta or options.sql) and not sql_failed:
+    logger.info('Doing FASTA library reload...')
+    fasta()
+    logger.info('Finished FASTA library reload...')
+
+# The mappings are rendered from the tables built by the UniProt and SQL reloaders
+if (options.mappings or options.sql or options.uniprot) and not sql_failed:
+    logger.info('Doing mappings rendering...')
+    mappings()
+    logger.info('Finished mappings rendering...')
 
 # Load the metabolomics data
 if options.metabolomics:
@@ -40,5 +40,11 @@ def one_entry(work):
 
             if ent is not None:
                 key = querymod.locate_entry(entry_name, r_conn)
-                r_conn.set(key, zlib.compress(ent.get_json().encode()))
+                # Also store which saveframes the entry has, so that they can be listed without parsing the entry
+                index_key = querymod.locate_framecode_index(entry_name)
+                pipe = r_conn.pipeline()
+                pipe.set(key, zlib.compress(ent.get_json().encode()))
+                pipe.delete(index_key)
+                pipe.hset(index_key, mapping=querymod.get_framecode_index(ent))
+                pipe.execute()
                 return entry_name
@@ -0,0 +1,389 @@
+""" Maintains the web.chem_shifts and web.query_grid tables. Rather than rebuilding them from scratch on every reload,
+only the entries whose version changed since the last reload are deleted and inserted again. The version of each
+entry that a table was last built from is stored in web.entry_versions, which is created by initialize.sql. """
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.shift_search import ATOM_TYPES, FINGERPRINT_BIN_WIDTHS
+
+# If more than this fraction of the entries in a table changed, it is faster to rebuild the whole table
+FULL_REBUILD_FRACTION = .25
+
+# Changes whenever the release history of an entry changes, which happens every time an entry is updated
+RELEASE_VERSION = '''
+SELECT entry."ID"                                                                   AS entry_id,
+       md5(COALESCE(string_agg(release::text, '|' ORDER BY release::text), ''))     AS version
+FROM {database}."Entry" AS entry
+         LEFT JOIN {database}."Release" AS release ON release."Entry_ID" = entry."ID"
+GROUP BY entry."ID"'''
+
+# A shift is repeated for each pH and temperature of its sample conditions, so each row is numbered to give the rows a
+#  unique key to paginate on
+CHEM_SHIFTS_SELECT = '''
+SELECT shifts.*, nextval('web.chem_shifts_row_id') AS row_id
+FROM (SELECT DISTINCT cs."Entry_ID"                 AS "Atom_chem_shift.Entry_ID",
+             "Entity_ID"::integer                   AS "Atom_chem_shift.Entity_ID",
+             "Entity_assembly_ID":: integer         AS "Atom_chem_shift.Entity_assembly_ID",
+             "Comp_index_ID"::integer               AS "Atom_chem_shift.Comp_index_ID",
+             "Comp_ID"                              AS "Atom_chem_shift.Comp_ID",
+             "Atom_ID"                              AS "Atom_chem_shift.Atom_ID",
+             "Atom_type"                            AS "Atom_chem_shift.Atom_type",
+             cs."Val"::numeric                      AS "Atom_chem_shift.Val",
+             cs."Val_err"::numeric                  AS "Atom_chem_shift.Val_err",
+             "Ambiguity_code"::int                  AS "Atom_chem_shift.Ambiguity_code",
+             "Assigned_chem_shift_list_ID"::integer AS "Atom_chem_shift.Assigned_chem_shift_list_ID",
+             web.convert_to_numeric(ph."Val")       AS "Sample_conditions.pH",
+             web.convert_to_numeric(temp."Val")     AS "Sample_conditions.Temperature_K",
+             '{database}'::text                     AS database
+      FROM {database}."Atom_chem_shift" AS cs
+               LEFT JOIN {database}."Assigned_chem_shift_list" AS csf
+                         ON csf."ID" = cs."Assigned_chem_shift_list_ID" AND csf."Entry_ID" = cs."Entry_ID"
+               LEFT JOIN {database}."Sample_condition_variable" AS ph
+                         ON csf."Sample_condition_list_ID" = ph."Sample_condition_list_ID" AND
+                            ph."Entry_ID" = cs."Entry_ID" AND ph."Type" = 'pH'
+               LEFT JOIN {database}."Sample_condition_variable" AS temp
+                         ON csf."Sample_condition_list_ID" = temp."Sample_condition_list_ID" AND
+                            temp."Entry_ID" = cs."Entry_ID" AND temp."Type" = 'temperature' AND temp."Val_units" = 'K'
+      WHERE {entry_filter}) AS shifts'''
+
+QUERY_GRID_SELECT = '''
+SELECT entity."Entry_ID",
+       array_agg(DISTINCT entity."Polymer_type")                                            AS "Polymer_types",
+       (SELECT "Name"
+        FROM macromolecules."Assembly" AS assem
+        WHERE assem."Entry_ID" = entity."Entry_ID"
+          AND assem."ID" = '1')                                                             AS system_name,
+       (SELECT "Title" FROM macromolecules."Entry" AS ent
+        WHERE entity."Entry_ID" = ent."ID")                                                 AS entry_title,
+       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'C' AND cs."Atom_isotope_number" = '13') AS carbon_shifts,
+       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'N' AND cs."Atom_isotope_number" = '15') AS nitrogen_shifts,
+       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'P' AND cs."Atom_isotope_number" = '31') AS phosphorus_shifts,
+       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'H' AND cs."Atom_isotope_number" = '1')  AS hydrogen_shifts,
+       COUNT(cs.*) FILTER ( WHERE
+               NOT (cs."Atom_type" = 'H' AND cs."Atom_isotope_number" = '1')
+               AND NOT (cs."Atom_type" = 'P' AND cs."Atom_isotope_number" = '31')
+               AND NOT (cs."Atom_type" = 'N' AND cs."Atom_isotope_number" = '15')
+               AND NOT (cs."Atom_type" = 'C' AND cs."Atom_isotope_number" = '13'))          AS other_shifts,
+       COUNT(cs.*)                                                                          AS total_shifts,
+       (SELECT COUNT(cc.*)
+        FROM macromolecules."Coupling_constant" AS cc
+        WHERE cc."Entry_ID" = entity."Entry_ID")                                            AS coupling_constants,
+       (SELECT COUNT(rdc.*)
+        FROM macromolecules."RDC" AS rdc
+        WHERE rdc."Entry_ID" = entity."Entry_ID")                                           as rdcs,
+       (SELECT COUNT(subq.*)
+        FROM (SELECT true
+              FROM macromolecules."T1" AS t1
+              WHERE t1."Entry_ID" = entity."Entry_ID"
+                AND t1."Val" IS NOT NULL
+              UNION ALL
+              SELECT true
+              FROM macromolecules."Auto_relaxation" AS ar
+                       LEFT JOIN macromolecules."Auto_relaxation_list" AS arl
+                                 ON arl."ID" = ar."Auto_relaxation_list_ID"
+              WHERE ar."Entry_ID" = entity."Entry_ID"
+                AND ar."Auto_relaxation_val" IS NOT NULL
+                AND (UPPER(arl."Common_relaxation_type_name") = 'R1' OR
+                     (UPPER(arl."Common_relaxation_type_name") = 'T1'))) AS subq)           AS t1s,
+       (SELECT COUNT(subq.*)
+        FROM (SELECT true
+              FROM macromolecules."T2" AS T2
+              WHERE T2."Entry_ID" = entity."Entry_ID"
+                AND T2."T2_val" IS NOT NULL
+              UNION ALL
+              SELECT true
+              FROM macromolecules."Auto_relaxation" AS ar
+                       LEFT JOIN macromolecules."Auto_relaxation_list" AS arl
+                                 ON arl."ID" = ar."Auto_relaxation_list_ID"
+              WHERE ar."Entry_ID" = entity."Entry_ID"
+                AND ar."Auto_relaxation_val" IS NOT NULL
+                AND (UPPER(arl."Common_relaxation_type_name") = 'R2' OR
+                     (UPPER(arl."Common_relaxation_type_name") = 'T2'))) AS subq)           AS t2s,
+       (SELECT COUNT(heteronuclear_noes.*)
+        FROM macromolecules."Heteronucl_NOE" AS heteronuclear_noes
+        WHERE heteronuclear_noes."Entry_ID" = entity."Entry_ID")                            AS heteronuclear_noes,
+       (SELECT COUNT(homonuclear_noes.*)
+        FROM macromolecules."Homonucl_NOE" AS homonuclear_noes
+        WHERE homonuclear_noes."Entry_ID" = entity."Entry_ID")                              AS homonuclear_noes,
+       (SELECT COUNT(order_param.*)
+        FROM macromolecules."Order_param" AS order_param
+        WHERE order_param."Entry_ID" = entity."Entry_ID"
+          AND "Order_param_val" IS NOT NULL)                                                AS order_params,
+       (SELECT COUNT(h_exchange.*)
+        FROM macromolecules."H_exch_rate" AS h_exchange
+        WHERE h_exchange."Entry_ID" = entity."Entry_ID"
+          AND "Val" IS NOT NULL)                                                            AS h_exchanges,
+       (SELECT COUNT(h_exchange_protection.*)
+        FROM macromolecules."H_exch_protection_factor" AS h_exchange_protection
+        WHERE h_exchange_protection."Entry_ID" = entity."Entry_ID"
+          AND "Val" IS NOT NULL)                                                            AS h_protection_factors,
+       (SELECT COUNT(csa."Val")
+        FROM macromolecules."CS_anisotropy" AS csa
+        WHERE csa."Entry_ID" = entity."Entry_ID"
+          AND "Val" IS NOT NULL)                                                            AS cs_anisotropys,
+       COALESCE((SELECT sets FROM web.timedomain_data WHERE bmrbid = entity."Entry_ID"), 0) AS timedomain_data_sets,
+       (SELECT array_agg(pdb_id) FROM web.pdb_link WHERE bmrb_id = entity."Entry_ID")       AS pdb_ids,
+       (SELECT (COUNT(*) = COUNT(*) FILTER ( WHERE "Mol_common_name" = 'DSS'
+           AND "Chem_shift_val"::numeric = 0
+           AND (("Indirect_shift_ratio"::numeric = 1 AND "Atom_type" = 'H' AND "Atom_isotope_number" = '1') OR
+                ("Indirect_shift_ratio"::numeric = .153506088 AND "Atom_type" = 'H' AND "Atom_isotope_number" = '2') OR
+                ("Indirect_shift_ratio"::numeric = .251449530 AND "Atom_type" = 'C' AND "Atom_isotope_number" = '13') OR
+                ("Indirect_shift_ratio"::numeric = .101329118 AND "Atom_type" = 'N' AND "Atom_isotope_number" = '15') OR
+                ("Indirect_shift_ratio"::numeric = .101329118 AND "Atom_type" = 'P' AND
+                 "Atom_isotope_number" = '31'))))::int
+        FROM macromolecules."Chem_shift_ref"
+        WHERE "Entry_ID" = entity."Entry_ID")                                               AS iupac_referencing
+FROM macromolecules."Entity" AS entity
+         LEFT JOIN macromolecules."Atom_chem_shift" AS cs
+                   ON cs."Entry_ID" = entity."Entry_ID" AND cs."Entity_ID" = entity."ID"
+WHERE "Polymer_type" IS NOT NULL AND {entry_filter}
+GROUP BY entity."Entry_ID"'''
+
+# The distinct C, N, and H shifts of each shift list, and the bins they fall into. Must match the bins calculated by
+#  shift_search.fingerprint_bin().
+SHIFT_FINGERPRINTS_SELECT = '''
+SELECT cs.database,
+       cs."Atom_chem_shift.Entry_ID"                                  AS entry_id,
+       cs."Atom_chem_shift.Assigned_chem_shift_list_ID"::text         AS list_id,
+       array_agg(DISTINCT cs."Atom_chem_shift.Val"::real)
+       FILTER ( WHERE cs."Atom_chem_shift.Atom_type" = 'C' )          AS c_shifts,
+       array_agg(DISTINCT cs."Atom_chem_shift.Val"::real)
+       FILTER ( WHERE cs."Atom_chem_shift.Atom_type" = 'N' )          AS n_shifts,
+       array_agg(DISTINCT cs."Atom_chem_shift.Val"::real)
+       FILTER ( WHERE cs."Atom_chem_shift.Atom_type" = 'H' )          AS h_shifts,
+       array_agg(DISTINCT CASE cs."Atom_chem_shift.Atom_type"
+           %s
+           END)                                                       AS bins
+FROM web.chem_shifts AS cs
+WHERE cs.database = '{database}'
+  AND cs."Atom_chem_shift.Atom_type" IN ('C', 'N', 'H')
+  AND cs."Atom_chem_shift.Val" IS NOT NULL
+  AND cs."Atom_chem_shift.Assigned_chem_shift_list_ID" IS NOT NULL
+  AND {entry_filter}
+GROUP BY cs.database, cs."Atom_chem_shift.Entry_ID", cs."Atom_chem_shift.Assigned_chem_shift_list_ID"''' % \
+                            '\n           '.join("WHEN '%s' THEN %d + floor(cs.\"Atom_chem_shift.Val\" / %s)::int" %
+                                                  (atom_type, (code + 1) * 10000000, FINGERPRINT_BIN_WIDTHS[atom_type])
+                                                  for code, atom_type in enumerate(ATOM_TYPES))
+
+# The query grid also shows the time domain data and PDB links, which are not part of the entry release history
+QUERY_GRID_VERSION = '''
+SELECT release_version.entry_id,
+       md5(release_version.version ||
+           COALESCE((SELECT sets::text FROM web.timedomain_data WHERE bmrbid = release_version.entry_id), '') ||
+           COALESCE((SELECT string_agg(pdb_id, ',' ORDER BY pdb_id)
+                     FROM web.pdb_link WHERE bmrb_id = release_version.entry_id), '')) AS version
+FROM (''' + RELEASE_VERSION + ''') AS release_version'''
+
+# Each derived table: which schemas it is built from, which SQL initialization phases it must run after, how to select
+#  the rows of a set of entries, how to compute the entry versions, how to delete the rows of a set of entries, which
+#  indexes it has (name, definition), and which of those are unique
+DERIVED_TABLES: Dict[str, dict] = {
+    'chem_shifts': {
+        'databases': ['macromolecules', 'metabolomics'],
+        'after': {'setup'},
+        'select': CHEM_SHIFTS_SELECT,
+        'entry_column': 'cs."Entry_ID"',
+        'version': RELEASE_VERSION,
+        'delete': '''DELETE FROM web.chem_shifts
+WHERE database = %(database)s AND "Atom_chem_shift.Entry_ID" = ANY(%(entry_ids)s);''',
+        'indexes': [
+            ('chem_shifts_atom_id_index', 'USING gin ("Atom_chem_shift.Atom_ID" gin_trgm_ops)'),
+            ('chem_shifts_atom_type_index', '(database, "Atom_chem_shift.Atom_type", "Atom_chem_shift.Val")'),
+            ('chem_shifts_comp_id_index', '(database, "Atom_chem_shift.Comp_ID", "Atom_chem_shift.Val")'),
+            ('chem_shifts_val_index', '(database, "Atom_chem_shift.Val")'),
+            ('chem_shifts_ph_index', '(database, "Sample_conditions.pH")'),
+            ('chem_shifts_temperature_index', '(database, "Sample_conditions.Temperature_K")'),
+            ('cluster_index', '(database, "Atom_chem_shift.Atom_type", "Atom_chem_shift.Atom_ID", '
+                              '"Atom_chem_shift.Comp_ID", "Atom_chem_shift.Val", "Sample_conditions.pH", '
+                              '"Sample_conditions.Temperature_K")'),
+            # Matches the keyset pagination of /search/chemical_shifts
+            ('entry_index', '(database, COALESCE("Atom_chem_shift.Entry_ID", \'\'), '
+                            'COALESCE("Atom_chem_shift.Assigned_chem_shift_list_ID", -1), '
+                            'COALESCE("Atom_chem_shift.Entity_assembly_ID", -1), '
+                            'COALESCE("Atom_chem_shift.Comp_index_ID", -1), COALESCE("Atom_chem_shift.Atom_ID", \'\'), '
+                            'row_id)')
+        ]
+    },
+    'query_grid': {
+        'databases': ['macromolecules'],
+        'after': {'setup'},
+        'select': QUERY_GRID_SELECT,
+        'entry_column': 'entity."Entry_ID"',
+        'version': QUERY_GRID_VERSION,
+        'delete': '''DELETE FROM web.query_grid WHERE "Entry_ID" = ANY(%(entry_ids)s);''',
+        'indexes': [
+            ('query_grid_entry_unique_index', '("Entry_ID")')
+        ],
+        # One row per entry, so that an incremental refresh can never leave an entry in the grid twice
+        'unique_indexes': {'query_grid_entry_unique_index'}
+    },
+    'shift_fingerprints': {
+        'databases': ['macromolecules', 'metabolomics'],
+        'after': {'chem_shifts'},
+        'select': SHIFT_FINGERPRINTS_SELECT,
+        'entry_column': 'cs."Atom_chem_shift.Entry_ID"',
+        'version': RELEASE_VERSION,
+        'delete': '''DELETE FROM web.shift_fingerprints
+WHERE database = %(database)s AND entry_id = ANY(%(entry_ids)s);''',
+        'indexes': [
+            ('shift_fingerprints_bins_index', 'USING gin (bins)'),
+            ('shift_fingerprints_entry_index', '(database, entry_id, list_id)')
+        ]
+    }
+}
+
+
+def _create_index(table: dict, index_name: str) -> str:
+    """ Returns the start of the statement which creates the index, which is unique if the table says so. """
+
+    return 'CREATE UNIQUE INDEX' if index_name in table.get('unique_indexes', set()) else 'CREATE INDEX'
+
+
+def _relation_kind(cur, relation: str) -> str:
+    """ Returns the pg_class relkind of a table in the web schema, or None if it does not exist. """
+
+    cur.execute('''
+SELECT relkind
+FROM pg_class
+         LEFT JOIN pg_namespace ON pg_class.relnamespace = pg_namespace.oid
+WHERE nspname = 'web' AND relname = %s''', [relation])
+    result = cur.fetchone()
+    return result[0] if result else None
+
+
+def _columns_changed(cur, relation: str) -> bool:
+    """ Returns whether the columns of the existing table differ from the ones its select now produces, in which case
+    the rows of changed entries can't simply be inserted again. """
+
+    table = DERIVED_TABLES[relation]
+    cur.execute('SELECT * FROM (%s) AS new_rows LIMIT 0;' %
+                table['select'].format(database=table['databases'][0], entry_filter='FALSE'))
+    new_columns = [desc[0] for desc in cur.description]
+    cur.execute('SELECT * FROM web.%s LIMIT 0;' % relation)
+    return new_columns != [desc[0] for desc in cur.description]
+
+
+def execute_in_parallel(statements: List[str], sessions: int = None) -> None:
+    """ Runs each of the statements in its own session and transaction, running up to the specified number of
+    sessions at once (by default, all of them). """
+
+    def execute(statement: str) -> None:
+        conn = PostgresConnection(write_access=True)
+        with conn as cur:
+            cur.execute(statement)
+            conn.commit()
+
+    with ThreadPoolExecutor(sessions or len(statements) or 1) as executor:
+        # Iterate the results so that any exception is raised here
+        list(executor.map(execute, statements))
+
+
+def _full_rebuild(conn: PostgresConnection, cur, relation: str) -> None:
+    """ Builds the table from scratch under a temporary name, and then swaps it into place. """
+
+    table = DERIVED_TABLES[relation]
+    logging.info('Rebuilding web.%s from scratch.', relation)
+
+    selects = [table['select'].format(database=database, entry_filter='TRUE') for database in table['databases']]
+    cur.execute('DROP TABLE IF EXISTS web.%s_tmp;' % relation)
+    cur.execute('CREATE TABLE web.%s_tmp AS %s;' % (relation, '\nUNION ALL\n'.join(selects)))
+
+    # The new table must be committed so that its indexes can be built from other sessions at the same time
+    conn.commit()
+    execute_in_parallel(['%s %s_tmp ON web.%s_tmp %s;' % (_create_index(table, index_name), index_name, relation,
+                                                          definition)
+                         for index_name, definition in table['indexes']])
+    cur.execute('ANALYZE web.%s_tmp;' % relation)
+
+    # Drop the old version, which may still be a materialized view, and move the new one into place
+    if _relation_kind(cur, relation) == 'm':
+        cur.execute('DROP MATERIALIZED VIEW web.%s;' % relation)
+    else:
+        cur.execute('DROP TABLE IF EXISTS web.%s;' % relation)
+    cur.execute('ALTER TABLE web.%s_tmp RENAME TO %s;' % (relation, relation))
+    for index_name, definition in table['indexes']:
+        cur.execute('ALTER INDEX web.%s_tmp RENAME TO %s;' % (index_name, index_name))
+
+    # Everything is current now
+    cur.execute('DELETE FROM web.entry_versions WHERE relation = %s;', [relation])
+    cur.execute('INSERT INTO web.entry_versions (relation, database, entry_id, version) '
+                'SELECT %s, database, entry_id, version FROM current_versions;', [relation])
+
+
+def _incremental_refresh(cur, relation: str, changed: List[tuple]) -> None:
+    """ Deletes and inserts again the rows of the entries which changed. """
+
+    table = DERIVED_TABLES[relation]
+    logging.info('Refreshing %d entries in web.%s.', len(changed), relation)
+
+    # Make sure any newly defined index exists
+    for index_name, definition in table['indexes']:
+        cur.execute('%s IF NOT EXISTS %s ON web.%s %s;' % (_create_index(table, index_name), index_name, relation,
+                                                            definition))
+
+    for database in table['databases']:
+        entry_ids = [x[1] for x in changed if x[0] == database]
+        if not entry_ids:
+            continue
+        cur.execute(table['delete'], {'database': database, 'entry_ids': entry_ids})
+        select = table['select'].format(database=database, entry_filter='%s = ANY(%%s)' % table['entry_column'])
+        cur.execute('INSERT INTO web.%s %s;' % (relation, select), [entry_ids])
+
+    cur.execute('''
+DELETE FROM web.entry_versions AS ev
+USING unnest(%s::text[], %s::text[]) AS changed(database, entry_id)
+WHERE ev.relation = %s AND ev.database = changed.database AND ev.entry_id = changed.entry_id;''',
+                [[x[0] for x in changed], [x[1] for x in changed], relation])
+    cur.execute('''
+INSERT INTO web.entry_versions (relation, database, entry_id, version)
+SELECT %s, cv.database, cv.entry_id, cv.version
+FROM current_versions AS cv
+         JOIN unnest(%s::text[], %s::text[]) AS changed(database, entry_id)
+              ON cv.database = changed.database AND cv.entry_id = changed.entry_id;''',
+                [relation, [x[0] for x in changed], [x[1] for x in changed]])
+    cur.execute('ANALYZE web.%s;' % relation)
+
+
+def refresh_derived_table(relation: str, full_rebuild: bool = False) -> None:
+    """ Brings one of the derived tables up to date. The API never sees a partially refreshed table - an
+    incremental refresh happens in one transaction, and a full rebuild is swapped into place in one transaction. """
+
+    table = DERIVED_TABLES[relation]
+    conn = PostgresConnection(write_access=True)
+    with conn as cur:
+        # Calculate the current version of every entry
+        versions = ['SELECT \'%s\'::text AS database, entry_id, version FROM (%s) AS versions' %
+                    (database, table['version'].format(database=database)) for database in table['databases']]
+        cur.execute('CREATE TEMP TABLE current_versions AS %s;' % '\nUNION ALL\n'.join(versions))
+
+        # The table must be rebuilt if it doesn't exist yet, is still a materialized view, or has different columns
+        if _relation_kind(cur, relation) != 'r' or _columns_changed(cur, relation):
+            full_rebuild = True
+
+        if not full_rebuild:
+            cur.execute('''
+SELECT COALESCE(cv.database, ev.database), COALESCE(cv.entry_id, ev.entry_id)
+FROM current_versions AS cv
+         FULL OUTER JOIN (SELECT * FROM web.entry_versions WHERE relation = %s) AS ev
+                         ON cv.database = ev.database AND cv.entry_id = ev.entry_id
+WHERE cv.version IS DISTINCT FROM ev.version;''', [relation])
+            changed = [tuple(x) for x in cur.fetchall()]
+            cur.execute('SELECT COUNT(*) FROM current_versions;')
+            total_entries = cur.fetchone()[0]
+
+            if len(changed) > total_entries * FULL_REBUILD_FRACTION:
+                full_rebuild = True
+            elif changed:
+                _incremental_refresh(cur, relation, changed)
+            else:
+                logging.info('web.%s is already up to date.', relation)
+
+        if full_rebuild:
+            _full_rebuild(conn, cur, relation)
+
+        cur.execute('GRANT ALL PRIVILEGES ON TABLE web.%s to web;' % relation)
+        cur.execute('GRANT ALL PRIVILEGES ON TABLE web.%s to bmrb;' % relation)
+        conn.commit()
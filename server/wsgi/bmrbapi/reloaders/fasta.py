@@ -0,0 +1,63 @@
+import logging
+import os
+import shutil
+import textwrap
+import time
+
+import simplejson as json
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.fasta import FASTA_POLYMER_TYPES
+
+# How many library versions to keep - workers may still be searching the previous one
+FASTA_VERSIONS_KEPT = 2
+
+
+def fasta() -> None:
+    """ Writes a FASTA sequence library for each polymer type, along with a sidecar file mapping each library sequence
+    to its entry, entity, and entry title. The libraries are written to a new version directory, and the "current"
+    symlink is then switched to it. """
+
+    library_dir = configuration['fasta_library_directory']
+    version = time.strftime('%Y%m%d%H%M%S')
+    version_dir = os.path.join(library_dir, version)
+    os.makedirs(version_dir + '.tmp')
+
+    wrapper = textwrap.TextWrapper(width=80, expand_tabs=False,
+                                   replace_whitespace=False,
+                                   drop_whitespace=False, break_on_hyphens=False)
+
+    with PostgresConnection(schema="macromolecules") as cur:
+        for library, polymer_type in FASTA_POLYMER_TYPES.items():
+            cur.execute('''
+SELECT entity."Entry_ID", entity."ID",
+  regexp_replace(entity."Polymer_seq_one_letter_code", E'[\\n\\r]+', '', 'g' ),
+  replace(regexp_replace(entry."Title", E'[\\n\\r]+', ' ', 'g' ), '  ', ' ')
+FROM "Entity" as entity
+  LEFT JOIN "Entry" as entry
+  ON entity."Entry_ID" = entry."ID"
+  WHERE entity."Polymer_seq_one_letter_code" IS NOT NULL AND "Polymer_type" = %s
+ORDER BY entity."Entry_ID", entity."ID"''', [polymer_type])
+            sequences = cur.fetchall()
+
+            # The sequences are named by their (1-indexed) position in the sidecar
+            with open(os.path.join(version_dir + '.tmp', library + '.fasta'), 'w') as library_file:
+                for position, row in enumerate(sequences, 1):
+                    library_file.write(">%s\n%s\n" % (position, "\n".join(wrapper.wrap(row[2]))))
+            with open(os.path.join(version_dir + '.tmp', library + '.json'), 'w') as sidecar_file:
+                json.dump([[row[0], row[1], row[3]] for row in sequences], sidecar_file)
+            logging.info('Wrote %d sequences to the %s FASTA library.', len(sequences), library)
+
+    # Switch the current symlink over to the new version
+    os.rename(version_dir + '.tmp', version_dir)
+    current_link = os.path.join(library_dir, 'current')
+    os.symlink(version, current_link + '.tmp')
+    os.replace(current_link + '.tmp', current_link)
+
+    # Clean up the old versions (and any failed runs)
+    versions = sorted(x for x in os.listdir(library_dir) if x != 'current' and not x.endswith('.tmp'))
+    for old_version in versions[:-FASTA_VERSIONS_KEPT]:
+        shutil.rmtree(os.path.join(library_dir, old_version))
+    for failed_run in [x for x in os.listdir(library_dir) if x.endswith('.tmp') and x != version + '.tmp']:
+        shutil.rmtree(os.path.join(library_dir, failed_run), ignore_errors=True)
@@ -0,0 +1,40 @@
+import gzip
+import hashlib
+import logging
+
+import brotli
+
+from bmrbapi.utils.bulk_mappings import HUPO_PSI_ID_EXPORT, MAPPING_MATCH_TYPES, MAPPING_STATEMENTS, \
+    iter_hupo_psi_id, locate_mapping, render_mapping
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+
+
+def _store(r, key: str, body: bytes) -> None:
+    """ Stores a rendered body in Redis, gzip and brotli compressed, along with its ETag. """
+
+    pipe = r.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping={'etag': hashlib.sha1(body).hexdigest(),
+                            'gzip': gzip.compress(body, compresslevel=9),
+                            'br': brotli.compress(body, quality=11)})
+    pipe.execute()
+
+
+def mappings() -> None:
+    """ Renders every combination of direction, format, and match type of the bulk /mappings endpoints, and the full
+    HUPO-PSI-ID export of /protein/uniprot, and stores each in Redis - gzip and brotli compressed, along with an
+    ETag - so that the endpoints can serve them directly. """
+
+    with PostgresConnection(real_dict_cursor=True) as cur, RedisConnection() as r:
+        for direction, statements in MAPPING_STATEMENTS.items():
+            for format_ in statements:
+                for match_type in MAPPING_MATCH_TYPES[direction]:
+                    body = render_mapping(cur, direction, format_, match_type)
+                    _store(r, locate_mapping(direction, format_, match_type), body)
+                    logging.info('Stored the %s %s mapping for match type %s (%d bytes).', direction, format_,
+                                 match_type, len(body))
+
+    with PostgresConnection(cursor_name='hupo_psi_id') as cur, RedisConnection() as r:
+        body = b''.join(iter_hupo_psi_id(cur))
+        _store(r, locate_mapping(*HUPO_PSI_ID_EXPORT), body)
+        logging.info('Stored the HUPO-PSI-ID export (%d bytes).', len(body))
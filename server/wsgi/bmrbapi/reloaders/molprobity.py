@@ -1,15 +1,20 @@
 import logging
+import multiprocessing
 import os
-import subprocess
 from io import BytesIO
 from subprocess import Popen, PIPE
+from typing import List
 from urllib.request import urlopen
 
+import psycopg2
 import simplejson as json
 
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection
 
+# The number of hash partitions of the molprobity.residue table
+RESIDUE_PARTITIONS = 16
+
 
 def molprobity_visualizations(resolution: int = 3000):
     csv_location = configuration['molprobity_directory'] + '/oneline_files/'
@@ -161,13 +166,51 @@ UPDATE molprobity.pdb_info_working
         conn.commit()
 
 
+def _load_residue_files(residue_files: List[str]) -> int:
+    """ Loads a group of residue CSV files into the residue staging table using one COPY session. Files which fail
+    to load are logged and skipped rather than aborting the whole load. Returns the number of files loaded. """
+
+    loaded_files = 0
+    conn = PostgresConnection(write_access=True)
+    with conn as cur:
+        for residue_file in residue_files:
+            cur.execute('SAVEPOINT residue_file;')
+            try:
+                with open(residue_file, 'r') as residue_csv:
+                    cur.copy_expert("COPY molprobity.residue_staging FROM STDIN DELIMITER ':' CSV;", residue_csv)
+            except (IOError, UnicodeDecodeError, psycopg2.DataError) as err:
+                cur.execute('ROLLBACK TO SAVEPOINT residue_file;')
+                logging.warning('Skipping MolProbity residue file %s: %s', residue_file, err)
+                continue
+            cur.execute('RELEASE SAVEPOINT residue_file;')
+            loaded_files += 1
+        conn.commit()
+
+    return loaded_files
+
+
+def _build_residue_partition(partition: int) -> None:
+    """ Indexes, clusters, and analyzes one partition of the new residue table. """
+
+    conn = PostgresConnection(write_access=True)
+    with conn as cur:
+        cur.execute('CREATE INDEX residue_tmp_p%d_residue_index ON molprobity.residue_tmp_p%d '
+                    '(pdb, model, pdb_residue_no);' % (partition, partition))
+        cur.execute('CLUSTER molprobity.residue_tmp_p%d USING residue_tmp_p%d_residue_index;' % (partition, partition))
+        cur.execute('ANALYZE molprobity.residue_tmp_p%d;' % partition)
+        conn.commit()
+
+
 def molprobity_full() -> bool:
     """ This takes a long time. """
 
-    cmd = subprocess.Popen('LC_ALL=C find %s/residue_files/combined/ -name \\*.csv -print0 | xargs -0 cat | '
-                           'sort -u -i -S2G --compress-program gzip -' %
-                           configuration['molprobity_directory'], shell=True, stderr=subprocess.PIPE,
-                           stdout=subprocess.PIPE)
+    # Find all of the residue files, and split them up between the COPY sessions
+    residue_files = []
+    for dir_path, dir_names, file_names in os.walk(os.path.join(configuration['molprobity_directory'],
+                                                                'residue_files', 'combined')):
+        residue_files.extend([os.path.join(dir_path, x) for x in file_names if x.endswith('.csv')])
+    sessions = multiprocessing.cpu_count()
+    residue_file_groups = [residue_files[x::sessions] for x in range(sessions)]
 
     conn = PostgresConnection(write_access=True)
     with conn as cur:
@@ -180,6 +223,9 @@ def molprobity_full() -> bool:
         sql_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sql", 'molprobity_one.sql')
         with open(sql_path, 'r') as sql_file:
             cur.execute(sql_file.read())
+        for partition in range(RESIDUE_PARTITIONS):
+            cur.execute('CREATE TABLE molprobity.residue_tmp_p%d PARTITION OF molprobity.residue_tmp '
+                        'FOR VALUES WITH (MODULUS %d, REMAINDER %d);' % (partition, RESIDUE_PARTITIONS, partition))
 
         # Insert the data from the files
         nobuild_location = os.path.join(configuration['molprobity_directory'],
@@ -195,19 +241,37 @@ def molprobity_full() -> bool:
         with open(orig_location, 'r') as orig_file:
             cur.copy_from(orig_file, 'tmp_table', sep=':', null='')
 
-        # Do the residue file
-        cur.copy_expert("copy molprobity.residue_tmp FROM STDIN DELIMITER ':' CSV;", cmd.stdout)
+        # The staging table must be visible to the other sessions before they can COPY into it
+        conn.commit()
 
-        # Check stderr
-        stderr = cmd.stderr.read()
-        if stderr:
-            logging.debug('Errors when sorting:\n%s', stderr)
+        # Do the residue files - duplicates are removed when moving them out of the staging table
+        with multiprocessing.Pool(sessions) as pool:
+            loaded_files = sum(pool.map(_load_residue_files, residue_file_groups))
+        logging.info('Loaded %d of %d MolProbity residue files.', loaded_files, len(residue_files))
+        if loaded_files == 0:
+            logging.critical('No MolProbity residue files could be loaded. Not replacing the residue table.')
+            conn.rollback()
             return False
 
         # Finalize
         sql_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sql", 'molprobity_two.sql')
         with open(sql_path, 'r') as sql_file:
             cur.execute(sql_file.read())
+        conn.commit()
+
+        # Build the residue partitions in parallel
+        with multiprocessing.Pool(min(sessions, RESIDUE_PARTITIONS)) as pool:
+            pool.map(_build_residue_partition, range(RESIDUE_PARTITIONS))
+        cur.execute('ANALYZE molprobity.residue_tmp;')
+
+        # Move the new residue table into place
+        cur.execute('ALTER TABLE IF EXISTS molprobity.residue RENAME TO residue_old;')
+        cur.execute('DROP TABLE IF EXISTS molprobity.residue_old;')
+        cur.execute('ALTER TABLE molprobity.residue_tmp RENAME TO residue;')
+        for partition in range(RESIDUE_PARTITIONS):
+            cur.execute('ALTER TABLE molprobity.residue_tmp_p%d RENAME TO residue_p%d;' % (partition, partition))
+            cur.execute('ALTER INDEX molprobity.residue_tmp_p%d_residue_index RENAME TO residue_p%d_residue_index;' %
+                        (partition, partition))
 
         cur.execute('GRANT SELECT ON ALL TABLES IN SCHEMA molprobity to web;')
         conn.commit()
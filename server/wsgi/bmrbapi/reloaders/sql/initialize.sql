@@ -2,8 +2,16 @@
 -- yum install postgresql-contrib
 -- psql -d bmrbeverything -U postgres
 
+-- This file is split into phases by the "-- @phase <name> [after=<phase>,<phase>] [parallel]" markers. Each phase
+--  runs in its own session and transaction once the phases it comes after have finished, so phases without a
+--  dependency between them run at the same time. The statements of a parallel phase each run in their own session.
+--  The query_grid, chem_shifts, and shift_fingerprints phases are defined in derived_tables.py.
+--  The tag_search_indexes phase is defined in sql_initialize.py.
+
+-- @phase extensions
 CREATE extension IF NOT EXISTS pg_trgm;
 
+-- @phase source_indexes after=extensions
 -- Put an index on tables that we will be querying often. Even though we will primarily use our custom table,
 --  the indexes are still helpful for certain other queries we will make against this table
 DO $$
@@ -22,110 +30,23 @@ BEGIN
     END;
 END $$;
 
-DROP MATERIALIZED VIEW IF EXISTS web.query_grid_tmp;
-CREATE MATERIALIZED VIEW web.query_grid_tmp AS
-SELECT entity."Entry_ID",
-       array_agg(DISTINCT entity."Polymer_type")                                            AS "Polymer_types",
-       (SELECT "Name"
-        FROM macromolecules."Assembly" AS assem
-        WHERE assem."Entry_ID" = entity."Entry_ID"
-          AND assem."ID" = '1')                                                             AS system_name,
-       (SELECT "Title" FROM macromolecules."Entry" AS ent
-        WHERE entity."Entry_ID" = ent."ID")                                                 AS entry_title,
-       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'C' AND cs."Atom_isotope_number" = '13') AS carbon_shifts,
-       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'N' AND cs."Atom_isotope_number" = '15') AS nitrogen_shifts,
-       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'P' AND cs."Atom_isotope_number" = '31') AS phosphorus_shifts,
-       COUNT(cs.*) FILTER ( WHERE cs."Atom_type" = 'H' AND cs."Atom_isotope_number" = '1')  AS hydrogen_shifts,
-       COUNT(cs.*) FILTER ( WHERE
-               NOT (cs."Atom_type" = 'H' AND cs."Atom_isotope_number" = '1')
-               AND NOT (cs."Atom_type" = 'P' AND cs."Atom_isotope_number" = '31')
-               AND NOT (cs."Atom_type" = 'N' AND cs."Atom_isotope_number" = '15')
-               AND NOT (cs."Atom_type" = 'C' AND cs."Atom_isotope_number" = '13'))          AS other_shifts,
-       COUNT(cs.*)                                                                          AS total_shifts,
-       (SELECT COUNT(cc.*)
-        FROM macromolecules."Coupling_constant" AS cc
-        WHERE cc."Entry_ID" = entity."Entry_ID")                                            AS coupling_constants,
-       (SELECT COUNT(rdc.*)
-        FROM macromolecules."RDC" AS rdc
-        WHERE rdc."Entry_ID" = entity."Entry_ID")                                           as rdcs,
-       (SELECT COUNT(subq.*)
-        FROM (SELECT true
-              FROM macromolecules."T1" AS t1
-              WHERE t1."Entry_ID" = entity."Entry_ID"
-                AND t1."Val" IS NOT NULL
-              UNION ALL
-              SELECT true
-              FROM macromolecules."Auto_relaxation" AS ar
-                       LEFT JOIN macromolecules."Auto_relaxation_list" AS arl
-                                 ON arl."ID" = ar."Auto_relaxation_list_ID"
-              WHERE ar."Entry_ID" = entity."Entry_ID"
-                AND ar."Auto_relaxation_val" IS NOT NULL
-                AND (UPPER(arl."Common_relaxation_type_name") = 'R1' OR
-                     (UPPER(arl."Common_relaxation_type_name") = 'T1'))) AS subq)           AS t1s,
-       (SELECT COUNT(subq.*)
-        FROM (SELECT true
-              FROM macromolecules."T2" AS T2
-              WHERE T2."Entry_ID" = entity."Entry_ID"
-                AND T2."T2_val" IS NOT NULL
-              UNION ALL
-              SELECT true
-              FROM macromolecules."Auto_relaxation" AS ar
-                       LEFT JOIN macromolecules."Auto_relaxation_list" AS arl
-                                 ON arl."ID" = ar."Auto_relaxation_list_ID"
-              WHERE ar."Entry_ID" = entity."Entry_ID"
-                AND ar."Auto_relaxation_val" IS NOT NULL
-                AND (UPPER(arl."Common_relaxation_type_name") = 'R2' OR
-                     (UPPER(arl."Common_relaxation_type_name") = 'T2'))) AS subq)           AS t2s,
-       (SELECT COUNT(heteronuclear_noes.*)
-        FROM macromolecules."Heteronucl_NOE" AS heteronuclear_noes
-        WHERE heteronuclear_noes."Entry_ID" = entity."Entry_ID")                            AS heteronuclear_noes,
-       (SELECT COUNT(homonuclear_noes.*)
-        FROM macromolecules."Homonucl_NOE" AS homonuclear_noes
-        WHERE homonuclear_noes."Entry_ID" = entity."Entry_ID")                              AS homonuclear_noes,
-       (SELECT COUNT(order_param.*)
-        FROM macromolecules."Order_param" AS order_param
-        WHERE order_param."Entry_ID" = entity."Entry_ID"
-          AND "Order_param_val" IS NOT NULL)                                                AS order_params,
-       (SELECT COUNT(h_exchange.*)
-        FROM macromolecules."H_exch_rate" AS h_exchange
-        WHERE h_exchange."Entry_ID" = entity."Entry_ID"
-          AND "Val" IS NOT NULL)                                                            AS h_exchanges,
-       (SELECT COUNT(h_exchange_protection.*)
-        FROM macromolecules."H_exch_protection_factor" AS h_exchange_protection
-        WHERE h_exchange_protection."Entry_ID" = entity."Entry_ID"
-          AND "Val" IS NOT NULL)                                                            AS h_protection_factors,
-       (SELECT COUNT(csa."Val")
-        FROM macromolecules."CS_anisotropy" AS csa
-        WHERE csa."Entry_ID" = entity."Entry_ID"
-          AND "Val" IS NOT NULL)                                                            AS cs_anisotropys,
-       COALESCE((SELECT sets FROM web.timedomain_data WHERE bmrbid = entity."Entry_ID"), 0) AS timedomain_data_sets,
-       (SELECT array_agg(pdb_id) FROM web.pdb_link WHERE bmrb_id = entity."Entry_ID")       AS pdb_ids,
-       (SELECT (COUNT(*) = COUNT(*) FILTER ( WHERE "Mol_common_name" = 'DSS'
-           AND "Chem_shift_val"::numeric = 0
-           AND (("Indirect_shift_ratio"::numeric = 1 AND "Atom_type" = 'H' AND "Atom_isotope_number" = '1') OR
-                ("Indirect_shift_ratio"::numeric = .153506088 AND "Atom_type" = 'H' AND "Atom_isotope_number" = '2') OR
-                ("Indirect_shift_ratio"::numeric = .251449530 AND "Atom_type" = 'C' AND "Atom_isotope_number" = '13') OR
-                ("Indirect_shift_ratio"::numeric = .101329118 AND "Atom_type" = 'N' AND "Atom_isotope_number" = '15') OR
-                ("Indirect_shift_ratio"::numeric = .101329118 AND "Atom_type" = 'P' AND
-                 "Atom_isotope_number" = '31'))))::int
-        FROM macromolecules."Chem_shift_ref"
-        WHERE "Entry_ID" = entity."Entry_ID")                                               AS iupac_referencing
-FROM macromolecules."Entity" AS entity
-         LEFT JOIN macromolecules."Atom_chem_shift" AS cs
-                   ON cs."Entry_ID" = entity."Entry_ID" AND cs."Entity_ID" = entity."ID"
-WHERE "Polymer_type" IS NOT NULL
-GROUP BY entity."Entry_ID";
-CREATE UNIQUE INDEX ON web.query_grid_tmp ("Entry_ID");
-
--- Go live with the new query grid info
-BEGIN;
-DROP MATERIALIZED VIEW IF EXISTS web.query_grid;
-ALTER MATERIALIZED VIEW web.query_grid_tmp RENAME TO query_grid;
-END;
-
-
--- All of the following (until the next comment) creates a materialized view
---  to be able to read the chemical shifts much faster
+-- @phase setup
+-- The version of each entry that the derived tables were last built from
+CREATE TABLE IF NOT EXISTS web.entry_versions (
+ relation text,
+ database text,
+ entry_id text,
+ version text,
+ PRIMARY KEY (relation, database, entry_id));
+GRANT ALL PRIVILEGES ON TABLE web.entry_versions to web;
+GRANT ALL PRIVILEGES ON TABLE web.entry_versions to bmrb;
+
+-- Numbers the rows of web.chem_shifts, to give them a unique key to paginate on
+CREATE SEQUENCE IF NOT EXISTS web.chem_shifts_row_id;
+GRANT ALL PRIVILEGES ON SEQUENCE web.chem_shifts_row_id to web;
+GRANT ALL PRIVILEGES ON SEQUENCE web.chem_shifts_row_id to bmrb;
+
+-- Used when building web.chem_shifts
 CREATE OR REPLACE FUNCTION web.convert_to_numeric(text)
   RETURNS numeric AS
 $func$
@@ -136,78 +57,7 @@ EXCEPTION WHEN OTHERS THEN
 END
 $func$  LANGUAGE plpgsql IMMUTABLE;
 
-DROP MATERIALIZED VIEW IF EXISTS web.chem_shifts_tmp;
-CREATE MATERIALIZED VIEW web.chem_shifts_tmp AS
-SELECT cs."Entry_ID"                          AS "Atom_chem_shift.Entry_ID",
-       "Entity_ID"::integer                   AS "Atom_chem_shift.Entity_ID",
-       "Entity_assembly_ID":: integer         AS "Atom_chem_shift.Entity_assembly_ID",
-       "Comp_index_ID"::integer               AS "Atom_chem_shift.Comp_index_ID",
-       "Comp_ID"                              AS "Atom_chem_shift.Comp_ID",
-       "Atom_ID"                              AS "Atom_chem_shift.Atom_ID",
-       "Atom_type"                            AS "Atom_chem_shift.Atom_type",
-       cs."Val"::numeric                      AS "Atom_chem_shift.Val",
-       cs."Val_err"::numeric                  AS "Atom_chem_shift.Val_err",
-       "Ambiguity_code"::int                  AS "Atom_chem_shift.Ambiguity_code",
-       "Assigned_chem_shift_list_ID"::integer AS "Atom_chem_shift.Assigned_chem_shift_list_ID",
-       web.convert_to_numeric(ph."Val")       AS "Sample_conditions.pH",
-       web.convert_to_numeric(temp."Val")     AS "Sample_conditions.Temperature_K",
-       'macromolecules'                       AS database
-FROM macromolecules."Atom_chem_shift" AS cs
-         LEFT JOIN macromolecules."Assigned_chem_shift_list" AS csf
-                   ON csf."ID" = cs."Assigned_chem_shift_list_ID" AND csf."Entry_ID" = cs."Entry_ID"
-         LEFT JOIN macromolecules."Sample_condition_variable" AS ph
-                   ON csf."Sample_condition_list_ID" = ph."Sample_condition_list_ID" AND
-                      ph."Entry_ID" = cs."Entry_ID" AND ph."Type" = 'pH'
-         LEFT JOIN macromolecules."Sample_condition_variable" AS temp
-                   ON csf."Sample_condition_list_ID" = temp."Sample_condition_list_ID" AND
-                      temp."Entry_ID" = cs."Entry_ID" AND temp."Type" = 'temperature' AND temp."Val_units" = 'K'
-UNION
-SELECT cs."Entry_ID"                          AS "Atom_chem_shift.Entry_ID",
-       "Entity_ID"::integer                   AS "Atom_chem_shift.Entity_ID",
-       "Entity_assembly_ID":: integer         AS "Atom_chem_shift.Entity_assembly_ID",
-       "Comp_index_ID"::integer               AS "Atom_chem_shift.Comp_index_ID",
-       "Comp_ID"                              AS "Atom_chem_shift.Comp_ID",
-       "Atom_ID"                              AS "Atom_chem_shift.Atom_ID",
-       "Atom_type"                            AS "Atom_chem_shift.Atom_type",
-       cs."Val"::numeric                      AS "Atom_chem_shift.Val",
-       cs."Val_err"::numeric                  AS "Atom_chem_shift.Val_err",
-       "Ambiguity_code"                       AS "Atom_chem_shift.Ambiguity_code",
-       "Assigned_chem_shift_list_ID"::integer AS "Atom_chem_shift.Assigned_chem_shift_list_ID",
-       web.convert_to_numeric(ph."Val")       AS "Sample_conditions.pH",
-       web.convert_to_numeric(temp."Val")     AS "Sample_conditions.Temperature_K",
-       'metabolomics'                         AS database
-FROM metabolomics."Atom_chem_shift" AS cs
-         LEFT JOIN metabolomics."Assigned_chem_shift_list" AS csf
-                   ON csf."ID" = cs."Assigned_chem_shift_list_ID" AND csf."Entry_ID" = cs."Entry_ID"
-         LEFT JOIN metabolomics."Sample_condition_variable" AS ph
-                   ON csf."Sample_condition_list_ID" = ph."Sample_condition_list_ID" AND
-                      ph."Entry_ID" = cs."Entry_ID" AND ph."Type" = 'pH'
-         LEFT JOIN metabolomics."Sample_condition_variable" AS temp
-                   ON csf."Sample_condition_list_ID" = temp."Sample_condition_list_ID" AND
-                      temp."Entry_ID" = cs."Entry_ID" AND temp."Type" = 'temperature' AND temp."Val_units" = 'K';
-CREATE INDEX ON web.chem_shifts_tmp USING gin ("Atom_chem_shift.Atom_ID" gin_trgm_ops);
-CREATE INDEX ON web.chem_shifts_tmp (database, "Atom_chem_shift.Atom_type", "Atom_chem_shift.Val");
-CREATE INDEX ON web.chem_shifts_tmp (database, "Atom_chem_shift.Comp_ID", "Atom_chem_shift.Val");
-CREATE INDEX ON web.chem_shifts_tmp (database, "Atom_chem_shift.Val");
-CREATE INDEX ON web.chem_shifts_tmp (database, "Sample_conditions.pH");
-CREATE INDEX ON web.chem_shifts_tmp (database, "Sample_conditions.Temperature_K");
-CREATE INDEX cluster_index_tmp ON web.chem_shifts_tmp (database, "Atom_chem_shift.Atom_type",
-                                                       "Atom_chem_shift.Atom_ID",
-                                                       "Atom_chem_shift.Comp_ID", "Atom_chem_shift.Val",
-                                                       "Sample_conditions.pH",
-                                                       "Sample_conditions.Temperature_K");
---CLUSTER web.chem_shifts_tmp USING cluster_index_tmp;
-ANALYZE web.chem_shifts_tmp;
-
-BEGIN;
-DROP MATERIALIZED VIEW IF EXISTS web.chem_shifts;
-ALTER MATERIALIZED VIEW web.chem_shifts_tmp RENAME TO chem_shifts;
-ALTER INDEX web.cluster_index_tmp RENAME TO cluster_index;
-END;
-
--- Now start with the instant search...
-
--- Helper function. We will delete this later.
+-- Helper function for the instant search. We will delete this later.
 CREATE OR REPLACE FUNCTION web.clean_title(varchar) RETURNS varchar AS
 $body$
 BEGIN
@@ -217,6 +67,7 @@ $body$
 IMMUTABLE LANGUAGE plpgsql;
 
 
+-- @phase metabolomics_summary after=setup
 --- This is for the additional information about metabolomics in the instant search
 -- 2.  Molecular Formula  3.  InCh 4.  SMILES 5.  Average Mass 6.  Molecular Weight 7.  Monoisotopic Mass
 
@@ -238,13 +89,53 @@ INSERT INTO web.metabolomics_summary_tmp (id, formula, inchi, smiles, average_ma
   WHERE sm."Type" = 'canonical';
 
 -- Move the new table into place
-BEGIN;
 ALTER TABLE IF EXISTS web.metabolomics_summary RENAME TO metabolomics_summary_old;
 ALTER TABLE web.metabolomics_summary_tmp RENAME TO metabolomics_summary;
 DROP TABLE IF EXISTS web.metabolomics_summary_old;
-END;
 
 
+-- @phase pdb_bmrb_links after=setup
+-- Every link between a PDB entry and a BMRB entry, with the PDB IDs normalized to upper case. The link type is
+--  one of exact, author, or blast.
+DROP TABLE IF EXISTS web.pdb_bmrb_links_tmp;
+CREATE TABLE web.pdb_bmrb_links_tmp (
+    pdb_id text NOT NULL,
+    bmrb_id text NOT NULL,
+    link_type text NOT NULL,
+    comment text);
+
+INSERT INTO web.pdb_bmrb_links_tmp (pdb_id, bmrb_id, link_type, comment)
+SELECT * FROM (
+    SELECT UPPER(pdb_id) AS pdb_id, bmrb_id, 'exact' AS link_type, null AS comment
+      FROM web.pdb_link
+    UNION
+    SELECT UPPER("Database_accession_code"), "Entry_ID", 'author', "Relationship"
+      FROM macromolecules."Related_entries"
+      WHERE "Database_name" = 'PDB' AND "Relationship" != 'BMRB Entry Tracking System' AND "Relationship" != 'BMRB Tracking System'
+    UNION
+    SELECT UPPER("Accession_code"), "Entry_ID", 'author', "Entry_details"
+      FROM macromolecules."Entity_db_link"
+      WHERE "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
+    UNION
+    SELECT UPPER("Accession_code"), "Entry_ID", 'author', "Entry_details"
+      FROM macromolecules."Assembly_db_link"
+      WHERE "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
+    UNION
+    SELECT UPPER("Accession_code"), "Entry_ID", 'blast', "Entry_details"
+      FROM macromolecules."Entity_db_link"
+      WHERE "Database_code" = 'PDB' AND "Author_supplied" != 'yes') AS links
+WHERE pdb_id IS NOT NULL AND bmrb_id IS NOT NULL;
+
+CREATE INDEX ON web.pdb_bmrb_links_tmp (pdb_id, link_type);
+CREATE INDEX ON web.pdb_bmrb_links_tmp (bmrb_id, link_type);
+
+-- Move the new table into place
+ALTER TABLE IF EXISTS web.pdb_bmrb_links RENAME TO pdb_bmrb_links_old;
+ALTER TABLE web.pdb_bmrb_links_tmp RENAME TO pdb_bmrb_links;
+DROP TABLE IF EXISTS web.pdb_bmrb_links_old;
+
+
+-- @phase instant_extra_search_terms after=extensions
 -- Create terms table
 DROP TABLE IF EXISTS web.instant_extra_search_terms_tmp;
 CREATE TABLE web.instant_extra_search_terms_tmp (
@@ -252,8 +143,6 @@ CREATE TABLE web.instant_extra_search_terms_tmp (
     term text,
     termname text,
     identical_term tsvector);
-CREATE INDEX ON web.instant_extra_search_terms_tmp USING gin(term gin_trgm_ops);
-CREATE INDEX ON web.instant_extra_search_terms_tmp USING gin(identical_term);
 
 INSERT INTO web.instant_extra_search_terms_tmp (id, termname, term, identical_term)
 SELECT DISTINCT "Entry_ID", 'PubMed ID', "PubMed_ID", to_tsvector("PubMed_ID") FROM metabolomics."Citation"
@@ -338,13 +227,17 @@ SELECT DISTINCT "Entry_ID", "Accession_code", 'Author provided ' || "Database_co
 -- Easier to do this to delete ~2000 rows than modify all of the above statements to exclude nulls
 DELETE FROM web.instant_extra_search_terms_tmp WHERE term IS NULL AND identical_term IS NULL;
 
+-- @phase instant_extra_search_terms_indexes after=instant_extra_search_terms parallel
+CREATE INDEX ON web.instant_extra_search_terms_tmp USING gin(term gin_trgm_ops);
+CREATE INDEX ON web.instant_extra_search_terms_tmp USING gin(identical_term);
+
+-- @phase instant_extra_search_terms_swap after=instant_extra_search_terms_indexes
 -- Move the new table into place
-BEGIN;
 ALTER TABLE IF EXISTS web.instant_extra_search_terms RENAME TO instant_extra_search_terms_old;
 ALTER TABLE web.instant_extra_search_terms_tmp RENAME TO instant_extra_search_terms;
 DROP TABLE IF EXISTS web.instant_extra_search_terms_old;
-END;
 
+-- @phase instant_cache after=setup
 -- Create tsvector table
 DROP TABLE IF EXISTS web.instant_cache_tmp;
 CREATE TABLE web.instant_cache_tmp (
@@ -433,9 +326,6 @@ LEFT JOIN metabolomics."Data_set" AS data_set
 WHERE entry."ID" like 'bmst%'
 GROUP BY entry."ID",entry."Title", entry."Submission_date";
 
--- Make sure nothing in procque gets into the released tables
-DELETE FROM macromolecules."Entry" e USING web.procque pq WHERE e."ID" = pq.accno;
-
 -- Processing
 INSERT INTO web.instant_cache_tmp
 SELECT
@@ -472,8 +362,6 @@ SELECT
  False
 FROM web.procque WHERE status = 'Withdrawn';
 
--- Create the index on the tsvector
-CREATE INDEX ON web.instant_cache_tmp USING gin(tsv);
 UPDATE web.instant_cache_tmp SET tsv =
     setweight(to_tsvector(instant_cache_tmp.id), 'A') ||
     setweight(to_tsvector(array_to_string(instant_cache_tmp.authors, ' ')),
@@ -482,13 +370,22 @@ UPDATE web.instant_cache_tmp SET tsv =
     setweight(to_tsvector(array_to_string(instant_cache_tmp.citations, '
 ')), 'D');
 
+-- @phase instant_cache_indexes after=instant_cache parallel
+-- Create the index on the tsvector
+CREATE INDEX ON web.instant_cache_tmp USING gin(tsv);
+
+-- @phase instant_cache_swap after=instant_cache_indexes
 -- Move the new table into place
-BEGIN;
 ALTER TABLE IF EXISTS web.instant_cache RENAME TO instant_cache_old;
 ALTER TABLE web.instant_cache_tmp RENAME TO instant_cache;
 DROP TABLE IF EXISTS web.instant_cache_old;
-END;
 
+-- @phase procque after=instant_extra_search_terms,instant_cache,pdb_bmrb_links,query_grid,chem_shifts,shift_fingerprints
+-- Make sure nothing in procque gets into the released tables. This runs after everything else that reads the
+--  macromolecules entries.
+DELETE FROM macromolecules."Entry" e USING web.procque pq WHERE e."ID" = pq.accno;
+
+-- @phase cleanup after=source_indexes,tag_search_indexes,metabolomics_summary,instant_extra_search_terms_swap,instant_cache_swap,procque
 -- Clean up
 DROP FUNCTION web.clean_title(varchar);
 GRANT ALL PRIVILEGES ON TABLE web.instant_extra_search_terms to web;
@@ -499,6 +396,8 @@ GRANT ALL PRIVILEGES ON TABLE web.metabolomics_summary to web;
 GRANT ALL PRIVILEGES ON TABLE web.metabolomics_summary to bmrb;
 GRANT ALL PRIVILEGES ON TABLE web.pdb_link to web;
 GRANT ALL PRIVILEGES ON TABLE web.pdb_link to bmrb;
+GRANT ALL PRIVILEGES ON TABLE web.pdb_bmrb_links to web;
+GRANT ALL PRIVILEGES ON TABLE web.pdb_bmrb_links to bmrb;
 
 ANALYSE;
 
@@ -52,7 +52,7 @@ FROM molprobity.oneline_tmp
 WITH NO DATA;
 
 
--- Residue table
+-- Residue table - hash partitioned by PDB ID, the partitions are created by the reloader
 DROP TABLE IF EXISTS molprobity.residue_tmp;
 CREATE table molprobity.residue_tmp (
 filename text,
@@ -113,4 +113,8 @@ outlier_count_separate_geometry integer,
 outlier_count integer,
 entry_id text,
 structure_validation_residue_list_id integer
-);
+) PARTITION BY HASH (pdb);
+
+-- Unlogged staging table for the residue files; the files are loaded into it in parallel and may contain duplicates
+DROP TABLE IF EXISTS molprobity.residue_staging;
+CREATE UNLOGGED TABLE molprobity.residue_staging (LIKE molprobity.residue_tmp);
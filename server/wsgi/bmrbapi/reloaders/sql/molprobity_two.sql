@@ -4,7 +4,11 @@ SELECT DISTINCT ON (pdb, model, hydrogenations, molprobity_flips, backbone_trim_
 FROM tmp_table
 ORDER BY pdb, model, hydrogenations, molprobity_flips, backbone_trim_state;
 
-CREATE INDEX ON molprobity.residue_tmp (pdb);
+-- Populate the residue table with duplicates excluded
+INSERT INTO molprobity.residue_tmp
+SELECT DISTINCT *
+FROM molprobity.residue_staging;
+DROP TABLE molprobity.residue_staging;
 
 -- Move the new tables into place
 ALTER TABLE IF EXISTS molprobity.oneline RENAME TO oneline_old;
@@ -12,10 +16,6 @@ ALTER TABLE molprobity.oneline_tmp RENAME TO oneline;
 DROP TABLE IF EXISTS molprobity.oneline_old;
 DROP TABLE tmp_table;
 
-ALTER TABLE IF EXISTS molprobity.residue RENAME TO residue_old;
-ALTER TABLE molprobity.residue_tmp RENAME TO residue;
-DROP TABLE IF EXISTS molprobity.residue_old;
-
 -- Set up permissions
 GRANT USAGE ON SCHEMA molprobity TO web;
 GRANT SELECT ON ALL TABLES IN SCHEMA molprobity TO web;
\ No newline at end of file
@@ -1,23 +1,126 @@
 import logging
 import os
-import subprocess
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from typing import Callable, Dict
 
-from bmrbapi.utils.configuration import configuration
+import psycopg2
+import redis
 
+from bmrbapi.exceptions import ServerException
+from bmrbapi.reloaders.derived_tables import DERIVED_TABLES, execute_in_parallel, refresh_derived_table
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.querymod import tag_search_index_statements
 
-def sql_initialize(host=configuration['postgres']['host'],
-                   database=configuration['postgres']['database'],
-                   user=configuration['postgres']['reload_user']) -> bool:
-    """ Prepare the DB for querying. """
+# How many phases may run at once
+PHASE_SESSIONS = 8
+
+# Matches the "-- @phase <name> [after=<phase>,<phase>] [parallel]" markers in initialize.sql
+PHASE_MARKER = re.compile(r'^-- @phase (\w+)(?: after=([\w,]+))?( parallel)?\s*$', re.MULTILINE)
+
+
+def _execute_phase(sql: str) -> None:
+    """ Runs the statements of a phase in one session and transaction. """
+
+    conn = PostgresConnection(write_access=True)
+    with conn as cur:
+        cur.execute(sql)
+        conn.commit()
+
+
+def _bump_instant_generation() -> None:
+    """ Invalidates the cached instant search results, which are keyed on this generation counter. """
+
+    try:
+        with RedisConnection() as r:
+            r.incr('instant:generation')
+    except (redis.exceptions.RedisError, ServerException) as err:
+        logging.warning('Could not invalidate the instant search cache: %s', err)
+
+
+def load_phases(full_rebuild: bool = False) -> Dict[str, dict]:
+    """ Returns the phases of the SQL initialization, keyed by name. Each phase is a dictionary containing the set of
+    phases it must run after, and a function to run it. """
 
     initialize_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sql", "initialize.sql")
+    with open(initialize_file, 'r') as sql_file:
+        initialize_sql = sql_file.read()
+
+    phases = {}
+    markers = list(PHASE_MARKER.finditer(initialize_sql))
+    for position, marker in enumerate(markers):
+        end = markers[position + 1].start() if position + 1 < len(markers) else len(initialize_sql)
+        phase_sql = initialize_sql[marker.end():end]
+
+        if marker.group(3):
+            statements = [x.strip() for x in re.split(r';\s*$', phase_sql, flags=re.MULTILINE)]
+            # Drop the comment lines, and then anything left empty
+            statements = ['\n'.join(y for y in x.split('\n') if not y.startswith('--')).strip() for x in statements]
+            run = partial(execute_in_parallel, [x for x in statements if x])
+        else:
+            run = partial(_execute_phase, phase_sql)
+        phases[marker.group(1)] = {'after': set(marker.group(2).split(',')) if marker.group(2) else set(),
+                                   'run': run}
+
+    # The derived tables are maintained in Python
+    for relation in DERIVED_TABLES:
+        phases[relation] = {'after': DERIVED_TABLES[relation]['after'],
+                            'run': partial(refresh_derived_table, relation, full_rebuild)}
+    # The indexes on the commonly searched tags are defined alongside the queries which use them
+    phases['tag_search_indexes'] = {'after': {'extensions'},
+                                    'run': partial(execute_in_parallel, tag_search_index_statements())}
+    phases['instant_generation'] = {'after': {'instant_cache_swap', 'instant_extra_search_terms_swap', 'procque'},
+                                    'run': _bump_instant_generation}
+
+    for name, phase in phases.items():
+        unknown = phase['after'] - phases.keys()
+        if unknown:
+            raise ValueError('Phase %s comes after undefined phases: %s' % (name, ', '.join(sorted(unknown))))
+
+    return phases
+
+
+def _timed_phase(name: str, run: Callable) -> None:
+    """ Runs a phase and logs how long it took. """
+
+    start_time = time.time()
+    logging.info('Starting SQL phase %s...', name)
+    run()
+    logging.info('Finished SQL phase %s in %.1f seconds.', name, time.time() - start_time)
+
+
+def run_phases(phases: Dict[str, dict]) -> None:
+    """ Runs each phase as soon as all of the phases it comes after have finished. """
+
+    finished, running = set(), {}
+    with ThreadPoolExecutor(PHASE_SESSIONS) as executor:
+        while len(finished) < len(phases):
+            for name, phase in phases.items():
+                if name not in finished and name not in running.values() and phase['after'] <= finished:
+                    running[executor.submit(_timed_phase, name, phase['run'])] = name
+            if not running:
+                raise ValueError('The SQL phases have a circular dependency: %s' %
+                                 ', '.join(sorted(phases.keys() - finished)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                # Raises the exception of a failed phase
+                future.result()
+                finished.add(name)
+
+
+def sql_initialize(full_rebuild: bool = False) -> bool:
+    """ Prepare the DB for querying. Specify full_rebuild=True to rebuild the derived tables from scratch rather than
+    only refreshing the entries which changed. """
 
-    # Rather than connect directly, we use the psql client. This is because the \copy commands will not work
-    #  in psycopg2 without doing it this way
-    proc = subprocess.Popen(['/usr/bin/psql', '-d', database, '-U', user, '-h', host, '-f', initialize_file,
-                             '-v', 'ON_ERROR_STOP=1'],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    if proc.returncode != 0 and stderr:
-        logging.warning('SQL reload experienced the following errors:\n%s' % stderr.decode())
-    return proc.returncode == 0
+    start_time = time.time()
+    try:
+        run_phases(load_phases(full_rebuild=full_rebuild))
+    except psycopg2.Error as err:
+        logging.warning('SQL reload experienced the following errors:\n%s' % err)
+        return False
+    logging.info('Finished SQL initialization in %.1f seconds.', time.time() - start_time)
+    return True
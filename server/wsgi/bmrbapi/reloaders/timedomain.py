@@ -1,67 +1,135 @@
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
-from psycopg2.extras import execute_values
+from psycopg2.extras import execute_values, Json
 
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
 
+# How many directories to scan at once - the scan is bound by the latency of the network storage, not the CPU
+TIMEDOMAIN_SCAN_THREADS = 32
+
+# A scanned directory: (mtime, {file name: size}, [sub directory names])
+ScannedDirectory = Tuple[float, Dict[str, int], List[str]]
+
+
+def _scan_tree(root: str, cache: Dict[str, ScannedDirectory]) -> Dict[str, ScannedDirectory]:
+    """ Scans a directory tree, returning the scanned directories keyed by their path relative to the root.
+
+    A directory whose mtime matches the cached mtime is not listed again. The timedomain files are never modified in
+    place once deposited, so adding, removing, or renaming a file (which updates the directory mtime) is the only
+    way the contents of a directory change. """
+
+    scanned = {}
+    pending = ['']
+    while pending:
+        relative_path = pending.pop()
+        path = os.path.join(root, relative_path)
+        mtime = os.stat(path).st_mtime
+
+        cached = cache.get(path)
+        if cached and cached[0] == mtime:
+            files, sub_dirs = cached[1], cached[2]
+        else:
+            files, sub_dirs = {}, []
+            with os.scandir(path) as directory:
+                for dir_entry in directory:
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        sub_dirs.append(dir_entry.name)
+                    else:
+                        files[dir_entry.name] = dir_entry.stat().st_size
+
+        scanned[relative_path] = (mtime, files, sub_dirs)
+        pending.extend(os.path.join(relative_path, x) for x in sub_dirs)
+
+    return scanned
+
+
+def _count_data_sets(tree: Dict[str, ScannedDirectory], relative_path: str = '') -> int:
+    """ Counts the data sets in a scanned tree. If there is only one directory, look inside it for the sets. """
+
+    sub_dirs = tree[relative_path][2]
+    if len(sub_dirs) == 1:
+        child_sets = _count_data_sets(tree, os.path.join(relative_path, sub_dirs[0]))
+        if child_sets > 1:
+            return child_sets
+    return len(sub_dirs)
+
 
 def timedomain() -> None:
-    """Creates the time domain links table."""
-
-    def get_dir_size(start_path='.'):
-        total_size = 0
-        for dir_path, dir_names, file_names in os.walk(start_path):
-            for f in file_names:
-                fp = os.path.join(dir_path, f)
-                total_size += os.path.getsize(fp)
-        return total_size
-
-    def get_data_sets(path):
-        sets = 0
-        last_set = ""
-        for f in os.listdir(path):
-            if os.path.isdir(os.path.join(path, f)):
-                sets += 1
-                last_set = os.path.join(path, f)
-        if sets == 1:
-            child_sets = get_data_sets(last_set)
-            if child_sets > 1:
-                return child_sets
-        return sets
-
-    def td_data_getter():
-        substitution_count = configuration['macromolecule_entry_directory'].count("%s")
-
-        with RedisConnection() as r:
-            all_entries = [_.decode() for _ in r.lrange('macromolecules:entry_list', 0, -1)]
-        for entry_id in all_entries:
-            td_dir = os.path.join(
-                configuration['macromolecule_entry_directory'] % ((entry_id,) * substitution_count),
-                'timedomain_data')
-            if os.path.exists(td_dir):
-                logging.debug(f'Processing TD directory: {td_dir}')
-                yield entry_id, get_dir_size(td_dir), get_data_sets(td_dir)
-            else:
-                pass
-
-    precalculated_values = list(td_data_getter())
+    """Creates the time domain links table, and the time domain file manifest."""
 
     psql = PostgresConnection(write_access=True)
+    with psql as cur:
+        cur.execute('''
+CREATE TABLE IF NOT EXISTS web.timedomain_scan_cache (
+ path text PRIMARY KEY,
+ mtime float8,
+ files jsonb,
+ sub_dirs jsonb);''')
+        psql.commit()
+        cur.execute('SELECT path, mtime, files, sub_dirs FROM web.timedomain_scan_cache;')
+        cache = {x[0]: (x[1], x[2], x[3]) for x in cur.fetchall()}
+
+    substitution_count = configuration['macromolecule_entry_directory'].count("%s")
+    with RedisConnection() as r:
+        all_entries = [_.decode() for _ in r.lrange('macromolecules:entry_list', 0, -1)]
+
+    def scan_entry(entry_id: str) -> Optional[Tuple[str, str, Dict[str, ScannedDirectory]]]:
+        td_dir = os.path.join(configuration['macromolecule_entry_directory'] % ((entry_id,) * substitution_count),
+                              'timedomain_data')
+        if not os.path.exists(td_dir):
+            return None
+        logging.debug(f'Processing TD directory: {td_dir}')
+        try:
+            return entry_id, td_dir, _scan_tree(td_dir, cache)
+        except OSError as err:
+            logging.warning(f'Could not scan TD directory {td_dir}: {err}')
+            return None
+
+    timedomain_data, manifest, new_cache = [], [], []
+    with ThreadPoolExecutor(TIMEDOMAIN_SCAN_THREADS) as executor:
+        for result in executor.map(scan_entry, all_entries):
+            if not result:
+                continue
+            entry_id, td_dir, tree = result
+
+            total_size = 0
+            for relative_path, (mtime, files, sub_dirs) in tree.items():
+                new_cache.append((os.path.join(td_dir, relative_path), mtime, Json(files), Json(sub_dirs)))
+                for file_name, size in files.items():
+                    manifest.append((entry_id, os.path.join(relative_path, file_name), size))
+                    total_size += size
+            timedomain_data.append((entry_id, total_size, _count_data_sets(tree)))
+
     with psql as cur:
         cur.execute('''
 CREATE TABLE IF NOT EXISTS web.timedomain_data (
  bmrbid text PRIMARY KEY,
  size numeric,
  sets numeric);
- DELETE FROM web.timedomain_data WHERE TRUE;''')
-        execute_values(cur, '''INSERT INTO web.timedomain_data(bmrbid, size, sets) VALUES %s;''', precalculated_values)
+CREATE TABLE IF NOT EXISTS web.timedomain_files (
+ bmrbid text,
+ path text,
+ size bigint,
+ PRIMARY KEY (bmrbid, path));
+ DELETE FROM web.timedomain_data WHERE TRUE;
+ DELETE FROM web.timedomain_files WHERE TRUE;
+ DELETE FROM web.timedomain_scan_cache WHERE TRUE;''')
+        execute_values(cur, '''INSERT INTO web.timedomain_data(bmrbid, size, sets) VALUES %s;''', timedomain_data)
+        execute_values(cur, '''INSERT INTO web.timedomain_files(bmrbid, path, size) VALUES %s;''', manifest,
+                       page_size=1000)
+        execute_values(cur, '''INSERT INTO web.timedomain_scan_cache(path, mtime, files, sub_dirs) VALUES %s;''',
+                       new_cache, page_size=1000)
         cur.execute('''
 GRANT USAGE ON schema web TO PUBLIC;
 GRANT SELECT ON ALL TABLES IN schema web TO PUBLIC;
 ALTER DEFAULT PRIVILEGES IN schema web GRANT SELECT ON TABLES TO PUBLIC;
 GRANT ALL PRIVILEGES ON TABLE web.timedomain_data to web;
 GRANT ALL PRIVILEGES ON TABLE web.timedomain_data to bmrb;
+GRANT ALL PRIVILEGES ON TABLE web.timedomain_files to web;
+GRANT ALL PRIVILEGES ON TABLE web.timedomain_files to bmrb;
 ''')
         psql.commit()
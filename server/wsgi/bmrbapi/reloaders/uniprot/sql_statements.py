@@ -28,6 +28,7 @@ ORDER BY ent."Entry_ID"::int, ent."ID"::int;
 create_mappings_table = '''
 DROP TABLE IF EXISTS web.uniprot_mappings_old CASCADE;
 DROP MATERIALIZED VIEW IF EXISTS web.hupo_psi_id_tmp_old;
+DROP TABLE IF EXISTS web.hupo_psi_id_documents_tmp;
 
 CREATE TABLE IF NOT EXISTS web.uniprot_mappings_tmp
 (
@@ -124,7 +125,22 @@ FROM web.uniprot_mappings_tmp AS uni
     AND cit."Class" = 'entry citation'
 ORDER BY uniprot_id);
 
+-- The finished HUPO-PSI-ID document of each UniProt accession
+CREATE TABLE web.hupo_psi_id_documents_tmp AS
+SELECT uniprot_id,
+       json_build_object('proteinIdentifier', 'uniprot:' || uniprot_id, 'proteinRegions',
+                         array_agg(json_build_object('source', source,
+                                                     'regionSequenceExperimental', "regionSequenceExperimental",
+                                                     'experimentType', "experimentType",
+                                                     'experimentReference', "experimentReference",
+                                                     'lastModified', "lastModified") ORDER BY id))::text AS document
+FROM web.hupo_psi_id_tmp
+GROUP BY uniprot_id;
+ALTER TABLE web.hupo_psi_id_documents_tmp ADD PRIMARY KEY (uniprot_id);
+
  -- Permissions
+GRANT ALL PRIVILEGES ON web.hupo_psi_id_documents_tmp TO web;
+GRANT ALL PRIVILEGES ON web.hupo_psi_id_documents_tmp TO bmrb;
 GRANT ALL PRIVILEGES ON web.hupo_psi_id_tmp TO web;
 GRANT ALL PRIVILEGES ON web.hupo_psi_id_tmp TO bmrb;
 GRANT ALL PRIVILEGES ON web.uniprot_mappings_tmp TO web;
@@ -138,4 +154,8 @@ DROP TABLE IF EXISTS web.uniprot_mappings_old CASCADE;
 ALTER MATERIALIZED VIEW IF EXISTS web.hupo_psi_id RENAME TO hupo_psi_id_tmp_old;
 ALTER MATERIALIZED VIEW web.hupo_psi_id_tmp RENAME TO hupo_psi_id;
 DROP MATERIALIZED VIEW IF EXISTS hupo_psi_id_tmp_old;
+
+ALTER TABLE IF EXISTS web.hupo_psi_id_documents RENAME TO hupo_psi_id_documents_old;
+ALTER TABLE web.hupo_psi_id_documents_tmp RENAME TO hupo_psi_id_documents;
+DROP TABLE IF EXISTS web.hupo_psi_id_documents_old;
 '''
\ No newline at end of file
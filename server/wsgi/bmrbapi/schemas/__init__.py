@@ -1,3 +1,6 @@
+import logging
+from typing import Dict, Iterable
+
 from flask import request
 from marshmallow import Schema
 
@@ -14,21 +17,42 @@ from bmrbapi.schemas.software import *
 from bmrbapi.utils.configuration import configuration
 
 
+# The (pre-instantiated) schema for each endpoint, built once at startup by build_validators()
+_validators: Dict[str, Schema] = {}
+_no_validation = Schema()
+
+
+def schema_name(endpoint: str) -> str:
+    """ Returns the name of the schema class for the given endpoint. """
+
+    return endpoint.split('.')[-1].title().replace("_", "")
+
+
+def build_validators(endpoints: Iterable[str]) -> None:
+    """ Instantiates the schema of each endpoint. In debug mode, an endpoint without a schema is an error. """
+
+    missing = []
+    for endpoint in endpoints:
+        #  This is either very clever or very stupid
+        schema = globals().get(schema_name(endpoint))
+        if not isinstance(schema, type) or not issubclass(schema, Schema) or schema is Schema:
+            missing.append(endpoint)
+            schema = Schema
+        _validators[endpoint] = schema()
+
+    if missing:
+        if configuration['debug']:
+            raise ServerException('Functions without validator defined: %s' % ", ".join(sorted(missing)))
+        logging.warning('Functions without validator defined: %s', ", ".join(sorted(missing)))
+
+
 def validate_parameters():
     """ Validate the parameters for the request. """
 
     if not request.endpoint:
         return
-    elif "." in request.endpoint:
-        endpoint = request.endpoint.split('.')[1].title().replace("_", "")
-    else:
-        endpoint = request.endpoint.title().replace("_", "")
-
-    #  This is either very clever or very stupid
-    schema = globals().get(endpoint, Schema)
-    if configuration['debug'] and schema is Schema:
-        raise ServerException('Function without validator defined: %s' % request.endpoint)
-    errors = schema().validate(request.args)
+
+    errors = _validators.get(request.endpoint, _no_validation).validate(request.args)
     if errors:
         raise RequestException(errors)
 
@@ -41,5 +65,9 @@ class GetStatus(Schema):
     pass
 
 
+class GetHealth(Schema):
+    pass
+
+
 class Static(Schema):
     pass
@@ -13,6 +13,13 @@ class ResponseFormats(enum.Enum):
     text = "text"
 
 
+class MappingFormats(enum.Enum):
+    json = "json"
+    text = "text"
+    arrow = "arrow"
+    npz = "npz"
+
+
 class MatchFormatsPDB(enum.Enum):
     exact = "exact"
     author = "author"
@@ -34,23 +41,23 @@ class UniprotMappingsInternal(Schema):
 
 class UniprotBmrbMap(Schema):
     match_type = CustomErrorEnum(MatchFormatsUniProt)
-    format = CustomErrorEnum(ResponseFormats)
+    format = CustomErrorEnum(MappingFormats)
 
 
 class BmrbUniprotMap(Schema):
     match_type = CustomErrorEnum(MatchFormatsUniProt)
-    format = CustomErrorEnum(ResponseFormats)
+    format = CustomErrorEnum(MappingFormats)
 
 
 class PdbBmrbMap(Schema):
     match_type = CustomErrorEnum(MatchFormatsPDB)
-    format = CustomErrorEnum(ResponseFormats)
+    format = CustomErrorEnum(MappingFormats)
     pass
 
 
 class BmrbPdbMap(Schema):
     match_type = CustomErrorEnum(MatchFormatsPDB)
-    format = CustomErrorEnum(ResponseFormats)
+    format = CustomErrorEnum(MappingFormats)
     pass
 
 
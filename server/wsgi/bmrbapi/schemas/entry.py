@@ -4,8 +4,8 @@ from marshmallow import fields, Schema
 
 from bmrbapi.schemas.default import DatabaseSchema, CustomErrorEnum
 
-__all__ = ['GetEntry', 'GetSoftwareByEntry', 'GetExperimentData', 'GetCitation', 'SimulateHsqc',
-           'ValidateEntry', 'ListEntries']
+__all__ = ['GetEntry', 'GetSoftwareByEntry', 'GetTimedomainFiles', 'GetExperimentData', 'GetCitation',
+           'SimulateHsqc', 'ValidateEntry', 'ListEntries']
 
 
 class GetEntry(Schema):
@@ -25,6 +25,10 @@ class GetSoftwareByEntry(Schema):
     pass
 
 
+class GetTimedomainFiles(Schema):
+    pass
+
+
 class GetExperimentData(Schema):
     shift = fields.Float(multiple=True)
     threshold = fields.Float()
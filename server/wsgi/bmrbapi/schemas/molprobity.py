@@ -1,9 +1,13 @@
 from marshmallow import fields, Schema
 
-__all__ = ['MolprobityResidue']
+__all__ = ['MolprobityOneline', 'MolprobityResidue']
+
+
+class MolprobityOneline(Schema):
+    pass
 
 
 class MolprobityResidue(Schema):
     """ A MolProbity residue specific search"""
 
-    r = fields.String(multiple=True)
+    r = fields.Integer(multiple=True)
@@ -1,11 +1,12 @@
 import enum
 
-from marshmallow import fields, Schema
+from marshmallow import fields, Schema, validate
 
 from bmrbapi.schemas.default import DatabaseSchema, CustomErrorEnum
 
 __all__ = ['GetBmrbDataFromPdbId', 'MultipleShiftSearch', 'GetChemicalShifts', 'GetAllValuesForTag', 'GetIdFromSearch',
-           'GetBmrbIdsFromPdbId', 'GetPdbIdsFromBmrbId', 'FastaSearch', 'Instant', 'Select', 'RerouteInstantInternal']
+           'GetBmrbIdsFromPdbId', 'GetBmrbIdsFromPdbIdRoute', 'GetPdbIdsFromBmrbId', 'FastaSearch', 'SubmitFastaSearch',
+           'FastaJob', 'Instant', 'Select', 'RerouteInstantInternal']
 
 
 class GetBmrbDataFromPdbId(Schema):
@@ -13,12 +14,12 @@ class GetBmrbDataFromPdbId(Schema):
 
 
 class MultipleShiftSearch(DatabaseSchema):
-    nthresh = fields.Float()
-    cthresh = fields.Float()
-    hthresh = fields.Float()
-    s = fields.Float(multiple=True)
+    nthresh = fields.Float(allow_nan=False, validate=validate.Range(min=0, max=10))
+    cthresh = fields.Float(allow_nan=False, validate=validate.Range(min=0, max=10))
+    hthresh = fields.Float(allow_nan=False, validate=validate.Range(min=0, max=1))
+    s = fields.Float(multiple=True, allow_nan=False)
     solvent = fields.String()
-    shift = fields.Float(multiple=True)
+    shift = fields.Float(multiple=True, allow_nan=False)
 
 
 class GetChemicalShifts(DatabaseSchema):
@@ -33,6 +34,17 @@ class GetChemicalShifts(DatabaseSchema):
     temperature_threshold = fields.Float()
     dictionary_result = fields.Bool()
 
+    class Formats(enum.Enum):
+        json = "json"
+        ndjson = "ndjson"
+        csv = "csv"
+        arrow = "arrow"
+        npz = "npz"
+
+    format = CustomErrorEnum(Formats)
+    limit = fields.Integer()
+    cursor = fields.String()
+
 
 class GetAllValuesForTag(DatabaseSchema):
     pass
@@ -46,6 +58,10 @@ class GetBmrbIdsFromPdbId(Schema):
     pass
 
 
+class GetBmrbIdsFromPdbIdRoute(Schema):
+    pass
+
+
 class GetPdbIdsFromBmrbId(Schema):
     pass
 
@@ -60,6 +76,14 @@ class FastaSearch(Schema):
     e_val = fields.String()
 
 
+class SubmitFastaSearch(Schema):
+    pass
+
+
+class FastaJob(Schema):
+    pass
+
+
 class Instant(DatabaseSchema):
     term = fields.String(required=True)
 
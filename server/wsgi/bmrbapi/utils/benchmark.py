@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+""" Benchmark the assembly of /select results, or with --validation the validation of request parameters. Run with
+python3 -m bmrbapi.utils.benchmark """
+
+import optparse
+import time
+from typing import List
+
+from bmrbapi.utils.querymod import SELECT_BATCH_ROWS, fetch_columns, select
+
+
+class _SyntheticCursor:
+    """ Serves generated rows through fetchmany(), as a server-side cursor would. """
+
+    def __init__(self, rows: List[tuple]):
+        self._rows = rows
+        self._position = 0
+
+    def fetchmany(self, size: int) -> List[tuple]:
+        batch = self._rows[self._position:self._position + size]
+        self._position += size
+        return batch
+
+
+def _row_by_row_columns(rows: List[tuple], col_names: List[str]) -> dict:
+    """ The row by row assembly that select() used previously, for comparison. """
+
+    result = {}
+    for search_field in col_names:
+        result[search_field] = []
+        s_index = col_names.index(search_field)
+        for row in rows:
+            result[search_field].append(row[s_index])
+    return result
+
+
+def _time(description: str, function) -> None:
+    start_time = time.time()
+    function()
+    print("%s: %.2f seconds" % (description, time.time() - start_time))
+
+
+def _validation_overhead(iterations: int) -> None:
+    """ Times the validation of the (empty) parameters of a request to each endpoint, both with the pre-built
+    validator and with the per-request schema lookup and instantiation that validate_parameters() did previously. """
+
+    from werkzeug.datastructures import MultiDict
+
+    from bmrbapi import application
+    from bmrbapi import schemas
+
+    args = MultiDict()
+    print("Microseconds per validation, over %d iterations:" % iterations)
+    print("%-45s %12s %12s" % ("Endpoint", "Per request", "Registry"))
+    for endpoint in sorted(application.view_functions):
+        validator = schemas._validators[endpoint]
+
+        start_time = time.time()
+        for _ in range(iterations):
+            getattr(schemas, schemas.schema_name(endpoint), schemas.Schema)().validate(args)
+        per_request = time.time() - start_time
+
+        start_time = time.time()
+        for _ in range(iterations):
+            validator.validate(args)
+        registry = time.time() - start_time
+
+        print("%-45s %12.1f %12.1f" % (endpoint, per_request / iterations * 1e6, registry / iterations * 1e6))
+
+
+# Specify some basic information about our command
+opt = optparse.OptionParser(usage="usage: %prog", version="1.0",
+                            description="Time the assembly of /select results, or the validation of request parameters.")
+opt.add_option("--rows", action="store", dest="rows", type="int", default=1000000,
+               help="The number of rows to generate for the synthetic benchmark.")
+opt.add_option("--columns", action="store", dest="columns", type="int", default=8,
+               help="The number of columns to generate for the synthetic benchmark.")
+opt.add_option("--table", action="store", dest="table", default=None,
+               help="Also time a select of every row of this table from the database, for example Atom_chem_shift.")
+opt.add_option("--database", action="store", dest="database", default="macromolecules",
+               help="The database containing the table.")
+opt.add_option("--validation", action="store_true", dest="validation", default=False,
+               help="Instead, time the validation of request parameters for each endpoint.")
+opt.add_option("--iterations", action="store", dest="iterations", type="int", default=10000,
+               help="The number of validations to time for each endpoint.")
+(options, cmd_input) = opt.parse_args()
+
+if options.validation:
+    _validation_overhead(options.iterations)
+    raise SystemExit(0)
+
+names = ["column_%d" % x for x in range(options.columns)]
+synthetic_rows = [tuple("%d.%d" % (x, y) for y in range(options.columns)) for x in range(options.rows)]
+print("Assembling %d rows of %d columns." % (options.rows, options.columns))
+_time("Row by row", lambda: _row_by_row_columns(synthetic_rows, names))
+_time("Batched transpose (%d rows per batch)" % SELECT_BATCH_ROWS,
+      lambda: fetch_columns(_SyntheticCursor(synthetic_rows), options.columns))
+
+if options.table:
+    _time("select(['*'], '%s') from the database" % options.table,
+          lambda: select(['*'], options.table, database=options.database))
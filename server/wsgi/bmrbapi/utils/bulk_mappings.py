@@ -0,0 +1,79 @@
+from typing import Dict, Iterator, Optional
+
+import redis
+import simplejson as json
+
+import bmrbapi.views.sql.db_links as sql_statements
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.connections import RedisConnection
+
+# The SQL used to generate each mapping, by direction and format
+MAPPING_STATEMENTS = {'uniprot_bmrb': {'text': sql_statements.uniprot_bmrb_map_text,
+                                       'json': sql_statements.uniprot_bmrb_map_json},
+                      'bmrb_uniprot': {'text': sql_statements.bmrb_uniprot_map_text,
+                                       'json': sql_statements.bmrb_uniprot_map_json},
+                      'pdb_bmrb': {'text': sql_statements.pdb_bmrb_map_text,
+                                   'json': sql_statements.pdb_bmrb_map_json},
+                      'bmrb_pdb': {'text': sql_statements.bmrb_pdb_map_text,
+                                   'json': sql_statements.bmrb_pdb_map_json},
+                      'uniprot_uniprot': {'text': sql_statements.uniprot_uniprot_map}
+                      }
+
+# The match types of each mapping direction. The UniProt->UniProt mapping doesn't have a match type.
+_PDB_MATCH_TYPES = ['exact', 'author', 'blast', 'assembly', 'all']
+_UNIPROT_MATCH_TYPES = ['author', 'blast', 'pdb', 'all']
+MAPPING_MATCH_TYPES = {'uniprot_bmrb': _UNIPROT_MATCH_TYPES,
+                       'bmrb_uniprot': _UNIPROT_MATCH_TYPES,
+                       'pdb_bmrb': _PDB_MATCH_TYPES,
+                       'bmrb_pdb': _PDB_MATCH_TYPES,
+                       'uniprot_uniprot': ['all']}
+
+MAPPING_MIMETYPES = {'json': 'application/json', 'text': 'text/plain', 'hupo-psi-id': 'application/json'}
+
+# The full HUPO-PSI-ID export of /protein/uniprot is stored alongside the mappings, as this (direction, format,
+#  match type)
+HUPO_PSI_ID_EXPORT = ('uniprot', 'hupo-psi-id', 'all')
+
+
+def locate_mapping(direction: str, format_: str, match_type: str) -> str:
+    """ Returns the Redis key of a pre-rendered mapping. """
+
+    return "mappings:%s:%s:%s" % (direction, format_, match_type)
+
+
+def render_mapping(cur, direction: str, format_: str, match_type: str) -> bytes:
+    """ Runs the query for a mapping using the provided (dictionary) cursor, and returns the response body. """
+
+    if direction == 'uniprot_uniprot':
+        cur.execute(MAPPING_STATEMENTS[direction][format_])
+    else:
+        cur.execute(MAPPING_STATEMENTS[direction][format_], ['%' if match_type == 'all' else match_type])
+
+    if format_ == 'text':
+        return "\n".join([x['string'] for x in cur.fetchall()]).encode()
+    return json.dumps(cur.fetchall()).encode()
+
+
+def iter_hupo_psi_id(cur) -> Iterator[bytes]:
+    """ Yields the JSON array of the HUPO-PSI-ID documents of every UniProt accession, a batch of documents at a
+    time. The documents are already rendered, so this is just a scan of web.hupo_psi_id_documents. """
+
+    cur.execute('SELECT document FROM web.hupo_psi_id_documents ORDER BY uniprot_id')
+    separator = b'['
+    batch = cur.fetchmany(1000)
+    while batch:
+        yield separator + b','.join(x[0].encode() for x in batch)
+        separator = b','
+        batch = cur.fetchmany(1000)
+    yield b']' if separator == b',' else b'[]'
+
+
+def get_stored_mapping(direction: str, format_: str, match_type: str) -> Optional[Dict[bytes, bytes]]:
+    """ Returns the pre-rendered mapping from Redis - its ETag and compressed bodies - or None if it hasn't been
+    rendered or Redis isn't available. """
+
+    try:
+        with RedisConnection() as r:
+            return r.hgetall(locate_mapping(direction, format_, match_type)) or None
+    except (redis.exceptions.RedisError, ServerException):
+        return None
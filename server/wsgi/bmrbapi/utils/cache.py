@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+import zlib
+from typing import Callable, Iterator, Optional, Union
+
+import redis
+import simplejson as json
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.connections import RedisConnection
+
+# How often to check whether another worker has finished computing a value, and how long to wait for it
+POLL_INTERVAL = .05
+LOCK_TIMEOUT = 10
+
+# How long a background refresh of a value may take before another worker tries again
+REFRESH_LOCK_TIMEOUT = 300
+
+# How much of a cached stream to decompress at once
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def _load(value: bytes):
+    return json.loads(zlib.decompress(value), use_decimal=True)
+
+
+def cached_json(key: str, compute: Callable[[], Optional[object]], ttl: int, generation_key: str = None):
+    """ Returns the value stored in Redis under the key, or computes it with the supplied function, stores it
+    (compressed JSON) for ttl seconds, and returns it. A computed value of None is not stored.
+
+    If a generation_key is provided, the current value of that Redis counter is made part of the key, so that
+    incrementing the counter invalidates everything cached under it.
+
+    Only one worker computes a given key at a time - the others wait for it to store the result rather than running
+    the same query concurrently. If Redis is unavailable the value is simply computed. """
+
+    try:
+        connection = RedisConnection()
+    except ServerException as err:
+        logging.warning('Could not use the Redis cache: %s', err)
+        return compute()
+
+    with connection as r:
+        try:
+            if generation_key:
+                key = '%s:%s' % (key, int(r.get(generation_key) or 0))
+            lock_key = key + ':lock'
+            value, have_lock = r.get(key), False
+            give_up = time.time() + LOCK_TIMEOUT
+            while value is None and time.time() < give_up:
+                have_lock = r.set(lock_key, 1, nx=True, ex=LOCK_TIMEOUT)
+                if have_lock:
+                    break
+                # Another worker is computing the value - wait for it
+                time.sleep(POLL_INTERVAL)
+                value = r.get(key)
+        except redis.exceptions.RedisError as err:
+            logging.warning('Could not use the Redis cache: %s', err)
+            return compute()
+
+        if value is not None:
+            return _load(value)
+        if not have_lock:
+            logging.warning('Timed out waiting for the cached value of %s.', key)
+            return compute()
+
+        try:
+            result = compute()
+            if result is not None:
+                try:
+                    r.set(key, zlib.compress(json.dumps(result).encode()), ex=ttl)
+                except redis.exceptions.RedisError as err:
+                    logging.warning('Could not store %s in the Redis cache: %s', key, err)
+            return result
+        finally:
+            try:
+                r.delete(lock_key)
+            except redis.exceptions.RedisError:
+                pass
+
+
+def _store_refreshed(key: str, compute: Callable[[], object], ttl: int) -> object:
+    value = compute()
+    try:
+        with RedisConnection() as r:
+            r.set(key, zlib.compress(json.dumps({'time': time.time(), 'value': value}).encode()), ex=ttl)
+    except (redis.exceptions.RedisError, ServerException) as err:
+        logging.warning('Could not store %s in the Redis cache: %s', key, err)
+    return value
+
+
+def _background_refresh(key: str, compute: Callable[[], object], ttl: int) -> None:
+    try:
+        _store_refreshed(key, compute, ttl)
+    except Exception:
+        logging.exception('Could not refresh the cached value of %s.', key)
+    finally:
+        try:
+            with RedisConnection() as r:
+                r.delete(key + ':refresh')
+        except (redis.exceptions.RedisError, ServerException):
+            pass
+
+
+def refreshed_json(key: str, compute: Callable[[], object], refresh_after: int, ttl: int):
+    """ Returns the value stored in Redis under the key, computing and storing it (as compressed JSON, for ttl
+    seconds) if it isn't there yet. Once the stored value is more than refresh_after seconds old, one worker
+    recomputes it in a background thread while the stored value continues to be served, so that only the very first
+    request has to wait for the value to be computed. """
+
+    try:
+        with RedisConnection() as r:
+            stored = r.get(key)
+            if stored is not None:
+                stored = _load(stored)
+                refresh = time.time() - stored['time'] > refresh_after and \
+                    r.set(key + ':refresh', 1, nx=True, ex=REFRESH_LOCK_TIMEOUT)
+    except (redis.exceptions.RedisError, ServerException) as err:
+        logging.warning('Could not use the Redis cache: %s', err)
+        return compute()
+
+    if stored is None:
+        return _store_refreshed(key, compute, ttl)
+    if refresh:
+        threading.Thread(target=_background_refresh, args=(key, compute, ttl), daemon=True).start()
+    return stored['value']
+
+
+def _decompress_stream(value: bytes) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj()
+    for position in range(0, len(value), STREAM_CHUNK_SIZE):
+        yield decompressor.decompress(value[position:position + STREAM_CHUNK_SIZE])
+    yield decompressor.flush()
+
+
+def _compress_and_store(key: str, chunks: Iterator[Union[str, bytes]], ttl: int) -> Iterator[bytes]:
+    compressor, compressed = zlib.compressobj(), []
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            compressed.append(compressor.compress(chunk))
+            yield chunk
+    finally:
+        # Release whatever the stream holds open right away if the client goes away mid-stream
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    compressed.append(compressor.flush())
+
+    # Only reached if the whole stream was sent
+    try:
+        with RedisConnection() as r:
+            r.set(key, b''.join(compressed), ex=ttl)
+    except (redis.exceptions.RedisError, ServerException) as err:
+        logging.warning('Could not store %s in the Redis cache: %s', key, err)
+
+
+def cached_stream(key: str, open_stream: Callable[[], Iterator[Union[str, bytes]]], ttl: int) -> Iterator[bytes]:
+    """ Returns an iterator over a response body which is stored (compressed) in Redis under the key. If it isn't
+    stored, the function is called to open the stream, and the stream is stored for ttl seconds once it has been sent
+    in full. The function is called before this returns, so that any error opening the stream is raised here rather
+    than after the response has started.
+
+    Neither the cached body nor the stream is ever held in memory uncompressed. """
+
+    try:
+        with RedisConnection() as r:
+            value = r.get(key)
+    except (redis.exceptions.RedisError, ServerException) as err:
+        logging.warning('Could not use the Redis cache: %s', err)
+        return iter(open_stream())
+
+    if value is not None:
+        return _decompress_stream(value)
+    return _compress_and_store(key, open_stream(), ttl)
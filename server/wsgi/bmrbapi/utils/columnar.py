@@ -0,0 +1,150 @@
+import io
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+import numpy
+
+from bmrbapi.exceptions import ServerException
+
+COLUMNAR_FORMATS = {'arrow': 'application/vnd.apache.arrow.stream',
+                    'npz': 'application/octet-stream'}
+
+# Postgres type OIDs, and how the columns of each type are encoded
+FLOAT_OIDS = {700, 701, 1700}  # float4, float8, numeric
+INT32_OIDS = {21, 23}  # int2, int4
+INT64_OIDS = {20}  # int8
+BOOL_OIDS = {16}
+ARRAY_OIDS = {1000, 1005, 1007, 1009, 1015, 1016, 1021, 1022, 1231}  # Arrays of the above, and of text
+
+# A column: (name, kind), where kind is one of 'float', 'int32', 'int64', 'bool', 'list', or 'string'
+Column = Tuple[str, str]
+
+
+def column_kinds(description: Sequence) -> List[Column]:
+    """ Returns the name and the kind of each column of a cursor description. Anything which isn't numeric, boolean,
+    or an array is sent as a (dictionary encoded) string. """
+
+    columns = []
+    for desc in description:
+        if desc[1] in FLOAT_OIDS:
+            kind = 'float'
+        elif desc[1] in INT32_OIDS:
+            kind = 'int32'
+        elif desc[1] in INT64_OIDS:
+            kind = 'int64'
+        elif desc[1] in BOOL_OIDS:
+            kind = 'bool'
+        elif desc[1] in ARRAY_OIDS:
+            kind = 'list'
+        else:
+            kind = 'string'
+        columns.append((desc[0], kind))
+    return columns
+
+
+def _transpose(rows: list, width: int) -> List[tuple]:
+    """ Turns a batch of rows (lists or dictionaries) into a list of columns. """
+
+    if not rows:
+        return [()] * width
+    return list(zip(*(row.values() if isinstance(row, dict) else row for row in rows)))
+
+
+def _to_string(value) -> str:
+    return value if value is None or isinstance(value, str) else str(value)
+
+
+def _import_pyarrow():
+    """ pyarrow is only needed for Arrow output, so it is imported on first use. """
+
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise ServerException('Arrow output is not available on this server.')
+    return pyarrow
+
+
+def _arrow_stream(columns: List[Column], batches: Iterable[list]) -> Iterator[bytes]:
+    """ Yields an Arrow IPC stream, one record batch at a time. """
+
+    pyarrow = _import_pyarrow()
+    types = {'float': pyarrow.float64(), 'int32': pyarrow.int32(), 'int64': pyarrow.int64(),
+             'bool': pyarrow.bool_(), 'list': pyarrow.list_(pyarrow.string()),
+             'string': pyarrow.dictionary(pyarrow.int32(), pyarrow.string())}
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+
+    def to_array(kind: str, values: tuple) -> 'pyarrow.Array':
+        if kind == 'float':
+            return pyarrow.array([None if x is None else float(x) for x in values], type=pyarrow.float64())
+        if kind == 'string':
+            return pyarrow.array([_to_string(x) for x in values], type=pyarrow.string()).dictionary_encode()
+        if kind == 'list':
+            return pyarrow.array([None if x is None else [_to_string(y) for y in x] for x in values],
+                                 type=types['list'])
+        return pyarrow.array(values, type=types[kind])
+
+    sink = io.BytesIO()
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            if not batch:
+                continue
+            arrays = [to_array(kind, values) for (name, kind), values in zip(columns, _transpose(batch, len(columns)))]
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+            yield drain()
+    yield drain()
+
+
+def _npz_archive(columns: List[Column], batches: Iterable[list]) -> Iterator[bytes]:
+    """ Yields a NumPy .npz archive with one array per column. The archive can only be written once all of the
+    batches have been fetched.
+
+    Numeric columns containing nulls are stored as float64 with NaN for the nulls. String columns are dictionary
+    encoded as in pandas: "<name>" holds int32 codes (-1 for null) into the "<name>.categories" array. Array columns
+    are flattened into "<name>" with the end offset of each row in "<name>.offsets". """
+
+    values = [[] for _ in columns]
+    for batch in batches:
+        for position, column_values in enumerate(_transpose(batch, len(columns))):
+            values[position].extend(column_values)
+
+    arrays = {}
+    for (name, kind), column_values in zip(columns, values):
+        if kind == 'string':
+            categories, codes = {}, numpy.empty(len(column_values), dtype=numpy.int32)
+            for position, value in enumerate(column_values):
+                codes[position] = -1 if value is None else categories.setdefault(_to_string(value), len(categories))
+            arrays[name] = codes
+            arrays[name + '.categories'] = numpy.array(list(categories), dtype=str)
+        elif kind == 'list':
+            arrays[name] = numpy.array([_to_string(y) for x in column_values if x for y in x], dtype=str)
+            arrays[name + '.offsets'] = numpy.cumsum([len(x) if x else 0 for x in column_values], dtype=numpy.int64)
+        elif kind == 'bool' and None not in column_values:
+            arrays[name] = numpy.array(column_values, dtype=bool)
+        elif kind in ('int32', 'int64') and None not in column_values:
+            arrays[name] = numpy.array(column_values, dtype=numpy.int32 if kind == 'int32' else numpy.int64)
+        else:
+            arrays[name] = numpy.array([numpy.nan if x is None else float(x) for x in column_values],
+                                       dtype=numpy.float64)
+
+    archive = io.BytesIO()
+    numpy.savez(archive, **arrays)
+    yield archive.getvalue()
+
+
+def encode_columnar(description: Sequence, batches: Iterable[list], output_format: str) -> Iterator[bytes]:
+    """ Encodes batches of rows from a cursor with the given description as typed columns, in either the Arrow IPC
+    stream format or as a NumPy .npz archive. Decimal values are converted to float64. """
+
+    columns = column_kinds(description)
+    if output_format == 'arrow':
+        # Make sure that pyarrow is available before the response is started
+        _import_pyarrow()
+        return _arrow_stream(columns, batches)
+    return _npz_archive(columns, batches)
@@ -16,10 +16,12 @@ class PostgresConnection:
     Specify write_access=True to use the reload user account with write access. Do not use this whenever user input
     is involved!
     Specify ets=True to connect to the ETS database.
-    Specify a schema to set it as the default search path."""
+    Specify a schema to set it as the default search path.
+    Specify a cursor_name to get a server-side (named) cursor, which fetches the results in batches as they are
+    iterated rather than all at once. A named cursor can only execute one query."""
 
     def __init__(self, write_access: bool = False, ets: bool = False, schema: str = None,
-                 real_dict_cursor: bool = False):
+                 real_dict_cursor: bool = False, cursor_name: str = None):
 
         self._ets = ets
         self._reload = write_access
@@ -34,6 +36,7 @@ class PostgresConnection:
             if schema not in ["metabolomics", "macromolecules", "chemcomps"]:
                 raise RequestException("Invalid database: %s." % schema)
         self._schema = schema
+        self._cursor_name = cursor_name
 
     def __enter__(self) -> Union[psycopg2.extras.DictCursor, psycopg2.extras.RealDictCursor]:
 
@@ -53,6 +56,8 @@ class PostgresConnection:
         cursor = self._conn.cursor()
         if self._schema:
             cursor.execute('SET search_path=public,%s;', [self._schema])
+        if self._cursor_name:
+            return self._conn.cursor(name=self._cursor_name)
         return cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from tempfile import NamedTemporaryFile
+from typing import Dict, List, Optional, Tuple
+
+import simplejson as json
+
+from bmrbapi.exceptions import APIException, ServerException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.querymod import SUBMODULE_DIR
+
+# The FASTA libraries, and the polymer type of the sequences in each
+FASTA_POLYMER_TYPES = {'polymer': 'polypeptide(L)', 'rna': 'polyribonucleotide', 'dna': 'polydeoxyribonucleotide'}
+
+# How many threads each fasta36 search uses, how many searches each worker runs at once, and how many searches a worker
+#  will accept (running or waiting to run) before turning new ones away
+FASTA_THREADS = configuration.get('fasta_threads', 4)
+FASTA_CONCURRENT_JOBS = configuration.get('fasta_concurrent_jobs', 2)
+FASTA_MAX_PENDING_JOBS = configuration.get('fasta_max_pending_jobs', 20)
+
+# How long (in seconds) a search may take, and how long the results (or failure) of a search are kept
+FASTA_JOB_TIMEOUT = 600
+FASTA_RESULT_TTL = 86400
+FASTA_FAILURE_TTL = 60
+# How long the state of a queued or running search is kept. A queued search may wait for every search ahead of it in
+#  the worker to run for the full timeout, and a running search needs time to store its results after the timeout.
+FASTA_QUEUED_TTL = FASTA_JOB_TIMEOUT * (FASTA_MAX_PENDING_JOBS // FASTA_CONCURRENT_JOBS + 1)
+FASTA_RUNNING_TTL = FASTA_JOB_TIMEOUT + 60
+# How often a worker refreshes the heartbeats of its queued and running searches, and how long a heartbeat lasts. A
+#  queued or running search whose heartbeat has expired belonged to a worker which died, and is run again when it is
+#  next submitted.
+FASTA_HEARTBEAT_INTERVAL = 10
+FASTA_HEARTBEAT_TTL = 30
+
+_sidecars: Dict[Tuple[str, str], List[list]] = {}
+_sidecar_lock = threading.Lock()
+
+
+def get_fasta_library(library: str) -> Tuple[str, str, List[list]]:
+    """ Returns the version of the current FASTA library of the given type, its path, and its sidecar - the
+    [entry ID, entity ID, entry title] of each sequence in the library, in order. The sidecar of each library version
+    is only loaded once per worker. """
+
+    current_link = os.path.join(configuration['fasta_library_directory'], 'current')
+    try:
+        version = os.readlink(current_link)
+    except OSError:
+        raise ServerException("Unable to perform FASTA search. The sequence libraries have not been generated.")
+    version_dir = os.path.join(configuration['fasta_library_directory'], version)
+
+    with _sidecar_lock:
+        if (version, library) not in _sidecars:
+            with open(os.path.join(version_dir, library + '.json'), 'r') as sidecar_file:
+                sidecar = json.load(sidecar_file)
+            # Forget the sidecars of the previous versions
+            for key in [x for x in _sidecars if x[1] == library]:
+                del _sidecars[key]
+            _sidecars[(version, library)] = sidecar
+
+    return version, os.path.join(version_dir, library + '.fasta'), _sidecars[(version, library)]
+
+
+def run_fasta(sequence: str, library: str, e_val: Optional[str] = None) -> List[dict]:
+    """ Runs a FASTA search of the sequence against the current library of the given type. """
+
+    fasta_binary = os.path.join(SUBMODULE_DIR, "fasta36", "bin", "fasta36")
+    if not os.path.isfile(fasta_binary):
+        raise ServerException("Unable to perform FASTA search. Server improperly installed.")
+
+    _, library_path, sidecar = get_fasta_library(library)
+
+    # Use a temporary file to store the FASTA search string
+    with NamedTemporaryFile(dir="/tmp") as fasta_file:
+        fasta_file.write((">query\n%s" % sequence.upper()).encode())
+        fasta_file.flush()
+
+        # Set up the FASTA arguments
+        fasta_arguments = [fasta_binary, "-m", "8", "-T", str(FASTA_THREADS)]
+        if e_val:
+            fasta_arguments.extend(["-E", e_val])
+        fasta_arguments.extend([fasta_file.name, library_path])
+
+        # Run FASTA
+        res = subprocess.check_output(fasta_arguments, stderr=subprocess.STDOUT, timeout=FASTA_JOB_TIMEOUT).decode()
+
+    # Combine the results
+    results = []
+    for line in res.split("\n"):
+        cols = line.split()
+        if len(cols) == 12:
+            matching_row = sidecar[int(cols[1]) - 1]
+            results.append({'entry_id': matching_row[0], 'entity_id': matching_row[1],
+                            'entry_title': matching_row[2], 'percent_id': Decimal(cols[2]),
+                            'alignment_length': int(cols[3]), 'mismatches': int(cols[4]),
+                            'gap_openings': int(cols[5]), 'q.start': int(cols[6]),
+                            'q.end': int(cols[7]), 's.start': int(cols[8]), 's.end': int(cols[9]),
+                            'e-value': Decimal(cols[10]), 'bit_score': Decimal(cols[11])})
+    return results
+
+
+_executor = ThreadPoolExecutor(FASTA_CONCURRENT_JOBS)
+_admission = threading.BoundedSemaphore(FASTA_MAX_PENDING_JOBS)
+
+# The queued and running searches of this worker, whose heartbeats it keeps up
+_pending_jobs = set()
+_pending_lock = threading.Lock()
+_heartbeat_pid = None
+
+
+def _job_owner() -> str:
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _set_job(job_id: str, job: dict, ttl: int, only_new: bool = False) -> bool:
+    with RedisConnection() as r:
+        return bool(r.set('fasta:job:%s' % job_id, json.dumps(job), ex=ttl, nx=only_new))
+
+
+def _beat() -> None:
+    while True:
+        time.sleep(FASTA_HEARTBEAT_INTERVAL)
+        with _pending_lock:
+            job_ids = list(_pending_jobs)
+        if not job_ids:
+            continue
+        try:
+            with RedisConnection() as r:
+                pipe = r.pipeline(transaction=False)
+                for job_id in job_ids:
+                    pipe.set('fasta:job:%s:heartbeat' % job_id, _job_owner(), ex=FASTA_HEARTBEAT_TTL)
+                pipe.execute()
+        except Exception:
+            logging.exception('Unable to refresh the heartbeats of the FASTA searches.')
+
+
+def _start_heartbeat() -> None:
+    """ Starts the thread which refreshes the heartbeats of this worker's searches, if this process doesn't have one
+    yet. (A forked worker doesn't inherit the thread of the process it was forked from.) """
+
+    global _heartbeat_pid
+
+    with _pending_lock:
+        if _heartbeat_pid == os.getpid():
+            return
+        _pending_jobs.clear()
+        threading.Thread(target=_beat, name='fasta-heartbeat', daemon=True).start()
+        _heartbeat_pid = os.getpid()
+
+
+def get_fasta_job(job_id: str) -> Optional[dict]:
+    """ Returns the state of a FASTA search job: its status (queued, running, complete, or failed), and the results
+    or error. Returns None for an unknown (or expired) job. """
+
+    with RedisConnection() as r:
+        job = r.get('fasta:job:%s' % job_id)
+    return json.loads(job, use_decimal=True) if job else None
+
+
+def _run_job(job_id: str, sequence: str, library: str, e_val: Optional[str]) -> None:
+    try:
+        _set_job(job_id, {'status': 'running'}, FASTA_RUNNING_TTL)
+        _set_job(job_id, {'status': 'complete', 'results': run_fasta(sequence, library, e_val)}, FASTA_RESULT_TTL)
+    except Exception as err:
+        logging.exception('FASTA search %s failed.', job_id)
+        error = err.message if isinstance(err, APIException) else 'The FASTA search failed.'
+        _set_job(job_id, {'status': 'failed', 'error': error}, FASTA_FAILURE_TTL)
+    finally:
+        with _pending_lock:
+            _pending_jobs.discard(job_id)
+        with RedisConnection() as r:
+            r.delete('fasta:job:%s:heartbeat' % job_id)
+        _admission.release()
+
+
+def submit_fasta_job(sequence: str, library: str, e_val: Optional[str] = None) -> str:
+    """ Queues a FASTA search, and returns its job ID. The job ID is derived from the search parameters and the library
+    version, so searches which have already been submitted (by any worker) are not run again - unless the worker
+    running them has died, which is noticed by its heartbeat having expired. """
+
+    version, _, _ = get_fasta_library(library)
+    job_id = hashlib.sha1(json.dumps([sequence.upper(), library, e_val, version]).encode()).hexdigest()
+    heartbeat_key = 'fasta:job:%s:heartbeat' % job_id
+
+    job = get_fasta_job(job_id)
+    if job and job['status'] in ('complete', 'failed'):
+        return job_id
+
+    _start_heartbeat()
+    with RedisConnection() as r:
+        # Whoever holds the heartbeat owns the search, so only one worker can take over a search from a dead one
+        if not r.set(heartbeat_key, _job_owner(), ex=FASTA_HEARTBEAT_TTL, nx=True):
+            return job_id
+        # The search may have finished (and given up its heartbeat) in the meantime
+        job = get_fasta_job(job_id)
+        if job and job['status'] in ('complete', 'failed'):
+            r.delete(heartbeat_key)
+            return job_id
+        if job:
+            logging.warning('Running FASTA search %s again, as the worker it was %s on stopped.', job_id, job['status'])
+
+        if not _admission.acquire(blocking=False):
+            r.delete('fasta:job:%s' % job_id, heartbeat_key)
+            raise ServerException('Too many FASTA searches are in progress. Please try again later.', 503)
+        with _pending_lock:
+            _pending_jobs.add(job_id)
+        _set_job(job_id, {'status': 'queued'}, FASTA_QUEUED_TTL)
+    _executor.submit(_run_job, job_id, sequence, library, e_val)
+    return job_id
@@ -0,0 +1,133 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from typing import List
+
+from bmrbapi.utils.configuration import configuration
+
+# Rotate the log files once they reach this size (or, if log.rotate_when is configured, on that schedule instead)
+LOG_MAX_BYTES = configuration.get('log', {}).get('max_bytes', 128 * 1024 * 1024)
+LOG_BACKUP_COUNT = configuration.get('log', {}).get('backup_count', 20)
+LOG_ROTATE_WHEN = configuration.get('log', {}).get('rotate_when')
+
+# The most records the background writer takes off the queue before writing them out
+LOG_BATCH_SIZE = 1000
+
+
+class _BatchWriteMixin:
+    """ Lets a file handler write a batch of records with one write() and one flush(), rather than one per record. """
+
+    def handle_batch(self, records: List[logging.LogRecord]) -> None:
+        records = [record for record in records if record.levelno >= self.level and self.filter(record)]
+        if not records:
+            return
+
+        try:
+            payload = "".join(self.format(record) + self.terminator for record in records)
+        except Exception:
+            for record in records:
+                self.handleError(record)
+            return
+
+        self.acquire()
+        try:
+            # A batch is small relative to the file, so checking the rollover once per batch is enough
+            if self.shouldRollover(records[0]):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(payload)
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[0])
+        finally:
+            self.release()
+
+
+class BatchedRotatingFileHandler(_BatchWriteMixin, RotatingFileHandler):
+    pass
+
+
+class BatchedTimedRotatingFileHandler(_BatchWriteMixin, TimedRotatingFileHandler):
+    pass
+
+
+def log_file_handler(path: str, formatter: logging.Formatter) -> logging.Handler:
+    """ Returns a handler that writes to the given file, rotated by time if log.rotate_when is configured, and
+    by size otherwise. """
+
+    if LOG_ROTATE_WHEN:
+        handler = BatchedTimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, delay=True)
+    else:
+        handler = BatchedRotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True)
+    handler.setFormatter(formatter)
+    return handler
+
+
+class BatchingQueueListener(QueueListener):
+    """ A QueueListener which takes all of the records waiting on the queue (up to LOG_BATCH_SIZE) at once, and
+    hands them to each handler as a batch. """
+
+    def _monitor(self) -> None:
+        while True:
+            batch = [self.dequeue(True)]
+            while len(batch) < LOG_BATCH_SIZE and batch[-1] is not self._sentinel:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is self._sentinel
+            if stop:
+                batch.pop()
+            if batch:
+                self.handle_batch(batch)
+            if stop:
+                break
+
+    def handle_batch(self, records: List[logging.LogRecord]) -> None:
+        for handler in self.handlers:
+            if hasattr(handler, 'handle_batch'):
+                handler.handle_batch(records)
+            else:
+                for record in records:
+                    if not self.respect_handler_level or record.levelno >= handler.level:
+                        handler.handle(record)
+
+
+class BackgroundLogHandler(QueueHandler):
+    """ Hands records off to a background thread which writes them with the given handlers, so that logging a
+    request only costs a queue put. The message is formatted by the background thread, not the caller.
+
+    The background thread is started on first use in each process, since threads started before uWSGI forks its
+    workers don't exist in the workers. """
+
+    def __init__(self, *handlers: logging.Handler):
+        super().__init__(queue.SimpleQueue())
+        self._handlers = handlers
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start_listener(self) -> None:
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Any records queued in the parent process belong to it
+            self.queue = queue.SimpleQueue()
+            self._listener = BatchingQueueListener(self.queue, *self._handlers, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave the formatting to the handlers on the background thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self._pid != os.getpid():
+            self._start_listener()
+        self.queue.put_nowait(record)
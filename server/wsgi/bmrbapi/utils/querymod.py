@@ -6,8 +6,10 @@ is done; restapi.py mainly just calls the methods here and returns the results.
 """
 import logging
 import os
+import re
 import zlib
-from typing import Union, List, Generator, Tuple, Optional
+from operator import itemgetter
+from typing import Union, List, Generator, Tuple, Optional, Dict
 
 import pynmrstar
 import simplejson as json
@@ -49,6 +51,22 @@ def locate_entry(entry_id: str, r_conn: StrictRedis) -> str:
         return "macromolecules:entry:%s" % entry_id
 
 
+def locate_framecode_index(entry_id: str) -> str:
+    """ Returns the Redis key of the index of the saveframe names of an entry, by category. """
+
+    return "%s:framecodes:%s" % (get_database_from_entry_id(entry_id), entry_id)
+
+
+def get_framecode_index(entry: pynmrstar.Entry) -> Dict[str, str]:
+    """ Returns the saveframe names of an entry by category, in the form stored in the framecode index: a mapping of
+    category to a JSON list of saveframe names. """
+
+    index = {}
+    for saveframe in entry:
+        index.setdefault(saveframe.category, []).append(saveframe.name)
+    return {category: json.dumps(names) for category, names in index.items()}
+
+
 def get_database_from_entry_id(entry_id: str) -> str:
     """ Returns the appropriate database to inspect based on ID."""
 
@@ -154,9 +172,78 @@ def get_category_and_tag(tag_name: str) -> List[str]:
     return sp
 
 
-def select(fetch_list: List[str], table: str, where_dict: dict = None, database: str = "macromolecules",
-           modifiers: List = None, as_dict: bool = True) -> dict:
-    """ Performs a SELECT query constructed from the supplied arguments."""
+# The tags which are commonly searched on, which get expression indexes matching the predicates built by
+#  compile_tag_predicate()
+SEARCHED_TAGS = {'macromolecules': ['Entry.Title', 'Entry.Experimental_method_subtype', 'Entity.Name',
+                                    'Entity_db_link.Accession_code', 'Citation.Title', 'Assembly.Name'],
+                 'metabolomics': ['Entry.Title', 'Chem_comp.Name', 'Chem_comp.Formula', 'Chem_comp.InChI_code']}
+
+# How many rows select() fetches from the server-side cursor at once
+SELECT_BATCH_ROWS = 10000
+
+# Characters which are special in a LIKE pattern
+_LIKE_SPECIAL = re.compile(r'[%_\\]')
+
+
+def tag_search_expression(tag: str, lower: bool, alias: Optional[str] = None) -> str:
+    """ Returns the expression a tag is compared on in a WHERE clause: its value with the (first) newline removed, and
+    lower-cased for case-insensitive searches. The expression indexes are built on exactly this expression. The tag
+    is qualified with the table alias, if one is provided. """
+
+    column = '%s."%s"' % (alias, tag) if alias else '"%s"' % tag
+    if lower:
+        return "regexp_replace(LOWER(%s),'\n','')" % column
+    return "regexp_replace(%s,'\n','')" % column
+
+
+def compile_tag_predicate(tag: str, value: str, lower: bool = False, alias: Optional[str] = None) -> Tuple[str, list]:
+    """ Returns the SQL predicate (and its parameters) which matches a tag against a search value, in which '*' is a
+    wildcard. The predicate is written so that the tag expression indexes can be used:
+
+    * Values without wildcards are compared with '=', which uses the btree index.
+    * Patterns with a fixed prefix ('foo*') use LIKE, which the planner turns into a range scan of the btree index
+      (it is built with text_pattern_ops for this reason).
+    * Any other pattern uses LIKE, which is served by the trigram index.
+
+    As the value was always passed to LIKE, '%' and '_' are also wildcards. """
+
+    if '"' in tag or '%' in tag:
+        raise RequestException("Invalid 'where' parameter.")
+    pattern = value.replace("*", "%")
+    comparand = "LOWER(%s)" if lower else "%s"
+    if _LIKE_SPECIAL.search(pattern):
+        return "%s LIKE %s" % (tag_search_expression(tag, lower, alias), comparand), [pattern]
+    return "%s = %s" % (tag_search_expression(tag, lower, alias), comparand), [pattern]
+
+
+def tag_search_index_statements() -> List[str]:
+    """ Returns the statements which create the expression indexes on the commonly searched tags: a btree index for
+    both exact and case-insensitive searches, and a trigram index for case-insensitive wildcard searches. Tags which
+    don't exist in the database are skipped. """
+
+    statements = []
+    for database, tags in SEARCHED_TAGS.items():
+        for full_tag in tags:
+            table, tag = full_tag.split('.')
+            exact, lower = tag_search_expression(tag, False), tag_search_expression(tag, True)
+            for suffix, definition in [('btree', 'btree (%s text_pattern_ops)' % exact),
+                                       ('lower_btree', 'btree (%s text_pattern_ops)' % lower),
+                                       ('lower_trgm', 'gin (%s gin_trgm_ops)' % lower)]:
+                index_name = ('tag_search_%s_%s_%s' % (table, tag, suffix)).lower()
+                statements.append('''
+DO $$
+BEGIN
+    CREATE INDEX IF NOT EXISTS %s ON %s."%s" USING %s;
+EXCEPTION
+    WHEN undefined_table OR undefined_column OR program_limit_exceeded THEN
+        RAISE NOTICE 'Skipping the index on %s.%s.';
+END $$;''' % (index_name, database, table, definition, database, full_tag))
+    return statements
+
+
+def build_select_query(fetch_list: List[str], table: str, where_dict: dict = None, database: str = "macromolecules",
+                       modifiers: List = None) -> Tuple[str, list]:
+    """ Builds the SELECT query (and its parameters) constructed from the supplied arguments."""
 
     # Turn None parameters into the proper empty type
     if where_dict is None:
@@ -194,11 +281,9 @@ def select(fetch_list: List[str], table: str, where_dict: dict = None, database:
         for key in where_dict:
             if need_and:
                 query += " AND"
-            if "lower" in modifiers:
-                query += " regexp_replace(LOWER(%s),'\n','') LIKE LOWER(%s)"
-            else:
-                query += " regexp_replace(%s,'\n','') LIKE %s"
-            parameters.extend([wrap_it_up(key), where_dict[key].replace("*", "%")])
+            predicate, predicate_parameters = compile_tag_predicate(key, where_dict[key], lower="lower" in modifiers)
+            query += " " + predicate
+            parameters.extend(predicate_parameters)
             need_and = True
 
     # TODO: build ordering in based on dictionary
@@ -210,11 +295,91 @@ def select(fetch_list: List[str], table: str, where_dict: dict = None, database:
 
     query += ';'
 
-    with PostgresConnection() as cur:
+    return query, parameters
+
+
+def build_join_query(queries: List[dict], database: str = "macromolecules", join_type: str = "inner",
+                     limit: Optional[int] = None, offset: int = 0) -> Tuple[str, list]:
+    """ Builds a single SELECT query (and its parameters) which joins the results of several /select queries on the
+    entry ID (the Entry_ID tag, or whichever tag holds the entry ID in that table). Each query is a dictionary with the
+    "select", "from", "where", and "modifiers" keys. The first query's table is joined to each of the others with the
+    join type (inner or left). The columns are named "<table>.<column>". """
+
+    if join_type not in ('inner', 'left'):
+        raise RequestException("Invalid 'join_type' parameter. Please choose from: inner, left")
+
+    columns, joins, where, parameters, where_parameters = [], [], [], [], []
+    first_id_tag = None
+    for position, each_query in enumerate(queries):
+        table, alias = each_query['from'], 't%d' % position
+        # Table and column names are interpolated into the query, where a '%' would be taken as a placeholder
+        if '"' in table or '%' in table:
+            raise RequestException("Invalid 'from' parameter.")
+        id_tag = get_entry_id_tag(table, database)
+        if "count" in each_query['modifiers']:
+            raise RequestException("The count modifier is not supported when joining queries.")
+        for column in each_query['select']:
+            if column == "*" or '"' in column or '%' in column:
+                raise RequestException("Invalid 'select' parameter. The columns to return must be listed when "
+                                       "joining queries.")
+            columns.append('%s."%s" AS "%s.%s"' % (alias, column, table, column))
+
+        predicates, lower = [], "lower" in each_query['modifiers']
+        for key, value in each_query['where'].items():
+            predicate, predicate_parameters = compile_tag_predicate(key, value, lower=lower, alias=alias)
+            predicates.append(predicate)
+            (where_parameters if position == 0 else parameters).extend(predicate_parameters)
+
+        if position == 0:
+            joins.append('%s."%s" AS %s' % (database, table, alias))
+            where, first_id_tag = predicates, id_tag
+        else:
+            # The conditions on the joined tables go in the join so that a left join keeps the unmatched rows
+            joins.append('%s JOIN %s."%s" AS %s ON %s' % (join_type.upper(), database, table, alias, ' AND '.join(
+                ['%s."%s" = t0."%s"' % (alias, id_tag, first_id_tag)] + predicates)))
+
+    query = 'SELECT %s FROM %s' % (', '.join(columns), ' '.join(joins))
+    parameters.extend(where_parameters)
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    if limit is not None:
+        # Order by every column so that the pages are stable
+        query += ' ORDER BY %s LIMIT %%s OFFSET %%s' % ', '.join(str(x + 1) for x in range(len(columns)))
+        parameters.extend([limit, offset])
+
+    return query + ';', parameters
+
+
+def fetch_columns(cur, width: int, first_batch: list = None) -> List[list]:
+    """ Fetches the (remaining) rows from a cursor in batches, and returns them as a list of columns, so the rows never
+    all need to be held at once. Each batch is transposed with itemgetter rather than zip(*batch), which would
+    allocate a tuple per column per batch and set off the garbage collector over and over on large results. """
+
+    columns = [[] for _ in range(width)]
+    getters = [itemgetter(position) for position in range(width)]
+    batch = cur.fetchmany(SELECT_BATCH_ROWS) if first_batch is None else first_batch
+    while batch:
+        for column, getter in zip(columns, getters):
+            column.extend(map(getter, batch))
+        batch = cur.fetchmany(SELECT_BATCH_ROWS)
+    return columns
+
+
+def select(fetch_list: List[str], table: str, where_dict: dict = None, database: str = "macromolecules",
+           modifiers: List = None, as_dict: bool = True) -> dict:
+    """ Performs a SELECT query constructed from the supplied arguments."""
+
+    if modifiers is None:
+        modifiers = []
+    query, parameters = build_select_query(fetch_list, table, where_dict=where_dict, database=database,
+                                           modifiers=modifiers)
+
+    # Use a server-side cursor so that large results are fetched in batches
+    with PostgresConnection(cursor_name='select') as cur:
         # Do the query
         try:
             cur.execute(query, parameters)
-            rows = cur.fetchall()
+            batch = cur.fetchmany(SELECT_BATCH_ROWS)
         except ProgrammingError as error:
             if configuration['debug']:
                 raise error
@@ -224,20 +389,18 @@ def select(fetch_list: List[str], table: str, where_dict: dict = None, database:
         col_names = [desc[0] for desc in cur.description]
 
         if not as_dict:
+            rows = []
+            while batch:
+                rows.extend(batch)
+                batch = cur.fetchmany(SELECT_BATCH_ROWS)
             return {'data': rows, 'columns': [table + "." + x for x in col_names]}
 
         # Turn the results into a dictionary
-        result = {}
-
+        columns = fetch_columns(cur, len(col_names), batch)
         if "count" in modifiers:
-            for pos, search_field in enumerate(fetch_list):
-                result[table + "." + search_field] = rows[0][pos]
+            result = {table + "." + search_field: columns[pos][0] for pos, search_field in enumerate(fetch_list)}
         else:
-            for search_field in col_names:
-                result[table + "." + search_field] = []
-                s_index = col_names.index(search_field)
-                for row in rows:
-                    result[table + "." + search_field].append(row[s_index])
+            result = {table + "." + search_field: column for search_field, column in zip(col_names, columns)}
 
         if configuration['debug']:
             result['debug'] = cur.query
@@ -0,0 +1,362 @@
+""" Matches a list of peaks against the chemical shift lists of the entries.
+
+For metabolomics, each worker keeps an in-memory index of the assigned chemical shifts, loaded from web.chem_shifts
+the first time it is searched and again whenever the entries of that database are reloaded. The macromolecules
+database is too large for that, so the candidate lists are found using the binned shifts in web.shift_fingerprints. """
+
+import math
+import threading
+from decimal import Decimal
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+
+# The atom types which are matched against the queried peaks, in the order of their codes in the index
+ATOM_TYPES = ('C', 'N', 'H')
+
+# Limits the size of the (lists x peaks) arrays used when counting the matched peaks
+MAX_SCORING_CELLS = 2 ** 20
+
+# Allowance for the float64 rounding of the distance between a deposited shift and a queried shift. Deposited
+#  shifts have at most a few decimal places, so any two distances which differ at all differ by far more than this.
+DISTANCE_TOLERANCE = 1e-9
+
+# The width (in ppm) of the fingerprint bins of each atom type
+FINGERPRINT_BIN_WIDTHS = {'C': .2, 'N': .2, 'H': .02}
+# How many candidate lists are fetched and scored at a time
+FINGERPRINT_BATCH_ROWS = 2000
+# The most shift lists returned by a fingerprint search
+FINGERPRINT_MAX_RESULTS = 500
+
+# The candidate lists, along with how many of the peaks they have a shift in a matching bin for. That is never fewer
+#  than the number of peaks the list actually matches, so the candidates are ranked by it.
+FINGERPRINT_SEARCH = '''
+WITH peak_bins AS (SELECT DISTINCT peak, generate_series(first_bin, last_bin) AS bin
+                   FROM unnest(%(peaks)s::int[], %(first_bins)s::int[], %(last_bins)s::int[])
+                            AS bin_range(peak, first_bin, last_bin))
+SELECT entry_id, list_id, c_shifts, n_shifts, h_shifts,
+       (SELECT count(DISTINCT peak_bins.peak)
+        FROM unnest(fp.bins) AS list_bin(bin)
+                 JOIN peak_bins ON peak_bins.bin = list_bin.bin) AS peaks_matched
+FROM web.shift_fingerprints AS fp
+WHERE database = %(database)s
+  AND bins && ARRAY(SELECT bin FROM peak_bins)
+ORDER BY peaks_matched DESC, entry_id, list_id'''
+
+SHIFT_LISTS = '''
+SELECT "Atom_chem_shift.Entry_ID", "Atom_chem_shift.Assigned_chem_shift_list_ID"
+FROM web.chem_shifts
+WHERE database = %(database)s AND "Atom_chem_shift.Assigned_chem_shift_list_ID" IS NOT NULL
+GROUP BY "Atom_chem_shift.Entry_ID", "Atom_chem_shift.Assigned_chem_shift_list_ID"
+ORDER BY "Atom_chem_shift.Entry_ID", "Atom_chem_shift.Assigned_chem_shift_list_ID"'''
+
+# The list index is the position of the list in the results of SHIFT_LISTS
+SHIFT_VALUES = '''
+WITH lists AS (SELECT "Atom_chem_shift.Entry_ID"                    AS entry_id,
+                      "Atom_chem_shift.Assigned_chem_shift_list_ID" AS list_id,
+                      (row_number() OVER (ORDER BY "Atom_chem_shift.Entry_ID",
+                          "Atom_chem_shift.Assigned_chem_shift_list_ID") - 1)::int AS list_index
+               FROM web.chem_shifts
+               WHERE database = %(database)s AND "Atom_chem_shift.Assigned_chem_shift_list_ID" IS NOT NULL
+               GROUP BY "Atom_chem_shift.Entry_ID", "Atom_chem_shift.Assigned_chem_shift_list_ID")
+SELECT shifts.atom_type, array_agg(lists.list_index), array_agg(shifts.val::real)
+FROM (SELECT DISTINCT "Atom_chem_shift.Entry_ID"                    AS entry_id,
+                      "Atom_chem_shift.Assigned_chem_shift_list_ID" AS list_id,
+                      "Atom_chem_shift.Atom_type"                   AS atom_type,
+                      "Atom_chem_shift.Val"                         AS val
+      FROM web.chem_shifts
+      WHERE database = %(database)s AND "Atom_chem_shift.Atom_type" IN ('C', 'N', 'H')
+        AND "Atom_chem_shift.Val" IS NOT NULL) AS shifts
+         JOIN lists ON lists.entry_id = shifts.entry_id AND lists.list_id = shifts.list_id
+GROUP BY shifts.atom_type'''
+
+# The deposited values of the candidate shifts, which are found using their float32 approximations. Each candidate is
+#  looked for in a window (around its approximation) of the shifts of its list and atom type.
+EXACT_SHIFTS = '''
+SELECT DISTINCT cs."Atom_chem_shift.Entry_ID",
+                cs."Atom_chem_shift.Assigned_chem_shift_list_ID"::text,
+                cs."Atom_chem_shift.Atom_type",
+                cs."Atom_chem_shift.Val"
+FROM unnest(%(entry_ids)s::text[], %(list_ids)s::text[], %(atom_types)s::text[], %(lows)s::numeric[],
+            %(highs)s::numeric[]) AS candidate(entry_id, list_id, atom_type, low, high)
+         JOIN web.chem_shifts AS cs
+              ON cs.database = %(database)s
+                  AND cs."Atom_chem_shift.Atom_type" = candidate.atom_type
+                  AND cs."Atom_chem_shift.Val" BETWEEN candidate.low AND candidate.high
+                  AND cs."Atom_chem_shift.Entry_ID" = candidate.entry_id
+                  AND cs."Atom_chem_shift.Assigned_chem_shift_list_ID"::text = candidate.list_id'''
+
+
+def fingerprint_bin(atom_type: str, shift: float) -> int:
+    """ Returns the fingerprint bin of a shift. Must match the bins calculated by the derived_tables reloader. """
+
+    return (ATOM_TYPES.index(atom_type) + 1) * 10000000 + math.floor(shift / FINGERPRINT_BIN_WIDTHS[atom_type])
+
+
+def float32_margin(values: numpy.ndarray) -> numpy.ndarray:
+    """ Returns how far a float32 approximation of each value can be from it (with a factor of two to spare). """
+
+    return 2 * numpy.spacing(numpy.abs(values).astype(numpy.float32)).astype(numpy.float64)
+
+
+def _closest_distance(shifts: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+    """ Returns the distance from each value to the closest of the (sorted) queried shifts. """
+
+    padded_shifts = numpy.concatenate(([-numpy.inf], shifts, [numpy.inf]))
+    position = numpy.searchsorted(shifts, values)
+    return numpy.minimum(numpy.abs(values - padded_shifts[position]), numpy.abs(values - padded_shifts[position + 1]))
+
+
+def deposited_values(database: str, lists: Sequence[Tuple[str, str]], list_indexes: numpy.ndarray,
+                     values: numpy.ndarray, atom_types: numpy.ndarray) -> Tuple[numpy.ndarray, List[Decimal],
+                                                                                numpy.ndarray]:
+    """ Looks up the deposited values of candidate shifts which were found using their float32 approximations. Each
+    candidate is described by the index of its list in lists, its float32 value, and the code of its atom type.
+
+    Returns the list index, deposited value, and atom type code of each distinct deposited shift. """
+
+    if len(values) == 0:
+        return numpy.zeros(0, dtype=numpy.int32), [], numpy.zeros(0, dtype=numpy.int8)
+
+    wide_values = values.astype(numpy.float64)
+    margin = float32_margin(wide_values)
+    with PostgresConnection() as cur:
+        cur.execute(EXACT_SHIFTS, {'database': database,
+                                   'entry_ids': [lists[x][0] for x in list_indexes],
+                                   'list_ids': [lists[x][1] for x in list_indexes],
+                                   'atom_types': [ATOM_TYPES[x] for x in atom_types],
+                                   'lows': (wide_values - margin).tolist(),
+                                   'highs': (wide_values + margin).tolist()})
+        rows = cur.fetchall()
+
+    positions = {lists[x]: x for x in numpy.unique(list_indexes)}
+    return (numpy.array([positions[(row[0], row[1])] for row in rows], dtype=numpy.int32),
+            [row[3] for row in rows],
+            numpy.array([ATOM_TYPES.index(row[2]) for row in rows], dtype=numpy.int8))
+
+
+def score_matches(shifts: numpy.ndarray, thresholds: Dict[str, float], list_indexes: numpy.ndarray,
+                  decimal_values: List[Decimal], atom_types: numpy.ndarray,
+                  lists: Sequence[Tuple[str, str]]) -> List[dict]:
+    """ Scores the shift lists which have a shift near at least one of the (sorted) queried shifts. Each shift is
+    described by the index of its list in lists, its deposited value, and the code of its atom type. (See
+    deposited_values().)
+
+    Returns the results for each list, sorted by the number of queried shifts matched, and then by the combined
+    offset of the matched shifts from the closest queried shifts. """
+
+    if len(decimal_values) == 0:
+        return []
+
+    # Decide whether each shift is really within the threshold of a queried shift using the value as deposited
+    decimal_shifts = [Decimal(str(x)) for x in shifts]
+    decimal_thresholds = [Decimal(str(thresholds[x])) for x in ATOM_TYPES]
+    positions = numpy.searchsorted(shifts, [float(x) for x in decimal_values])
+    within = numpy.array([min(abs(value - decimal_shifts[x])
+                              for x in range(max(position - 1, 0), min(position + 2, len(shifts))))
+                          <= decimal_thresholds[code]
+                          for value, position, code in zip(decimal_values, positions, atom_types)], dtype=bool)
+    if not within.any():
+        return []
+    list_indexes, atom_types = list_indexes[within], atom_types[within]
+    decimal_values = [x for x, keep in zip(decimal_values, within) if keep]
+
+    exact_values = numpy.array([float(x) for x in decimal_values])
+    type_thresholds = numpy.array([thresholds[x] for x in ATOM_TYPES]) + DISTANCE_TOLERANCE
+
+    # The distance from each matched shift to the closest queried shift
+    distance = _closest_distance(shifts, exact_values)
+
+    unique_lists, local_lists = numpy.unique(list_indexes, return_inverse=True)
+    offsets = numpy.bincount(local_lists, weights=distance, minlength=len(unique_lists))
+
+    # Sort the matched shifts by atom type, list, and then value, so that the closest shift of each type in a list to
+    #  each queried shift can be found with a binary search over a key which is increasing across the lists
+    order = numpy.lexsort((exact_values, local_lists, atom_types))
+    groups = atom_types[order].astype(numpy.int64) * len(unique_lists) + local_lists[order]
+    sorted_values = exact_values[order]
+    base = min(sorted_values.min(), shifts.min()) - 1
+    span = max(sorted_values.max(), shifts.max()) - base + 1
+    sorted_keys = groups * span + (sorted_values - base)
+
+    # A queried shift is matched if the closest shift of any atom type in the list is within the threshold of that
+    #  atom type
+    shifts_matched = numpy.zeros(len(unique_lists), dtype=int)
+    chunk_size = max(1, MAX_SCORING_CELLS // len(shifts))
+    for chunk_start in range(0, len(unique_lists), chunk_size):
+        chunk = numpy.arange(chunk_start, min(chunk_start + chunk_size, len(unique_lists)))
+        matched = numpy.zeros((len(chunk), len(shifts)), dtype=bool)
+        for code in range(len(ATOM_TYPES)):
+            chunk_groups = code * len(unique_lists) + chunk
+            group_starts = numpy.searchsorted(groups, chunk_groups, 'left')[:, None]
+            group_ends = numpy.searchsorted(groups, chunk_groups, 'right')[:, None]
+            targets = chunk_groups[:, None] * span + (shifts[None, :] - base)
+            right = numpy.searchsorted(sorted_keys, targets)
+            left = right - 1
+            right_distance = numpy.where(right < group_ends,
+                                         numpy.abs(sorted_values[right.clip(max=len(order) - 1)] - shifts), numpy.inf)
+            left_distance = numpy.where(left >= group_starts,
+                                        numpy.abs(sorted_values[left.clip(min=0)] - shifts), numpy.inf)
+            matched |= numpy.minimum(left_distance, right_distance) <= type_thresholds[code]
+        shifts_matched[chunk] = matched.sum(axis=1)
+
+    # The matched shifts of each list, in order of value
+    list_order = numpy.lexsort((exact_values, local_lists))
+    list_ends = numpy.searchsorted(local_lists[list_order], numpy.arange(len(unique_lists)), 'right')
+
+    results = []
+    for local_list, rows in enumerate(numpy.split(list_order, list_ends[:-1])):
+        entry_id, list_id = lists[unique_lists[local_list]]
+        results.append({'Entry_ID': entry_id, 'Assigned_chem_shift_list_ID': list_id,
+                        'Val': [{'Shift': decimal_values[x], 'Atom_type': ATOM_TYPES[atom_types[x]]} for x in rows],
+                        'Combined_offset': round(float(offsets[local_list]), 3),
+                        'Shifts_matched': int(shifts_matched[local_list])})
+
+    return sorted(results, key=lambda x: (-x['Shifts_matched'], x['Combined_offset'], x['Entry_ID']))
+
+
+class ShiftIndex:
+    """ The assigned chemical shifts of one database. For each atom type, the shifts are stored as a sorted float32
+    array alongside the index of the shift list each one belongs to. """
+
+    def __init__(self, database: str, update_time: Optional[bytes]):
+        self.database: str = database
+        self.update_time: Optional[bytes] = update_time
+        self.lists: List[Tuple[str, str]] = []
+        self.values: Dict[str, numpy.ndarray] = {}
+        self.list_indexes: Dict[str, numpy.ndarray] = {}
+
+        with PostgresConnection() as cur:
+            cur.execute(SHIFT_LISTS, {'database': database})
+            self.lists = [(x[0], str(x[1])) for x in cur.fetchall()]
+
+            cur.execute(SHIFT_VALUES, {'database': database})
+            for atom_type, list_indexes, values in cur:
+                values = numpy.array(values, dtype=numpy.float32)
+                order = numpy.argsort(values, kind='stable')
+                self.values[atom_type] = values[order]
+                self.list_indexes[atom_type] = numpy.array(list_indexes, dtype=numpy.int32)[order]
+
+    def search(self, shifts: List[float], thresholds: Dict[str, float]) -> List[dict]:
+        """ Returns the scored shift lists which contain a shift within the threshold of any of the queried shifts.
+        See score_matches(). """
+
+        shifts = numpy.sort(numpy.array(shifts, dtype=numpy.float64))
+
+        list_indexes, values, atom_types = [], [], []
+        for code, atom_type in enumerate(ATOM_TYPES):
+            if atom_type not in self.values:
+                continue
+            # Widen the window by the rounding of the stored float32 values, score_matches() then drops any shifts
+            #  which are only inside it because of that rounding, using their deposited values
+            low_bounds = shifts - thresholds[atom_type]
+            high_bounds = shifts + thresholds[atom_type]
+            low = numpy.searchsorted(self.values[atom_type], low_bounds - float32_margin(low_bounds), 'left')
+            high = numpy.searchsorted(self.values[atom_type], high_bounds + float32_margin(high_bounds), 'right')
+            positions = numpy.unique(numpy.concatenate([numpy.arange(x, y) for x, y in zip(low, high)]))
+            list_indexes.append(self.list_indexes[atom_type][positions])
+            values.append(self.values[atom_type][positions])
+            atom_types.append(numpy.full(len(positions), code, dtype=numpy.int8))
+
+        if not values:
+            return []
+        return score_matches(shifts, thresholds,
+                             *deposited_values(self.database, self.lists, numpy.concatenate(list_indexes),
+                                               numpy.concatenate(values), numpy.concatenate(atom_types)),
+                             lists=self.lists)
+
+
+def _score_candidates(database: str, shifts: numpy.ndarray, thresholds: Dict[str, float],
+                      candidates: List[tuple]) -> List[dict]:
+    """ Scores a batch of rows of web.shift_fingerprints. See score_matches(). """
+
+    lists, list_indexes, values, atom_types = [], [], [], []
+    for list_index, candidate in enumerate(candidates):
+        lists.append((candidate[0], candidate[1]))
+        # The shift columns are in the same order as ATOM_TYPES
+        for code, type_shifts in enumerate(candidate[2:5]):
+            if type_shifts:
+                list_indexes.extend([list_index] * len(type_shifts))
+                values.extend(type_shifts)
+                atom_types.extend([code] * len(type_shifts))
+    if not values:
+        return []
+    list_indexes = numpy.array(list_indexes, dtype=numpy.int32)
+    values = numpy.array(values, dtype=numpy.float32)
+    atom_types = numpy.array(atom_types, dtype=numpy.int8)
+
+    # Only keep the shifts which could match a queried peak, allowing for the float32 rounding of the values.
+    #  score_matches() then decides using their deposited values.
+    wide_values = values.astype(numpy.float64)
+    type_thresholds = numpy.array([thresholds[x] for x in ATOM_TYPES])
+    matched = _closest_distance(shifts, wide_values) <= type_thresholds[atom_types] + float32_margin(wide_values)
+
+    return score_matches(shifts, thresholds,
+                         *deposited_values(database, lists, list_indexes[matched], values[matched],
+                                           atom_types[matched]),
+                         lists=lists)
+
+
+def search_fingerprints(database: str, shifts: List[float], thresholds: Dict[str, float]) -> Tuple[List[dict], bool]:
+    """ Returns the best FINGERPRINT_MAX_RESULTS of the scored shift lists which contain a shift within the threshold
+    of any of the queried shifts, and whether there may be more matching lists than that. The candidate lists are
+    scored in order of how many peaks they could match, until none of the rest could make the results. See
+    score_matches(). """
+
+    shifts = numpy.sort(numpy.array(shifts, dtype=numpy.float64))
+
+    # The ranges of bins which a shift matching each peak could be in, with a bin of margin on either side. They are
+    #  expanded by the database.
+    peaks, first_bins, last_bins = [], [], []
+    for peak, shift in enumerate(shifts):
+        for atom_type in ATOM_TYPES:
+            peaks.append(peak)
+            first_bins.append(fingerprint_bin(atom_type, shift - thresholds[atom_type]) - 1)
+            last_bins.append(fingerprint_bin(atom_type, shift + thresholds[atom_type]) + 1)
+
+    results = []
+    truncated = False
+    with PostgresConnection(cursor_name='shift_fingerprints') as cur:
+        cur.execute(FINGERPRINT_SEARCH, {'database': database, 'peaks': peaks, 'first_bins': first_bins,
+                                         'last_bins': last_bins})
+        candidates = cur.fetchmany(FINGERPRINT_BATCH_ROWS)
+        while candidates:
+            # The candidates are ranked, so once the results are full, a list with fewer possible matches than the
+            #  last of the results can't displace it
+            if len(results) >= FINGERPRINT_MAX_RESULTS:
+                results.sort(key=lambda x: (-x['Shifts_matched'], x['Combined_offset'], x['Entry_ID']))
+                del results[FINGERPRINT_MAX_RESULTS:]
+                truncated = True
+                if candidates[0][5] < results[-1]['Shifts_matched']:
+                    break
+            results.extend(_score_candidates(database, shifts, thresholds, candidates))
+            candidates = cur.fetchmany(FINGERPRINT_BATCH_ROWS)
+
+    results.sort(key=lambda x: (-x['Shifts_matched'], x['Combined_offset'], x['Entry_ID']))
+    if len(results) > FINGERPRINT_MAX_RESULTS:
+        del results[FINGERPRINT_MAX_RESULTS:]
+        truncated = True
+    return results, truncated
+
+
+_shift_indexes: Dict[str, ShiftIndex] = {}
+_shift_index_lock = threading.Lock()
+
+
+def get_shift_index(database: str) -> ShiftIndex:
+    """ Returns the shift index of a database, loading it if the entries were reloaded since it was last loaded. """
+
+    with RedisConnection() as r:
+        update_time = r.hget('%s:meta' % database, 'update_time')
+
+    shift_index = _shift_indexes.get(database)
+    if shift_index is None or shift_index.update_time != update_time:
+        with _shift_index_lock:
+            shift_index = _shift_indexes.get(database)
+            if shift_index is None or shift_index.update_time != update_time:
+                shift_index = ShiftIndex(database, update_time)
+                _shift_indexes[database] = shift_index
+
+    return shift_index
@@ -0,0 +1,170 @@
+import base64
+import binascii
+import csv
+import io
+from typing import Iterable, Iterator, Optional, Sequence
+
+import simplejson as json
+from flask import Response
+
+from bmrbapi.exceptions import RequestException
+from bmrbapi.utils.columnar import COLUMNAR_FORMATS, encode_columnar
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection
+
+# How many rows to fetch from the server-side cursor (and send to the client) at once
+STREAM_BATCH_ROWS = 2000
+
+STREAM_FORMATS = {'json': 'application/json',
+                  'ndjson': 'application/x-ndjson',
+                  'csv': 'text/csv',
+                  **COLUMNAR_FORMATS}
+
+
+def encode_cursor(key: Sequence) -> str:
+    """ Turns the sort key of the last row of a page into an opaque pagination cursor. """
+
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decode_cursor(cursor: str, key_types: Sequence[type]) -> list:
+    """ Returns the sort key stored in a pagination cursor. Each element of the key must be either None or of the
+    type (str, int, or float) of the corresponding key column. """
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise RequestException('Invalid pagination cursor.')
+    if not isinstance(key, list) or len(key) != len(key_types):
+        raise RequestException('Invalid pagination cursor.')
+    for value, key_type in zip(key, key_types):
+        if value is None:
+            continue
+        # JSON doesn't distinguish a float with an integral value from an integer, and bool is a subclass of int
+        allowed_types = (int, float) if key_type is float else key_type
+        if isinstance(value, bool) or not isinstance(value, allowed_types):
+            raise RequestException('Invalid pagination cursor.')
+    return key
+
+
+def _encode_batches(description: Sequence, batches: Iterable[list], output_format: str,
+                    dictionary_result: bool = False, extra: Optional[dict] = None) -> Iterator:
+    """ Returns an iterator over the rows in the requested format, one chunk per batch. Rows may be either lists or
+    dictionaries.
+
+    Any extra keys are appended to the JSON object. (They are not sent in the other formats, or when the JSON result
+    is a list of dictionaries.)"""
+
+    if output_format in COLUMNAR_FORMATS:
+        return encode_columnar(description, batches, output_format)
+    return _encode_text(description, batches, output_format, dictionary_result, extra)
+
+
+def _encode_text(description: Sequence, batches: Iterable[list], output_format: str, dictionary_result: bool,
+                 extra: Optional[dict]) -> Iterator[str]:
+    """ Yields the rows as JSON, NDJSON, or CSV. """
+
+    columns = [desc[0] for desc in description]
+    if output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(row.values() if isinstance(row, dict) else row for row in batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    elif output_format == 'ndjson':
+        for batch in batches:
+            yield ''.join(json.dumps(row if isinstance(row, dict) else dict(zip(columns, row))) + '\n'
+                          for row in batch)
+
+    else:
+        yield '[' if dictionary_result else '{"columns": %s, "data": [' % json.dumps(columns)
+        first = True
+        for batch in batches:
+            if not batch:
+                continue
+            if not first:
+                yield ','
+            first = False
+            yield ','.join(json.dumps(row) for row in batch)
+
+        if dictionary_result:
+            yield ']'
+        else:
+            yield ']%s}' % ''.join(', %s: %s' % (json.dumps(key), json.dumps(value))
+                                   for key, value in (extra or {}).items())
+
+
+def stream_query(sql: str, args: list, output_format: str = 'json', dictionary_result: bool = False,
+                 column_prefix: str = '') -> Response:
+    """ Runs a query on a server-side cursor, and streams the results to the client as they are fetched, so the
+    memory used by the worker does not depend on the size of the result. The column names may be given a prefix.
+
+    The query is executed, and the first batch fetched, before the response is started so that errors are still
+    reported to the client as a normal error response. """
+
+    def fetch_batches() -> Iterator:
+        with PostgresConnection(real_dict_cursor=dictionary_result, cursor_name='stream_query') as cur:
+            cur.execute(sql, args)
+            batch = cur.fetchmany(STREAM_BATCH_ROWS)
+            # The description of a named cursor is only available after the first fetch
+            yield cur.description, cur.query
+            while batch:
+                yield batch
+                batch = cur.fetchmany(STREAM_BATCH_ROWS)
+
+    batches = fetch_batches()
+    description, query = next(batches)
+    if column_prefix:
+        description = [(column_prefix + desc[0],) + tuple(desc[1:]) for desc in description]
+    extra = {'debug': query} if configuration['debug'] else None
+    chunks = _encode_batches(description, batches, output_format, dictionary_result, extra)
+
+    def generate() -> Iterator:
+        try:
+            yield from chunks
+        finally:
+            # Close the connection right away if the client goes away mid-stream
+            batches.close()
+
+    return Response(generate(), mimetype=STREAM_FORMATS[output_format])
+
+
+def paginated_query(sql: str, args: list, key_columns: Sequence[str], limit: int, output_format: str = 'json',
+                    dictionary_result: bool = False, hidden_columns: int = 0) -> Response:
+    """ Runs a query which returns one page of (at most limit) results, ordered by the key columns. If the page is
+    full, a cursor to fetch the next page is returned in the X-Next-Cursor header (and in the JSON body).
+
+    The given number of trailing columns are only used to build the cursor, and are not returned. """
+
+    with PostgresConnection(real_dict_cursor=dictionary_result) as cur:
+        cur.execute(sql, args)
+        rows = cur.fetchall()
+        description = cur.description
+        query = cur.query
+
+    extra = {'debug': query} if configuration['debug'] else {}
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor([rows[-1][column] for column in key_columns])
+        extra['next_cursor'] = next_cursor
+
+    if hidden_columns:
+        hidden = [desc[0] for desc in description[-hidden_columns:]]
+        description = description[:-hidden_columns]
+        if dictionary_result:
+            for row in rows:
+                for column in hidden:
+                    del row[column]
+        else:
+            rows = [row[:-hidden_columns] for row in rows]
+
+    response = Response(_encode_batches(description, [rows], output_format, dictionary_result, extra),
+                        mimetype=STREAM_FORMATS[output_format])
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
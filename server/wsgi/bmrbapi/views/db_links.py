@@ -1,43 +1,59 @@
+import gzip
+from typing import Dict
+
 from flask import Blueprint, Response, request, jsonify
 
-import bmrbapi.views.sql.db_links as sql_statements
 from bmrbapi.exceptions import RequestException
+from bmrbapi.utils.columnar import COLUMNAR_FORMATS
 from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.bulk_mappings import HUPO_PSI_ID_EXPORT, MAPPING_MIMETYPES, MAPPING_STATEMENTS, \
+    get_stored_mapping, iter_hupo_psi_id, render_mapping
+from bmrbapi.utils.streaming import stream_query
 
 # Set up the blueprint
 db_endpoints = Blueprint('db_links', __name__)
 
 
+def _stored_mapping_response(stored: Dict[bytes, bytes], format_: str) -> Response:
+    """ Builds the response for a pre-rendered mapping, using the best compression the client accepts. """
+
+    if request.accept_encodings['br']:
+        encoding, body = 'br', stored[b'br']
+    elif request.accept_encodings['gzip']:
+        encoding, body = 'gzip', stored[b'gzip']
+    else:
+        encoding, body = None, gzip.decompress(stored[b'gzip'])
+
+    response = Response(body, mimetype=MAPPING_MIMETYPES[format_])
+    response.vary.add('Accept-Encoding')
+    # Each encoding is a different representation, so it gets its own ETag
+    response.set_etag('%s-%s' % (stored[b'etag'].decode(), encoding or 'identity'))
+    if encoding:
+        response.content_encoding = encoding
+    return response.make_conditional(request)
+
+
 def mapping_helper(direction: str):
-    """ Performs the SQL queries needed to do BMRB -> UniProt mapping. """
+    """ Performs the SQL queries needed to do BMRB -> UniProt mapping. The JSON and text mappings are normally served
+    as rendered by the mappings reloader; they are only queried here if they haven't been rendered. """
 
     if "pdb" in direction:
         match_type = request.args.get('match_type', 'exact')
     else:
         match_type = request.args.get('match_type', 'all')
-    if match_type == 'all':
-        match_type = '%'
 
     format_ = "text" if direction == "uniprot_uniprot" else request.args.get('format', 'json')
 
-    statements = {'uniprot_bmrb': {'text': sql_statements.uniprot_bmrb_map_text,
-                                   'json': sql_statements.uniprot_bmrb_map_json},
-                  'bmrb_uniprot': {'text': sql_statements.bmrb_uniprot_map_text,
-                                   'json': sql_statements.bmrb_uniprot_map_json},
-                  'pdb_bmrb': {'text': sql_statements.pdb_bmrb_map_text,
-                               'json': sql_statements.pdb_bmrb_map_json},
-                  'bmrb_pdb': {'text': sql_statements.bmrb_pdb_map_text,
-                               'json': sql_statements.bmrb_pdb_map_json},
-                  'uniprot_uniprot': {'text': sql_statements.uniprot_uniprot_map}
-                  }
+    if format_ in COLUMNAR_FORMATS:
+        return stream_query(MAPPING_STATEMENTS[direction]['json'], ['%' if match_type == 'all' else match_type],
+                            output_format=format_)
+
+    stored = get_stored_mapping(direction, format_, match_type)
+    if stored:
+        return _stored_mapping_response(stored, format_)
 
     with PostgresConnection(real_dict_cursor=True) as cur:
-        if format_ == "text":
-            cur.execute(statements[direction][format_], [match_type])
-            return Response("\n".join([x['string'] for x in cur.fetchall()]), mimetype='text/plain')
-        elif format_ == 'json':
-            cur.execute(statements[direction][format_], [match_type])
-            return jsonify(cur.fetchall())
+        return Response(render_mapping(cur, direction, format_, match_type), mimetype=MAPPING_MIMETYPES[format_])
 
 
 @db_endpoints.route('/mappings/uniprot/uniprot')
@@ -93,16 +109,35 @@ def uniprot(accession_id=None):
     if response_format not in ['json', 'hupo-psi-id']:
         raise RequestException("Invalid format type. Allowed options: 'json', 'hupo-psi-id'.")
 
-    with PostgresConnection(real_dict_cursor=(response_format == 'json')) as cur:
+    if response_format == 'hupo-psi-id':
+        # The documents are rendered by the UniProt reloader, and the full export by the mappings reloader
+        if accession_id:
+            with PostgresConnection() as cur:
+                cur.execute('SELECT document FROM web.hupo_psi_id_documents WHERE uniprot_id = %s', [accession_id])
+                result = cur.fetchone()
+            if result:
+                return Response(result[0], mimetype='application/json')
+            return jsonify([])
+
+        stored = get_stored_mapping(*HUPO_PSI_ID_EXPORT)
+        if stored:
+            return _stored_mapping_response(stored, response_format)
+
+        def generate():
+            with PostgresConnection(cursor_name='hupo_psi_id') as cur:
+                yield from iter_hupo_psi_id(cur)
+
+        return Response(generate(), mimetype='application/json')
+
+    with PostgresConnection(real_dict_cursor=True) as cur:
 
         # Deal with the optional condition
-        where, sql, terms = '', '', []
+        where, terms = '', []
         if accession_id:
             terms = [accession_id]
             where = ' WHERE uni.uniprot_id = %s'
 
-        if response_format == 'json':
-            sql = '''
+        sql = '''
 SELECT bmrb_id    AS "Entry_ID",
        entity_id  AS "Entity_ID",
        CASE
@@ -113,39 +148,5 @@ SELECT bmrb_id    AS "Entry_ID",
        uniprot_id AS "Accession_code"
 FROM web.uniprot_mappings AS uni''' + where
 
-        elif response_format == 'hupo-psi-id':
-            if accession_id:
-                sql = '''
-SELECT json_build_object('proteinIdentifier', 'uniprot:' || uniprot_id, 'proteinRegions',
-                         array_agg(json_build_object('source', source,
-                                                     'regionSequenceExperimental', "regionSequenceExperimental",
-                                                     'experimentType', "experimentType",
-                                                     'experimentReference', "experimentReference",
-                                                     'lastModified', "lastModified")))
-FROM web.hupo_psi_id
-WHERE uniprot_id = %s
-GROUP BY uniprot_id;
-    '''
-            else:
-                sql = '''
-SELECT json_build_object('proteinIdentifier', 'uniprot:' || uniprot_id, 'proteinRegions',
-                         array_agg(json_build_object('source', source,
-                                                     'regionSequenceExperimental', "regionSequenceExperimental",
-                                                     'experimentType', "experimentType",
-                                                     'experimentReference', "experimentReference",
-                                                     'lastModified', "lastModified")))
-FROM web.hupo_psi_id
-GROUP BY uniprot_id;
-    '''
-
         cur.execute(sql, terms)
-        if response_format == 'json':
-            return jsonify(cur.fetchall())
-        elif response_format == 'hupo-psi-id':
-            if accession_id:
-                result = cur.fetchall()
-                if len(result) >= 1:
-                    return jsonify(result[0][0])
-                else:
-                    return jsonify([])
-            return jsonify([x[0] for x in cur.fetchall()])
+        return jsonify(cur.fetchall())
@@ -276,6 +276,27 @@ WHERE "Software"."Entry_ID" = %s''', [entry_id])
         return jsonify({"columns": column_names, "data": results})
 
 
+@entry_endpoints.route('/entry/<entry_id>/timedomain')
+def get_timedomain_files(entry_id):
+    """ Returns the time domain files available for an entry, and their sizes. """
+
+    with PostgresConnection() as cur:
+        cur.execute('''
+SELECT path, size
+FROM web.timedomain_files
+WHERE bmrbid = %s
+ORDER BY path''', [entry_id])
+
+        column_names = [desc[0] for desc in cur.description]
+        results = cur.fetchall()
+
+        # If no results, make sure the entry exists
+        if len(results) == 0:
+            check_valid(entry_id)
+
+        return jsonify({"columns": column_names, "data": results})
+
+
 @entry_endpoints.route('/entry/<entry_id>/experiments')
 def get_experiment_data(entry_id):
     """ Return the experiments available for an entry. """
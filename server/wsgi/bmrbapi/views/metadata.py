@@ -1,87 +1,73 @@
 import datetime
-from typing import List, Tuple
 
 from flask import Blueprint, jsonify, Response
-from psycopg2.extras import DictCursor
 
+import bmrbapi.views.sql.metadata as sql_statements
+from bmrbapi.utils.cache import refreshed_json
 from bmrbapi.utils.connections import PostgresConnection
-from bmrbapi.views.sql.metadata import *
 
 # Set up the blueprint
 meta_endpoints = Blueprint('metadata', __name__)
 
+# The statistics change at most daily, so they are recalculated (in the background) once they are an hour old
+RELEASE_STATISTICS_REFRESH = 3600
+RELEASE_STATISTICS_TTL = 7 * 86400
+
+
+def _calculate_release_statistics() -> dict:
+    """ Calculates the statistics about released entries from ETS. """
+
+    with PostgresConnection(ets=True, real_dict_cursor=True) as cur:
+        cur.execute(sql_statements.release_statistics, [])
+        by_year = {int(row['year']): row for row in cur.fetchall()}
+
+    results = {}
+
+    # Use this do to the calculations
+    total_released_by_year = 0
+    original_released_by_year = 0
+    structure_released_by_year = 0
+    nonstructure_released_by_year = 0
+
+    for year in range(1995, datetime.datetime.now().year + 1):
+        # Missing years, and the counts missing from a year, are zero
+        counts = {key: value or 0 for key, value in by_year.get(year, {}).items()}
+
+        total_released_by_year += counts.get('released_in_year', 0)
+        original_released_by_year += counts.get('original_release_in_year', 0)
+
+        structure_released_by_year += counts.get('structure_total', 0)
+        nonstructure_released_by_year += counts.get('nonstructure_total', 0)
+
+        results[year] = {
+            'total_released_by_year': total_released_by_year,
+            'original_released_by_year': original_released_by_year,
+            'structure_released_by_year': structure_released_by_year,
+            'nonstructure_released_by_year': nonstructure_released_by_year,
+            'released_in_year': counts.get('released_in_year', 0),
+            'withdrawn_or_obsoleted_during_year': counts.get('withdrawn_or_obsoleted_during_year', 0),
+            'withdrawn_or_obsoleted_from_year': counts.get('withdrawn_or_obsoleted_from_year', 0),
+            'original_release_in_year': counts.get('original_release_in_year', 0),
+            'structure_release_in_year': {
+                'total': counts.get('structure_total', 0),
+                'adit-nmr': counts.get('structure_aditnmr', 0),
+                'onedep': counts.get('structure_onedep', 0),
+                'bmrbdep': counts.get('structure_bmrbdep', 0)
+            },
+            'nonstructure_release_in_year': {
+                'total': counts.get('nonstructure_total', 0),
+                'adit-nmr': counts.get('nonstructure_aditnmr', 0),
+                'onedep': counts.get('nonstructure_onedep', 0),
+                'bmrbdep': counts.get('nonstructure_bmrbdep', 0)
+            },
+        }
+
+    return {'release_information': results}
+
 
 @meta_endpoints.route('/meta/release_statistics')
 def get_release_statistics() -> Response:
     """ Returns statistics about released entries. """
 
-    results = {}
-
-    def get_query_results(cursor: DictCursor, query: str) -> List[Tuple[int, int]]:
-        cursor.execute(query, [])
-        return cursor.fetchall()
-
-    with PostgresConnection(ets=True) as cur:
-
-        years_to_show = range(1995, datetime.datetime.now().year + 1)
-
-        # Do the queries
-        total_released_in_year = get_query_results(cur, released_in_year)
-        original_released_in_year = get_query_results(cur, original_release_in_year)
-        removed_in_year = get_query_results(cur, withdrawn_entries_in_year)
-        removed_from_year = get_query_results(cur, entries_released_this_year_since_withdrawn)
-
-        structure_total_released_in_year = get_query_results(cur, structure_total_in_year)
-        structure_adit_nmr_released_in_year = get_query_results(cur, structure_aditnmr_in_year)
-        structure_onedep_released_in_year = get_query_results(cur, structure_onedep_in_year)
-        structure_bmrbdep_released_in_year = get_query_results(cur, structure_bmrbdep_in_year)
-
-        nonstructure_total_released_in_year = get_query_results(cur, nonstructure_total_in_year)
-        nonstructure_adit_nmr_released_in_year = get_query_results(cur, nonstructure_aditnmr_in_year)
-        nonstructure_onedep_released_in_year = get_query_results(cur, nonstructure_onedep_in_year)
-        nonstructure_bmrbdep_released_in_year = get_query_results(cur, nonstructure_bmrbdep_in_year)
-
-        def lookup_year(res, search_year: int):
-            """ Returns the number of entries for a year from a list. """
-            for row in res:
-                if row[0] == search_year:
-                    return row[1]
-            return 0
-
-        # Use this do to the calculations
-        total_released_by_year = 0
-        original_released_by_year = 0
-        structure_released_by_year = 0
-        nonstructure_released_by_year = 0
-
-        for year in years_to_show:
-            total_released_by_year += lookup_year(total_released_in_year, year)
-            original_released_by_year += lookup_year(original_released_in_year, year)
-
-            structure_released_by_year += lookup_year(structure_total_released_in_year, year)
-            nonstructure_released_by_year += lookup_year(nonstructure_total_released_in_year, year)
-
-            results[year] = {
-                'total_released_by_year': total_released_by_year,
-                'original_released_by_year': original_released_by_year,
-                'structure_released_by_year': structure_released_by_year,
-                'nonstructure_released_by_year': nonstructure_released_by_year,
-                'released_in_year': lookup_year(total_released_in_year, year),
-                'withdrawn_or_obsoleted_during_year': lookup_year(removed_in_year, year),
-                'withdrawn_or_obsoleted_from_year': lookup_year(removed_from_year, year),
-                'original_release_in_year': lookup_year(original_released_in_year, year),
-                'structure_release_in_year': {
-                    'total': lookup_year(structure_total_released_in_year, year),
-                    'adit-nmr': lookup_year(structure_adit_nmr_released_in_year, year),
-                    'onedep': lookup_year(structure_onedep_released_in_year, year),
-                    'bmrbdep': lookup_year(structure_bmrbdep_released_in_year, year)
-                },
-                'nonstructure_release_in_year': {
-                    'total': lookup_year(nonstructure_total_released_in_year, year),
-                    'adit-nmr': lookup_year(nonstructure_adit_nmr_released_in_year, year),
-                    'onedep': lookup_year(nonstructure_onedep_released_in_year, year),
-                    'bmrbdep': lookup_year(nonstructure_bmrbdep_released_in_year, year)
-                },
-            }
-
-    return jsonify({'release_information': results})
+    return jsonify(refreshed_json('meta:release_statistics', _calculate_release_statistics,
+                                  RELEASE_STATISTICS_REFRESH, RELEASE_STATISTICS_TTL))
@@ -1,5 +1,6 @@
 from flask import jsonify, request, Blueprint
 
+from bmrbapi.exceptions import RequestException
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection
 
@@ -33,11 +34,13 @@ def get_molprobity_data(pdb_id, residues=None):
         if not residues:
             sql = '''SELECT * FROM molprobity.residue WHERE pdb = lower(%s);'''
         else:
-            sql = '''SELECT * FROM molprobity.residue WHERE pdb = lower(%s) AND ('''
-            for item in residues:
-                sql += " pdb_residue_no = %s OR "
-                terms.append(item)
-            sql += " 1=2) ORDER BY model, pdb_residue_no"
+            try:
+                residues = [int(x) for x in residues]
+            except ValueError:
+                raise RequestException('Residue numbers must be integers.')
+            sql = '''SELECT * FROM molprobity.residue WHERE pdb = lower(%s) AND pdb_residue_no = ANY(%s)
+ORDER BY model, pdb_residue_no'''
+            terms.append(residues)
 
     with PostgresConnection() as cur:
         cur.execute(sql, terms)
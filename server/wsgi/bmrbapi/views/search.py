@@ -1,67 +1,100 @@
-import os
+import hashlib
+import logging
+import math
+import re
 import shlex
-import subprocess
-import textwrap
 import warnings
-from decimal import Decimal
-from tempfile import NamedTemporaryFile
-from typing import List, Dict, Iterable, Set
+from functools import partial
+from typing import List, Dict, Iterable, Iterator, Optional, Set, Tuple
 from urllib.parse import quote
 
 import psycopg2
-from flask import jsonify, request, Blueprint, url_for
+import redis
+import simplejson as json
+from flask import jsonify, request, Blueprint, Response, url_for
 from psycopg2 import ProgrammingError
 
 import bmrbapi.views.sql.search as sql_statements
 from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.utils.cache import cached_json, cached_stream
+from bmrbapi.utils.columnar import COLUMNAR_FORMATS
 from bmrbapi.utils.configuration import configuration
-from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
 from bmrbapi.utils.decorators import require_content_type_json
-from bmrbapi.utils.querymod import SUBMODULE_DIR, get_db, get_entry_id_tag, select as qselect, \
+from bmrbapi.utils.fasta import FASTA_POLYMER_TYPES, get_fasta_job, submit_fasta_job
+from bmrbapi.utils.querymod import get_db, get_entry_id_tag, select as qselect, \
     get_database_from_entry_id, get_valid_entries_from_redis, \
-    get_category_and_tag, wrap_it_up, select as querymod_select
+    get_category_and_tag, select as querymod_select, build_select_query, build_join_query, \
+    locate_entry, locate_framecode_index, get_framecode_index
+from bmrbapi.utils.shift_search import get_shift_index, search_fingerprints
+from bmrbapi.utils.streaming import STREAM_BATCH_ROWS, STREAM_FORMATS, decode_cursor, paginated_query, stream_query
 
 # Set up the blueprint
 search_endpoints = Blueprint('search', __name__)
 
+# How long to cache instant search results for, in seconds
+INSTANT_CACHE_TTL = 300
+# How long to cache the values of a tag for, in seconds. (They are also invalidated when the database is reloaded.)
+ALL_VALUES_CACHE_TTL = 86400
 
-def get_extra_data_available(bmrb_id):
-    """ Returns any additional data associated with the entry. For example:
+# The link types of web.pdb_bmrb_links, and how they are reported
+PDB_LINK_TYPES = {'exact': 'Exact', 'author': 'Author Provided', 'blast': 'BLAST Match'}
 
-    Time domain, residual dipolar couplings, pKa values, etc."""
 
-    # Set up the DB cursor
-    with PostgresConnection(schema=get_database_from_entry_id(bmrb_id)) as cur:
+def _get_framecode_indexes(bmrb_ids: List[str]) -> Dict[str, Dict[str, List[str]]]:
+    """ Returns the saveframe names of each entry by category. Entries which are not available in Redis are omitted. """
 
-        query = '''
-SELECT "Entry_ID" as entry_id, ed."Type" as type, dic.catgrpviewname as description, "Count"::integer as sets,
-       0 as size from "Data_set" as ed
-  LEFT JOIN dict.aditcatgrp as dic ON ed."Type" = dic.sfcategory
- WHERE ed."Entry_ID" like %s
-UNION
-SELECT bmrbid, 'time_domain_data', 'Time domain data', sets, size FROM web.timedomain_data where bmrbid like %s;'''
-        cur.execute(query, [bmrb_id, bmrb_id])
+    with RedisConnection() as r:
+        pipe = r.pipeline(transaction=False)
+        for bmrb_id in bmrb_ids:
+            pipe.hgetall(locate_framecode_index(bmrb_id))
+            pipe.exists(locate_entry(bmrb_id, r))
+        results = pipe.execute()
+        # An index is only trusted if its entry is still there
+        present = [bmrb_id for bmrb_id, exists in zip(bmrb_ids, results[1::2]) if exists]
+        indexes = {bmrb_id: index if exists else {}
+                   for bmrb_id, index, exists in zip(bmrb_ids, results[::2], results[1::2])}
 
-        try:
-            entry = next(get_valid_entries_from_redis(bmrb_id))[1]
-        # This happens when an entry is valid but isn't available in Redis - for example, when we only have
-        #  2.0 records for an entry.
-        except StopIteration:
-            return None
+        # Entries loaded before the framecode index existed need to be parsed
+        missing = [x for x in present if not indexes[x]]
+        for bmrb_id, entry in get_valid_entries_from_redis(missing):
+            indexes[bmrb_id] = get_framecode_index(entry)
+
+    return {bmrb_id: {(k.decode() if isinstance(k, bytes) else k): json.loads(v) for k, v in index.items()}
+            for bmrb_id, index in indexes.items() if index}
+
+
+def get_extra_data_available(bmrb_ids: List[str]) -> Dict[str, list]:
+    """ Returns any additional data associated with each of the entries. For example:
+
+    Time domain, residual dipolar couplings, pKa values, etc.
+
+    Entries which are not available in Redis (for example, when we only have 2.0 records for an entry) are omitted."""
 
-        extra_data = []
-        for row in cur.fetchall():
-            if row['type'] == 'time_domain_data':
-                extra_data.append({'data_type': row['description'], 'data_sets': row['sets'], 'size': row['size'],
-                                   'thumbnail_url': url_for('static', filename='fid.svg', _external=True),
-                                   'urls': ['https://bmrb.io/ftp/pub/bmrb/timedomain/bmr%s/' % bmrb_id]})
-            else:
-                saveframe_names = [x.name for x in entry.get_saveframes_by_category(row['type'])]
-                url = 'https://bmrb.io/data_library/summary/showGeneralSF.php?accNum=%s&Sf_framecode=%s'
+    framecodes = _get_framecode_indexes(bmrb_ids)
+    extra_data = {bmrb_id: [] for bmrb_id in framecodes}
 
-                extra_data.append({'data_type': row['description'], 'data_sets': row['sets'],
-                                   'data_sfcategory': row['type'],
-                                   'urls': [url % (bmrb_id, quote(x)) for x in saveframe_names]})
+    ids_by_database = {}
+    for bmrb_id in framecodes:
+        ids_by_database.setdefault(get_database_from_entry_id(bmrb_id), []).append(bmrb_id)
+
+    url = 'https://bmrb.io/data_library/summary/showGeneralSF.php?accNum=%s&Sf_framecode=%s'
+    with PostgresConnection() as cur:
+        for database, database_ids in ids_by_database.items():
+            cur.execute(sql_statements.extra_data_available.format(database=database), [database_ids, database_ids])
+
+            for row in cur.fetchall():
+                bmrb_id = row['entry_id']
+                if row['type'] == 'time_domain_data':
+                    extra_data[bmrb_id].append({'data_type': row['description'], 'data_sets': row['sets'],
+                                                'size': row['size'],
+                                                'thumbnail_url': url_for('static', filename='fid.svg', _external=True),
+                                                'urls': ['https://bmrb.io/ftp/pub/bmrb/timedomain/bmr%s/' % bmrb_id]})
+                else:
+                    saveframe_names = framecodes[bmrb_id].get(row['type'], [])
+                    extra_data[bmrb_id].append({'data_type': row['description'], 'data_sets': row['sets'],
+                                                'data_sfcategory': row['type'],
+                                                'urls': [url % (bmrb_id, quote(x)) for x in saveframe_names]})
 
     return extra_data
 
@@ -70,35 +103,11 @@ def get_bmrb_ids_from_pdb_id(pdb_id: str) -> List[Dict[str, str]]:
     """ Returns the associated BMRB IDs for a PDB ID. """
 
     with PostgresConnection() as cur:
-        query = '''
-        SELECT bmrb_id, array_agg(link_type) from 
-    (SELECT bmrb_id, 'Exact' AS link_type, null AS comment
-      FROM web.pdb_link
-      WHERE pdb_id LIKE UPPER(%s)
-    UNION
-    SELECT "Entry_ID", 'Author Provided', "Relationship"
-      FROM macromolecules."Related_entries"
-      WHERE "Database_accession_code" LIKE UPPER(%s) AND "Database_name" = 'PDB'
-        AND "Relationship" != 'BMRB Entry Tracking System' AND "Relationship" != 'BMRB Tracking System'
-    UNION
-    SELECT "Entry_ID", 'Author Provided', "Entry_details"
-      FROM macromolecules."Entity_db_link"
-      WHERE "Accession_code" LIKE UPPER(%s) AND "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
-    UNION
-    SELECT "Entry_ID", 'Author Provided', "Entry_details"
-      FROM macromolecules."Assembly_db_link"
-      WHERE "Accession_code" LIKE UPPER(%s) AND "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
-    UNION
-    SELECT "Entry_ID", 'BLAST Match', "Entry_details"
-      FROM macromolecules."Entity_db_link"
-      WHERE "Accession_code" LIKE UPPER(%s) AND "Database_code" = 'PDB' AND "Author_supplied" != 'yes') AS sub
-    GROUP BY bmrb_id;'''
-
-        cur.execute(query, [pdb_id, pdb_id, pdb_id, pdb_id, pdb_id])
+        cur.execute(sql_statements.bmrb_ids_from_pdb_id, [pdb_id])
 
         result = []
         for x in cur.fetchall():
-            result.append({"bmrb_id": x[0], "match_types": x[1]})
+            result.append({"bmrb_id": x[0], "match_types": [PDB_LINK_TYPES[y] for y in x[1]]})
 
         return result
 
@@ -107,13 +116,15 @@ def get_bmrb_ids_from_pdb_id(pdb_id: str) -> List[Dict[str, str]]:
 def get_bmrb_data_from_pdb_id(pdb_id):
     """ Returns the associated BMRB data for a PDB ID. """
 
+    bmrb_ids = get_bmrb_ids_from_pdb_id(pdb_id)
+    extra_data = get_extra_data_available([x['bmrb_id'] for x in bmrb_ids])
+
     result = []
-    for item in get_bmrb_ids_from_pdb_id(pdb_id):
-        data = get_extra_data_available(item['bmrb_id'])
-        if data is not None:
+    for item in bmrb_ids:
+        if item['bmrb_id'] in extra_data:
             result.append({'bmrb_id': item['bmrb_id'], 'match_types': item['match_types'],
                            'url': 'https://bmrb.io/data_library/summary/index.php?bmrbId=%s' % item['bmrb_id'],
-                           'data': data})
+                           'data': extra_data[item['bmrb_id']]})
 
     return jsonify(result)
 
@@ -133,124 +144,57 @@ def multiple_shift_search():
                   'H': float(request.args.get('hthresh', .01))}
 
     solvent = request.args.get('solvent', 'any').lower()
+    database = get_db("metabolomics", valid_list=['metabolomics', 'macromolecules'])
 
     if not shift_strings:
         raise RequestException("You must specify at least one shift to search for.")
 
-    terms = []
-    sql = '''
-SELECT *
-FROM (SELECT atom_shift."Entry_ID",
-             atom_shift."Assigned_chem_shift_list_ID"::text,
-             array_agg(DISTINCT atom_shift."Val" || ',' || atom_shift."Atom_type") AS shift_pair,
-             ent.title,
-             ent.link,
-             (SELECT array_agg(DISTINCT (s."Mol_common_name"))
-              FROM "Chem_shift_experiment" cse
-                       LEFT JOIN "Sample_component" s ON s."Sample_ID" = cse."Sample_ID"
-                  AND s."Entry_ID" = cse."Entry_ID"
-                  AND cse."Assigned_chem_shift_list_ID" = atom_shift."Assigned_chem_shift_list_ID"
-                  AND cse."Entry_ID" = atom_shift."Entry_ID"
-              WHERE (s."Type" ilike 'solvent' OR (s."Type" IS NULL
-                  AND s."Concentration_val_units" = '%%'
-                  AND web.convert_to_numeric(s."Concentration_val") >= 20
-                  AND s."Entity_ID" IS NULL)))                                     AS solvent
-      FROM "Atom_chem_shift" AS atom_shift
-               LEFT JOIN web.instant_cache AS ent
-                         ON ent.id = atom_shift."Entry_ID"
-      WHERE  '''
-
     shift_floats: List[float] = []
-    shift_decimals: List[Decimal] = []
     shift = None
     try:
         for shift in shift_strings:
             shift_floats.append(float(shift))
-            shift_decimals.append(Decimal(shift))
+            if not math.isfinite(shift_floats[-1]) or abs(shift_floats[-1]) > 1000:
+                raise ValueError
     except ValueError:
-        raise RequestException("Invalid shift specified. All shifts must be numbers. Invalid shift: '%s'" % shift)
-
-    shift_floats = sorted(shift_floats)
-    shift_decimals = sorted(shift_decimals)
-
-    for shift in shift_floats:
-        sql += '''
-((atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'C')
- OR
- (atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'N')
- OR
- (atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'H')) OR '''
-        terms.append(shift + thresholds['C'])
-        terms.append(shift - thresholds['C'])
-        terms.append(shift + thresholds['N'])
-        terms.append(shift - thresholds['N'])
-        terms.append(shift + thresholds['H'])
-        terms.append(shift - thresholds['H'])
-
-    # End the OR
-    sql += '''
-1=2
-GROUP BY atom_shift."Entry_ID",atom_shift."Assigned_chem_shift_list_ID",ent.title,ent.link
-ORDER BY count(DISTINCT atom_shift."Val") DESC) sq
-    '''
+        raise RequestException("Invalid shift specified. All shifts must be numbers between -1000 and 1000. "
+                               "Invalid shift: '%s'" % shift)
+
+    # Match and score the shift lists, and then only fetch the details of the matching lists
+    result = {"data": []}
+    if database == 'macromolecules':
+        matches, truncated = search_fingerprints(database, shift_floats, thresholds)
+        if truncated:
+            result['truncated'] = True
+    else:
+        matches = get_shift_index(database).search(shift_floats, thresholds)
 
-    if solvent != 'any':
-        sql += " WHERE %s ilike ANY(solvent)"
-        terms.append(solvent)
+    if not matches:
+        return jsonify(result)
 
-    # Do the query
-    with PostgresConnection(schema=get_db("metabolomics")) as cur:
-        cur.execute(sql, terms)
-        result = {"data": []}
+    with PostgresConnection(schema=database) as cur:
+        cur.execute(sql_statements.multiple_shift_search_details,
+                    {'entry_ids': [x['Entry_ID'] for x in matches],
+                     'list_ids': [x['Assigned_chem_shift_list_ID'] for x in matches],
+                     'solvent': solvent})
 
         # Send query string if in debug mode
         if configuration['debug']:
             result['debug'] = cur.query
 
-        for entry in cur:
-            title = entry[3].replace("\n", "") if entry[3] else None
-            # Perfect opportunity for walrus operator once using 3.8
-            shifts = [{'Shift': Decimal(y[0]), 'Atom_type': y[1]} for y in [x.split(',') for x in entry[2]]]
-
-            result['data'].append({'Entry_ID': entry[0], 'Assigned_chem_shift_list_ID': entry[1], 'Title': title,
-                                   'Link': entry[4], 'Val': shifts, 'Solvent': entry[5]})
-
-    def get_closest(collection, number):
-        """ Returns the closest number from a list of numbers. """
-        return min(collection, key=lambda _: abs(_ - number))
-
-    def get_closest_by_atom(collection: dict,
-                            shift_value: Decimal) -> dict:
-        """ Returns the closest [shift,atom_name] pair from the options. """
-
-        # Start with impossibly bad peak of the correct atom type, in case no matches for this peak exist
-        best_match: dict = {'Shift': Decimal('inf'), 'Atom_type': None}
-        for item in collection:
-            if abs(item['Shift'] - shift_value) < best_match['Shift']:
-                best_match = {'Shift': item['Shift'], 'Atom_type': item['Atom_type']}
-        return best_match
-
-    def get_sort_key(res) -> [int, Decimal, str]:
-        """ Returns the sort key. """
-
-        key: Decimal = Decimal(0)
+        details = {(x['entry_id'], x['list_id']): x for x in cur.fetchall()}
 
-        # Add the difference of all the shifts
-        for item in res['Val']:
-            key += abs(get_closest(shift_decimals, item['Shift']) - item['Shift'])
-        res['Combined_offset'] = round(key, 3)
-
-        # Determine how many of the queried shifts were matched
-        num_match = 0
-        for check_peak in shift_decimals:
-            closest = get_closest_by_atom(res['Val'], check_peak)
-            if abs(check_peak - closest['Shift']) <= thresholds[closest['Atom_type']]:
-                num_match += 1
-        res['Shifts_matched'] = num_match
-
-        return -num_match, key, res['Entry_ID']
-
-    result['data'] = sorted(result['data'], key=get_sort_key)
+    for match in matches:
+        detail = details.get((match['Entry_ID'], match['Assigned_chem_shift_list_ID']))
+        # Filtered out by solvent
+        if not detail:
+            continue
+        title = detail['title'].replace("\n", "") if detail['title'] else None
+        result['data'].append({'Entry_ID': match['Entry_ID'],
+                               'Assigned_chem_shift_list_ID': match['Assigned_chem_shift_list_ID'],
+                               'Title': title, 'Link': detail['link'], 'Val': match['Val'],
+                               'Solvent': detail['solvent'], 'Combined_offset': match['Combined_offset'],
+                               'Shifts_matched': match['Shifts_matched']})
 
     return jsonify(result)
 
@@ -274,6 +218,18 @@ def get_chemical_shifts():
     database: str = get_db("macromolecules", valid_list=['macromolecules', 'metabolomics'])
     dictionary_result: bool = request.args.get('dictionary_result', False)
 
+    output_format: str = request.args.get('format', 'json')
+    if output_format not in STREAM_FORMATS:
+        raise RequestException('Invalid format specified. Please choose from: %s' % ', '.join(STREAM_FORMATS))
+    limit: str = request.args.get('limit', None)
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            raise RequestException('The limit must be a positive integer.')
+        limit: int = int(limit)
+    cursor: str = request.args.get('cursor', None)
+    if cursor and limit is None:
+        raise RequestException('A cursor can only be used together with a limit.')
+
     sql = '''
 SELECT "Atom_chem_shift.Entry_ID",
        "Atom_chem_shift.Entity_ID",
@@ -287,7 +243,12 @@ SELECT "Atom_chem_shift.Entry_ID",
        "Atom_chem_shift.Ambiguity_code",
        "Atom_chem_shift.Assigned_chem_shift_list_ID",
        "Sample_conditions.pH",
-       "Sample_conditions.Temperature_K"
+       "Sample_conditions.Temperature_K"'''
+    # The row ID is only needed for the pagination cursor
+    if limit is not None:
+        sql += ''',
+       row_id'''
+    sql += '''
 FROM web.chem_shifts
 WHERE
 '''
@@ -361,19 +322,28 @@ WHERE
     sql += '''database=%s'''
     args.append(database)
 
-    # Do the query
-    with PostgresConnection(real_dict_cursor=dictionary_result) as cur:
-        cur.execute(sql, args)
-
-        if not dictionary_result:
-            result = {'columns': [desc[0] for desc in cur.description],
-                      'data': cur.fetchall()}
-            # Send query string if in debug mode
-            if configuration['debug']:
-                result['debug'] = cur.query
-            return jsonify(result)
-        else:
-            return jsonify(cur.fetchall())
+    if limit is None:
+        return stream_query(sql, args, output_format=output_format, dictionary_result=dictionary_result)
+
+    # Keyset pagination - continue after the last row of the previous page, in the order of the entry index. A shift
+    #  has a row for each of its sample conditions, so the row ID is needed to make the key unique. NULLs are
+    #  coalesced so that rows with them are neither skipped nor repeated.
+    key_columns = ['Atom_chem_shift.Entry_ID', 'Atom_chem_shift.Assigned_chem_shift_list_ID',
+                   'Atom_chem_shift.Entity_assembly_ID', 'Atom_chem_shift.Comp_index_ID', 'Atom_chem_shift.Atom_ID',
+                   'row_id']
+    key_defaults = ["''", '-1', '-1', '-1', "''", None]
+    key_types = [str, int, int, int, str, int]
+    key_sql = ', '.join('COALESCE("%s", %s)' % (column, default) if default else '"%s"' % column
+                        for column, default in zip(key_columns, key_defaults))
+    if cursor:
+        sql += ' AND (%s) > (%s)' % (key_sql, ', '.join('COALESCE(%%s, %s)' % default if default else '%s'
+                                                        for default in key_defaults))
+        args.extend(decode_cursor(cursor, key_types))
+    sql += ' ORDER BY %s LIMIT %%s' % key_sql
+    args.append(limit)
+
+    return paginated_query(sql, args, key_columns, limit, output_format=output_format,
+                           dictionary_result=dictionary_result, hidden_columns=1)
 
 
 @search_endpoints.route('/search/get_all_values_for_tag/<tag_name>')
@@ -383,38 +353,64 @@ def get_all_values_for_tag(tag_name):
     database = get_db('macromolecules')
 
     params = get_category_and_tag(tag_name)
-    with PostgresConnection(schema=database) as cur:
-
-        # Use Entry_ID normally, but occasionally use ID depending on the context
-        id_field = get_entry_id_tag(tag_name, database=database)
-
-        query = '''SELECT "%s", array_agg(%%s) from "%s" GROUP BY "%s";'''
-        query = query % (id_field, params[0], id_field)
+    # Use Entry_ID normally, but occasionally use ID depending on the context
+    id_field = get_entry_id_tag(tag_name, database=database)
+
+    # Empty and "na" values are left out, as are the entries which only have those
+    query = '''SELECT "%s", array_agg("%s") FROM "%s" WHERE "%s" IS NOT NULL AND "%s"::text NOT IN ('', 'na')
+GROUP BY "%s";''' % (id_field, params[1], params[0], params[1], params[1], id_field)
+
+    def open_stream() -> Iterator[str]:
+        def fetch_batches() -> Iterator:
+            with PostgresConnection(schema=database, cursor_name='all_values') as cur:
+                try:
+                    cur.execute(query)
+                    batch = cur.fetchmany(STREAM_BATCH_ROWS)
+                except ProgrammingError as e:
+                    sp = str(e).split('\n')
+                    if len(sp) > 3:
+                        if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
+                            raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
+                                                   sp[3].split('"')[1])
+
+                    raise RequestException("Tag not found.")
+                yield cur.query
+                while batch:
+                    yield batch
+                    batch = cur.fetchmany(STREAM_BATCH_ROWS)
+
+        # Run the query before the response is started, so that an unknown tag is still reported as an error
+        batches = fetch_batches()
+        executed_query = next(batches)
+
+        def generate() -> Iterator[str]:
+            try:
+                yield '{'
+                separator = ''
+                for batch in batches:
+                    yield separator + ','.join('%s: %s' % (json.dumps(x[0]), json.dumps(x[1])) for x in batch)
+                    separator = ','
+                if configuration['debug']:
+                    yield '%s"query": %s' % (separator, json.dumps(executed_query.decode()))
+                yield '}'
+            finally:
+                batches.close()
+
+        return generate()
+
+    # The values only change when the database is reloaded
+    generation = None
+    if not configuration['debug']:
         try:
-            cur.execute(query, [wrap_it_up(params[1])])
-        except ProgrammingError as e:
-            sp = str(e).split('\n')
-            if len(sp) > 3:
-                if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
-                    raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
-                                           sp[3].split('"')[1])
-
-            raise RequestException("Tag not found.")
-
-        # Turn the results into a dict
-        res = {}
-        for x in cur.fetchall():
-            sub_res = []
-            for elem in x[1]:
-                if elem and elem != "na":
-                    sub_res.append(elem)
-            if len(sub_res) > 0:
-                res[x[0]] = sub_res
-
-        if configuration['debug']:
-            res['query'] = cur.query
+            with RedisConnection() as r:
+                generation = r.hget('%s:meta' % database, 'update_time')
+        except (redis.exceptions.RedisError, ServerException) as err:
+            logging.warning('Could not use the Redis cache: %s', err)
+    if generation is None:
+        return Response(open_stream(), mimetype='application/json')
 
-    return res
+    key = 'all_values:%s:%s:%s' % (database, tag_name, generation.decode())
+    return Response(cached_stream(key, open_stream, ALL_VALUES_CACHE_TTL), mimetype='application/json')
 
 
 @search_endpoints.route('/search/get_id_by_tag_value/<tag_name>/<path:tag_value>')
@@ -448,95 +444,70 @@ def get_pdb_ids_from_bmrb_id(bmrb_id):
     """ Returns the associated PDB IDs for a BMRB ID. """
 
     with PostgresConnection() as cur:
-        query = '''
-    SELECT pdb_id, 'Exact' AS link_type, null AS comment
-      FROM web.pdb_link
-      WHERE bmrb_id LIKE %s
-    UNION
-    SELECT "Database_accession_code", 'Author Provided', "Relationship"
-      FROM macromolecules."Related_entries"
-      WHERE "Entry_ID" LIKE %s AND "Database_name" = 'PDB'
-        AND "Relationship" != 'BMRB Entry Tracking System' AND "Relationship" != 'BMRB Tracking System'
-    UNION
-    SELECT "Accession_code", 'Author Provided', "Entry_details"
-      FROM macromolecules."Entity_db_link"
-      WHERE "Entry_ID" LIKE %s AND "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
-    UNION
-    SELECT "Accession_code", 'Author Provided', "Entry_details"
-      FROM macromolecules."Assembly_db_link"
-      WHERE "Entry_ID" LIKE %s AND "Database_code" = 'PDB' AND "Author_supplied" = 'yes'
-    UNION
-    SELECT "Accession_code", 'BLAST Match', "Entry_details"
-      FROM macromolecules."Entity_db_link"
-      WHERE "Entry_ID" LIKE %s AND "Database_code" = 'PDB' AND "Author_supplied" != 'yes';'''
-
-        cur.execute(query, [bmrb_id, bmrb_id, bmrb_id, bmrb_id, bmrb_id])
-        return jsonify([{"pdb_id": x[0], "match_type": x[1], "comment": x[2]} for x in cur.fetchall()])
+        cur.execute(sql_statements.pdb_ids_from_bmrb_id, [bmrb_id])
+        return jsonify([{"pdb_id": x[0], "match_type": PDB_LINK_TYPES[x[1]], "comment": x[2]} for x in cur.fetchall()])
+
+
+def _fasta_job_response(job_id: str, job: dict) -> Response:
+    """ Returns the ID, status, and URL of a FASTA search job, with a 202 status until it has completed. """
+
+    response = jsonify({'job_id': job_id, 'status': job['status'],
+                        'url': url_for('search.fasta_job', job_id=job_id, _external=True)})
+    response.status_code = 200 if job['status'] == 'complete' else 202
+    return response
 
 
 @search_endpoints.route('/search/fasta/<sequence>')
 def fasta_search(sequence):
     """Performs a FASTA search on the specified query in the BMRB database."""
 
-    fasta_binary = os.path.join(SUBMODULE_DIR, "fasta36", "bin", "fasta36")
     a_type = request.args.get('type', 'polymer')
     e_val = request.args.get('e_val')
 
-    # Map the type to the exact name
-    a_type = {'polymer': 'polypeptide(L)', 'rna': 'polyribonucleotide', 'dna': 'polydeoxyribonucleotide'}[a_type]
-
-    if not os.path.isfile(fasta_binary):
-        raise ServerException("Unable to perform FASTA search. Server improperly installed.")
-
-    with PostgresConnection(schema="macromolecules") as cur:
-        cur.execute('''
-SELECT ROW_NUMBER() OVER (ORDER BY 1) AS id, entity."Entry_ID",entity."ID",
-  regexp_replace(entity."Polymer_seq_one_letter_code", E'[\\n\\r]+', '', 'g' ),
-  replace(regexp_replace(entry."Title", E'[\\n\\r]+', ' ', 'g' ), '  ', ' ')
-FROM "Entity" as entity
-  LEFT JOIN "Entry" as entry
-  ON entity."Entry_ID" = entry."ID"
-  WHERE entity."Polymer_seq_one_letter_code" IS NOT NULL AND "Polymer_type" = %s''', [a_type])
-
-        sequences = cur.fetchall()
-
-    wrapper = textwrap.TextWrapper(width=80, expand_tabs=False,
-                                   replace_whitespace=False,
-                                   drop_whitespace=False, break_on_hyphens=False)
-    seq_strings = [">%s\n%s\n" % (x[0], "\n".join(wrapper.wrap(x[3]))) for x in sequences]
-
-    # Use temporary files to store the FASTA search string and FASTA DB
-    with NamedTemporaryFile(dir="/tmp") as fasta_file, \
-            NamedTemporaryFile(dir="/tmp") as sequence_file:
-        fasta_file.write((">query\n%s" % sequence.upper()).encode())
-        fasta_file.flush()
-
-        sequence_file.write(("".join(seq_strings)).encode())
-        sequence_file.flush()
-
-        # Set up the FASTA arguments
-        fasta_arguments = [fasta_binary, "-m", "8"]
-        if e_val:
-            fasta_arguments.extend(["-E", e_val])
-        fasta_arguments.extend([fasta_file.name, sequence_file.name])
-
-        # Run FASTA
-        res = subprocess.check_output(fasta_arguments, stderr=subprocess.STDOUT).decode()
-
-    # Combine the results
-    results = []
-    for line in res.split("\n"):
-        cols = line.split()
-        if len(cols) == 12:
-            matching_row = sequences[int(cols[1]) - 1]
-            results.append({'entry_id': matching_row[1], 'entity_id': matching_row[2],
-                            'entry_title': matching_row[4], 'percent_id': Decimal(cols[2]),
-                            'alignment_length': int(cols[3]), 'mismatches': int(cols[4]),
-                            'gap_openings': int(cols[5]), 'q.start': int(cols[6]),
-                            'q.end': int(cols[7]), 's.start': int(cols[8]), 's.end': int(cols[9]),
-                            'e-value': Decimal(cols[10]), 'bit_score': Decimal(cols[11])})
-
-    return jsonify(results)
+    if a_type not in FASTA_POLYMER_TYPES:
+        raise RequestException('Invalid type specified. Please choose from: %s' % ', '.join(FASTA_POLYMER_TYPES))
+
+    # The search runs on the bounded FASTA executor, and identical searches are answered from the stored results. A
+    #  search which hasn't finished yet is answered like the POST method below.
+    job_id = submit_fasta_job(sequence, a_type, e_val)
+    job = get_fasta_job(job_id) or {'status': 'queued'}
+    if job['status'] == 'complete':
+        return jsonify(job['results'])
+    if job['status'] == 'failed':
+        raise ServerException(job['error'])
+    return _fasta_job_response(job_id, job)
+
+
+@search_endpoints.route('/search/fasta', methods=['POST'])
+@require_content_type_json
+def submit_fasta_search():
+    """ Starts a FASTA search, and returns the ID of the job to poll for the results. """
+
+    params: dict = request.json
+    sequence = params.get('sequence')
+    a_type = params.get('type', 'polymer')
+    e_val = params.get('e_val')
+
+    if not sequence or not isinstance(sequence, str):
+        raise RequestException('You must specify the sequence to search for.')
+    if a_type not in FASTA_POLYMER_TYPES:
+        raise RequestException('Invalid type specified. Please choose from: %s' % ', '.join(FASTA_POLYMER_TYPES))
+    if e_val is not None:
+        e_val = str(e_val)
+
+    job_id = submit_fasta_job(sequence, a_type, e_val)
+    return _fasta_job_response(job_id, get_fasta_job(job_id) or {'status': 'queued'})
+
+
+@search_endpoints.route('/search/fasta/job/<job_id>')
+def fasta_job(job_id):
+    """ Returns the status of a FASTA search job, and the results once it has completed. """
+
+    job = get_fasta_job(job_id)
+    if job is None:
+        raise RequestException('No such FASTA search job. (Results are kept for one day.)', 404)
+    job['job_id'] = job_id
+    return jsonify(job)
 
 
 @search_endpoints.route('/instant')
@@ -545,12 +516,26 @@ def reroute_instant_internal():
     return instant()
 
 
-@search_endpoints.route('/search/instant')
-def instant():
-    """ Do the instant search. """
+def _negation_filter(negated_terms: Set[str], match_term: bool) -> Tuple[str, dict]:
+    """ Returns the SQL (and its parameters) excluding results whose title or citations contain any of the negated
+    terms. Specify match_term to also exclude results whose matched extra search term contains a negated term. """
+
+    sql, args = '', {}
+    for position, negated_term in enumerate(sorted(negated_terms)):
+        # Escape the LIKE wildcards - the negated terms are matched as plain substrings
+        args['negated_%d' % position] = '%%%s%%' % re.sub(r'([\\%_])', r'\\\1', negated_term)
+        parameter = '%%(negated_%d)s' % position
+        conditions = ["COALESCE(title, '') ILIKE " + parameter,
+                      "EXISTS (SELECT 1 FROM unnest(citations) AS citation WHERE citation ILIKE %s)" % parameter]
+        if match_term:
+            conditions.append("COALESCE(term, '') ILIKE " + parameter)
+        sql += ' AND NOT (%s)' % ' OR '.join(conditions)
+    return sql, args
 
-    term = request.args.get('term')
-    database = get_db('combined')
+
+def _instant_search(database: str, term: str, negated_terms: Set[str]) -> Optional[List[dict]]:
+    """ Runs the instant search queries, excluding the results matching any of the negated terms. Returns None if the
+    instant search tables are unavailable. """
 
     if database == "metabolomics":
         instant_query_one = sql_statements.metabolomics_instant_query_one
@@ -563,31 +548,16 @@ def instant():
         instant_query_one = sql_statements.combined_instant_query_one
         instant_query_two = sql_statements.combined_instant_query_two
 
-    # This code strips out the "negation" terms
-    split_term: List[str] = [_.lower() for _ in shlex.split(term, posix=False)]
-    negated_terms: Set[str] = set()
-    x = 0
-    while x < len(split_term):
-        if split_term[x].lower() == 'not' and x + 1 < len(split_term):
-            negated_terms.add(split_term[x+1])
-            split_term.pop(x)
-            split_term.pop(x)
-            continue
-        if split_term[x].startswith("-"):
-            negated_terms.add(split_term[x][1:])
-            split_term.pop(x)
-            continue
-        x += 1
-    term = " ".join(split_term)
+    filter_one, filter_one_args = _negation_filter(negated_terms, False)
+    filter_two, filter_two_args = _negation_filter(negated_terms, True)
 
     with PostgresConnection() as cur:
         try:
-            cur.execute(instant_query_one, [term, term, term])
+            cur.execute(instant_query_one.format(negation_filter=filter_one), dict(filter_one_args, term=term))
         except psycopg2.ProgrammingError:
             if configuration['debug']:
                 raise
-            return [{"label": "Instant search temporarily offline.", "value": "error",
-                     "link": "/software/query/"}]
+            return None
 
         # First query
         result = []
@@ -618,12 +588,11 @@ def instant():
 
         # Second query
         try:
-            cur.execute(instant_query_two, [term, term, term, term])
+            cur.execute(instant_query_two.format(negation_filter=filter_two), dict(filter_two_args, term=term))
         except psycopg2.ProgrammingError:
             if configuration['debug']:
                 raise
-            return [{"label": "Instant search temporarily offline.", "value": "error",
-                     "link": "/software/query/"}]
+            return None
 
         for item in cur.fetchall():
             if item['id'] not in ids:
@@ -650,30 +619,46 @@ def instant():
             debug['query2'] = cur.query
             result.append({"debug": debug})
 
-    def needs_remove(negated_term_list, check_result):
-        for negated_term in negated_term_list:
-            if negated_term in check_result['label'].lower():
-                return True
-            if 'extra' in check_result and negated_term in check_result['extra']['term'].lower():
-                return True
-            citations = check_result['citations']
-            if citations[0] is None:
-                citations.pop(0)
-            if any([negated_term in _.lower() for _ in [_ for _ in citations]]):
-                return True
-        return False
-
-    # Remove the negation results
+    return result
+
+
+@search_endpoints.route('/search/instant')
+def instant():
+    """ Do the instant search. """
+
+    term = request.args.get('term')
+    database = get_db('combined')
+
+    # This code strips out the "negation" terms
+    split_term: List[str] = [_.lower() for _ in shlex.split(term, posix=False)]
+    negated_terms: Set[str] = set()
     x = 0
-    while x < len(result):
-        if 'debug' in result[x]:
-            x += 1
+    while x < len(split_term):
+        if split_term[x].lower() == 'not' and x + 1 < len(split_term):
+            negated_terms.add(split_term[x+1])
+            split_term.pop(x)
+            split_term.pop(x)
             continue
-        if needs_remove(negated_terms, result[x]):
-            result.pop(x)
+        if split_term[x].startswith("-"):
+            negated_terms.add(split_term[x][1:])
+            split_term.pop(x)
             continue
         x += 1
+    term = " ".join(split_term)
 
+    if configuration['debug']:
+        result = _instant_search(database, term, negated_terms)
+    else:
+        # The same prefixes are searched constantly as people type, so cache the results until the instant search
+        #  tables are next reloaded (which increments the generation) or the TTL expires
+        search_hash = hashlib.sha1(json.dumps([term, sorted(negated_terms)]).encode()).hexdigest()
+        result = cached_json('instant:%s:%s' % (database, search_hash),
+                             partial(_instant_search, database, term, negated_terms), INSTANT_CACHE_TTL,
+                             generation_key='instant:generation')
+
+    if result is None:
+        return [{"label": "Instant search temporarily offline.", "value": "error",
+                 "link": "/software/query/"}]
     return jsonify(result)
 
 
@@ -692,10 +677,30 @@ def select():
     if database not in ["chemcomps", "macromolecules", "metabolomics", "dict"]:
         raise RequestException("Invalid database specified.")
 
+    output_format = params.get("format", "json")
+    if output_format != "json" and output_format not in COLUMNAR_FORMATS:
+        raise RequestException("Invalid format specified. Please choose from: json, %s" % ", ".join(COLUMNAR_FORMATS))
+
     # Okay, now we need to go through each query and get the results
     if not isinstance(params['query'], list):
         params['query'] = [params['query']]
 
+    # Optionally, join the queries on the entry ID in the database rather than returning each result separately
+    join = params.get("join")
+    if join is not None and join != "Entry_ID":
+        raise RequestException("Invalid join specified. Queries can only be joined on: Entry_ID")
+    limit, offset = params.get("limit"), params.get("offset", 0)
+    if limit is not None or offset:
+        if not join:
+            raise RequestException("The limit and offset parameters are only supported when joining queries.")
+        if limit is not None and (not isinstance(limit, int) or limit < 1):
+            raise RequestException("The limit must be a positive integer.")
+        if not isinstance(offset, int) or offset < 0:
+            raise RequestException("The offset must be a non-negative integer.")
+
+    if output_format != "json" and len(params['query']) > 1 and not join:
+        raise RequestException("Only the json format is supported when performing multiple queries.")
+
     result_list = []
 
     # Build the amalgamation of queries
@@ -706,7 +711,7 @@ def select():
         if not isinstance(each_query['select'], list):
             each_query['select'] = [each_query['select']]
         # We need the ID to join if they are doing multiple queries
-        if len(params['query']) > 1:
+        if len(params['query']) > 1 and not join:
             each_query['select'].append("Entry_ID")
         if "from" not in each_query:
             raise RequestException('You must specify which table to query with the "from" parameter.')
@@ -720,12 +725,28 @@ def select():
 
         each_query['where'] = each_query.get("where", {})
 
-        if len(params['query']) > 1:
+        if join:
+            # The queries are combined below
+            continue
+        elif len(params['query']) > 1:
             # If there are multiple queries then add their results to the list
             cur_res = querymod_select(each_query['select'], each_query['from'],
                                       where_dict=each_query['where'], database=database,
                                       modifiers=each_query['modifiers'], as_dict=False)
             result_list.append(cur_res)
+        elif output_format in COLUMNAR_FORMATS or not each_query['dict']:
+            # Stream the results as they are read, rather than assembling them first
+            query, parameters = build_select_query(each_query['select'], each_query['from'],
+                                                   where_dict=each_query['where'], database=database,
+                                                   modifiers=each_query['modifiers'])
+            try:
+                # The JSON columns are named <table>.<column>, as in the non-streamed results
+                return stream_query(query, parameters, output_format=output_format,
+                                    column_prefix=each_query['from'] + "." if output_format == "json" else "")
+            except ProgrammingError as error:
+                if configuration['debug']:
+                    raise error
+                raise RequestException("Invalid 'from' parameter.")
         else:
             # If there is only one query just return it
             return querymod_select(each_query['select'], each_query['from'],
@@ -733,4 +754,14 @@ def select():
                                    modifiers=each_query['modifiers'],
                                    as_dict=each_query['dict'])
 
+    if join:
+        query, parameters = build_join_query(params['query'], database=database,
+                                             join_type=params.get("join_type", "inner"), limit=limit, offset=offset)
+        try:
+            return stream_query(query, parameters, output_format=output_format)
+        except ProgrammingError as error:
+            if configuration['debug']:
+                raise error
+            raise RequestException("Invalid 'from' or 'select' parameter.")
+
     return result_list
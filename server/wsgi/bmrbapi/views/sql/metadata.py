@@ -1,172 +1,53 @@
-released_in_year: str = """
-SELECT lt.year, count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, date_part('year', logdate) AS year
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum, year) AS lt ON el.depnum = lt.depnum
-WHERE lt.depnum IS NOT NULL
-GROUP BY lt.year
-ORDER BY lt.year;"""
-
-original_release_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE el.status LIKE 'rel%%'
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);"""
-
-withdrawn_entries_in_year: str = """
-SELECT lt.year, count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, date_part('year', min(logdate)) AS year
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status NOT LIKE 'rel%%'
-  AND lt.depnum IS NOT NULL
-GROUP BY lt.year
-ORDER BY lt.year;"""
-
-entries_released_this_year_since_withdrawn: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'awd'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status NOT LIKE 'rel%%'
-  AND lt.depnum IS NOT NULL
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);"""
-
-structure_aditnmr_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE el.status LIKE 'rel%%'
-  AND LENGTH(nmr_dep_code) = 7
-  AND pdb_code IS NOT NULL
-  AND pdb_code NOT IN ('?', '.', '')
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-structure_onedep_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE el.status LIKE 'rel%%'
-  AND LENGTH(nmr_dep_code) = 12
-  AND pdb_code IS NOT NULL
-  AND pdb_code NOT IN ('?', '.', '')
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-structure_bmrbdep_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND nmr_dep_code = restart_id
-  AND pdb_code IS NOT NULL
-  AND pdb_code NOT IN ('?', '.', '')
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-structure_total_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND el.pdb_code IS NOT NULL
-  AND el.pdb_code NOT IN ('?', '.', '')
-  AND el.pdb_code !~ '^[0-9]+$'
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-nonstructure_total_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND (pdb_code IS NULL OR pdb_code IN ('?', '.', '') OR pdb_code ~ '^[0-9]+$')
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-nonstructure_aditnmr_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND LENGTH(nmr_dep_code) = 7
-  AND (pdb_code IS NULL OR pdb_code IN ('?', '.', ''))
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-nonstructure_onedep_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND LENGTH(nmr_dep_code) = 12
-  AND (pdb_code IS NULL OR pdb_code IN ('?', '.', ''))
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
-
-nonstructure_bmrbdep_in_year: str = """
-SELECT date_part('year', logdate), count(*)
-FROM entrylog AS el
-         LEFT JOIN
-     (SELECT depnum, min(logdate) AS logdate
-      FROM logtable
-      WHERE newstatus = 'rel'
-      GROUP BY depnum) AS lt ON el.depnum = lt.depnum
-WHERE status LIKE 'rel%%'
-  AND nmr_dep_code = restart_id
-  AND (pdb_code IS NULL OR pdb_code IN ('?', '.', ''))
-GROUP BY date_part('year', logdate)
-ORDER BY date_part('year', logdate);
-"""
+release_statistics: str = """
+WITH first_release AS (SELECT depnum, min(logdate) AS logdate
+                       FROM logtable
+                       WHERE newstatus = 'rel'
+                       GROUP BY depnum),
+     first_withdrawal AS (SELECT depnum, min(logdate) AS logdate
+                          FROM logtable
+                          WHERE newstatus = 'awd'
+                          GROUP BY depnum),
+     release_years AS (SELECT depnum, date_part('year', logdate) AS year
+                       FROM logtable
+                       WHERE newstatus = 'rel'
+                       GROUP BY depnum, year),
+     by_first_release AS (
+         SELECT date_part('year', fr.logdate) AS year,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%') AS original_release_in_year,
+                count(*) FILTER (WHERE el.status NOT LIKE 'rel%%') AS withdrawn_or_obsoleted_during_year,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND el.pdb_code NOT IN ('?', '.', '')
+                    AND el.pdb_code !~ '^[0-9]+$') AS structure_total,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND LENGTH(el.nmr_dep_code) = 7
+                    AND el.pdb_code NOT IN ('?', '.', '')) AS structure_aditnmr,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND LENGTH(el.nmr_dep_code) = 12
+                    AND el.pdb_code NOT IN ('?', '.', '')) AS structure_onedep,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND el.nmr_dep_code = el.restart_id
+                    AND el.pdb_code NOT IN ('?', '.', '')) AS structure_bmrbdep,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND (el.pdb_code IS NULL
+                    OR el.pdb_code IN ('?', '.', '') OR el.pdb_code ~ '^[0-9]+$')) AS nonstructure_total,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND LENGTH(el.nmr_dep_code) = 7
+                    AND (el.pdb_code IS NULL OR el.pdb_code IN ('?', '.', ''))) AS nonstructure_aditnmr,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND LENGTH(el.nmr_dep_code) = 12
+                    AND (el.pdb_code IS NULL OR el.pdb_code IN ('?', '.', ''))) AS nonstructure_onedep,
+                count(*) FILTER (WHERE el.status LIKE 'rel%%' AND el.nmr_dep_code = el.restart_id
+                    AND (el.pdb_code IS NULL OR el.pdb_code IN ('?', '.', ''))) AS nonstructure_bmrbdep
+         FROM entrylog AS el
+                  JOIN first_release AS fr ON el.depnum = fr.depnum
+         GROUP BY 1),
+     by_release AS (
+         SELECT ry.year, count(*) AS released_in_year
+         FROM entrylog AS el
+                  JOIN release_years AS ry ON el.depnum = ry.depnum
+         GROUP BY ry.year),
+     by_first_withdrawal AS (
+         SELECT date_part('year', fw.logdate) AS year, count(*) AS withdrawn_or_obsoleted_from_year
+         FROM entrylog AS el
+                  JOIN first_withdrawal AS fw ON el.depnum = fw.depnum
+         WHERE el.status NOT LIKE 'rel%%'
+         GROUP BY 1)
+SELECT *
+FROM by_first_release
+         FULL JOIN by_release USING (year)
+         FULL JOIN by_first_withdrawal USING (year)
+WHERE year IS NOT NULL
+ORDER BY year;"""
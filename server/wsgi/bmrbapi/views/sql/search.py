@@ -15,10 +15,10 @@ SELECT instant_cache.id,
 FROM web.instant_cache
          LEFT JOIN web.metabolomics_summary AS ms
                    ON instant_cache.id = ms.id
-WHERE tsv @@ plainto_tsquery(%s)
+WHERE tsv @@ plainto_tsquery(%(term)s)
   AND is_metab = 'True'
-  AND ms.id IS NOT NULL
-ORDER BY instant_cache.id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;'''
+  AND ms.id IS NOT NULL {negation_filter}
+ORDER BY instant_cache.id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC;'''
 
 metabolomics_instant_query_two = """
 SELECT set_limit(.5);
@@ -42,14 +42,14 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
-  AND is_metab = 'True'
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s)
+  AND is_metab = 'True' {negation_filter}
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                  termname,
-                                 similarity(tt.term, %s) AS sml,
+                                 similarity(tt.term, %(term)s) AS sml,
                                  tt.id,
                                  title,
                                  citations,
@@ -69,18 +69,18 @@ FROM (
                             ON instant_cache.id = tt.id
                   LEFT JOIN web.metabolomics_summary AS ms
                             ON instant_cache.id = ms.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s
            AND tt.identical_term IS NULL
            AND ms.id IS NOT NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
-WHERE is_metab = 'True'"""
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
+WHERE is_metab = 'True' {negation_filter}"""
 
 macromolecules_instant_query_one = '''
 SELECT id, title, citations, authors, link, sub_date, data_types
 FROM web.instant_cache
-WHERE tsv @@ plainto_tsquery(%s)
-  AND is_metab = 'False'
-ORDER BY id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;
+WHERE tsv @@ plainto_tsquery(%(term)s)
+  AND is_metab = 'False' {negation_filter}
+ORDER BY id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC;
 '''
 
 macromolecules_instant_query_two = '''
@@ -99,13 +99,13 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s) {negation_filter}
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                                termname,
-                                               similarity(tt.term, %s) AS sml,
+                                               similarity(tt.term, %(term)s) AS sml,
                                                tt.id,
                                                title,
                                                citations,
@@ -117,10 +117,10 @@ FROM (
          FROM web.instant_cache
                   LEFT JOIN web.instant_extra_search_terms AS tt
                             ON instant_cache.id = tt.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s
            AND tt.identical_term IS NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
-WHERE is_metab = 'False'
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
+WHERE is_metab = 'False' {negation_filter}
 ORDER BY sml DESC
 LIMIT 75;
 '''
@@ -129,8 +129,8 @@ LIMIT 75;
 combined_instant_query_one = '''
 SELECT id, title, citations, authors, link, sub_date, data_types
 FROM web.instant_cache
-WHERE tsv @@ plainto_tsquery(%s)
-ORDER BY id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;
+WHERE tsv @@ plainto_tsquery(%(term)s) {negation_filter}
+ORDER BY id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC;
 '''
 
 combined_instant_query_two = '''
@@ -149,13 +149,13 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s) {negation_filter}
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                                termname,
-                                               similarity(tt.term, %s) AS sml,
+                                               similarity(tt.term, %(term)s) AS sml,
                                                tt.id,
                                                title,
                                                citations,
@@ -167,9 +167,50 @@ FROM (
          FROM web.instant_cache
                   LEFT JOIN web.instant_extra_search_terms AS tt
                             ON instant_cache.id = tt.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s
            AND tt.identical_term IS NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
+WHERE TRUE {negation_filter}
 ORDER BY sml DESC
 LIMIT 75;
-'''
\ No newline at end of file
+'''
+multiple_shift_search_details = '''
+SELECT *
+FROM (SELECT lists.entry_id,
+             lists.list_id,
+             ent.title,
+             ent.link,
+             (SELECT array_agg(DISTINCT (s."Mol_common_name"))
+              FROM "Chem_shift_experiment" cse
+                       LEFT JOIN "Sample_component" s ON s."Sample_ID" = cse."Sample_ID"
+                  AND s."Entry_ID" = cse."Entry_ID"
+                  AND cse."Assigned_chem_shift_list_ID" = lists.list_id
+                  AND cse."Entry_ID" = lists.entry_id
+              WHERE (s."Type" ilike 'solvent' OR (s."Type" IS NULL
+                  AND s."Concentration_val_units" = '%%'
+                  AND web.convert_to_numeric(s."Concentration_val") >= 20
+                  AND s."Entity_ID" IS NULL))) AS solvent
+      FROM unnest(%(entry_ids)s::text[], %(list_ids)s::text[]) AS lists(entry_id, list_id)
+               LEFT JOIN web.instant_cache AS ent
+                         ON ent.id = lists.entry_id) sq
+WHERE %(solvent)s = 'any' OR %(solvent)s ilike ANY(solvent)'''
+
+extra_data_available = '''
+SELECT "Entry_ID" as entry_id, ed."Type" as type, dic.catgrpviewname as description, "Count"::integer as sets,
+       0 as size from {database}."Data_set" as ed
+  LEFT JOIN dict.aditcatgrp as dic ON ed."Type" = dic.sfcategory
+ WHERE ed."Entry_ID" = ANY(%s)
+UNION
+SELECT bmrbid, 'time_domain_data', 'Time domain data', sets, size FROM web.timedomain_data where bmrbid = ANY(%s)
+ORDER BY entry_id, type;'''
+
+bmrb_ids_from_pdb_id = '''
+SELECT bmrb_id, array_agg(link_type ORDER BY link_type)
+  FROM web.pdb_bmrb_links
+ WHERE pdb_id = UPPER(%s)
+ GROUP BY bmrb_id;'''
+
+pdb_ids_from_bmrb_id = '''
+SELECT pdb_id, link_type, comment
+  FROM web.pdb_bmrb_links
+ WHERE bmrb_id = %s;'''